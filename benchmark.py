@@ -0,0 +1,232 @@
+# -*- coding: utf8 -*-
+'''
+@project   Maprox <http://www.maprox.net>
+@info      Benchmark of protocol parsers on recorded packets
+@copyright 2013, Maprox LLC
+
+Usage (from the root directory of the project):
+  python3 benchmark.py [-n REPEAT] [-t TOLERANCE] [--save] [handler ...]
+
+Corpus of a handler is stored in bench/corpus/<handler>.hex: every line
+is a hex string of data recorded from a device in one read (lines started
+with # are comments). Data is replayed through
+PacketFactory.getPacketsFromBuffer() and Handler.translate() of the handler.
+Results are compared with bench/baseline.json, the script exits with code 1
+if counts of packets differ from the baseline or performance is worse than
+the baseline more than TOLERANCE. Use --save to write a new baseline.
+Messages of the log below WARNING are not written unless --verbose is set.
+'''
+
+import argparse
+import binascii
+import importlib
+import json
+import logging
+import os
+import sys
+import time
+import tracemalloc
+from configparser import ConfigParser
+
+PATH_CORPUS = 'bench/corpus'
+PATH_BASELINE = 'bench/baseline.json'
+
+# fields of the result: (name, title, format)
+FIELDS = [
+    ('packets', 'packets', '%8d'),
+    ('records', 'records', '%8d'),
+    ('rate', 'packets/s', '%10.0f'),
+    ('p50', 'p50, us', '%9.1f'),
+    ('p99', 'p99, us', '%9.1f'),
+    ('memory', 'peak, KiB', '%10.1f')
+]
+
+def readCorpus(name):
+    """
+     Reads corpus of the handler
+     @param name: Name of the handler (e.g. naviset.gt20)
+     @return: list of bytes
+    """
+    chunks = []
+    with open(os.path.join(PATH_CORPUS, name + '.hex')) as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                chunks.append(binascii.unhexlify(line))
+    return chunks
+
+def getCorpusNames():
+    """
+     Returns names of handlers which have corpus
+     @return: list of str
+    """
+    return sorted(fileName[:-4] for fileName in os.listdir(PATH_CORPUS)
+        if fileName.endswith('.hex'))
+
+def createHandler(name):
+    """
+     Creates handler with packets factory configured by
+     [settings] section of the conf/handlers/<name>.conf
+     @param name: Name of the handler
+     @return: Handler instance
+    """
+    import kernel.pipe as pipe
+    module = importlib.import_module('lib.handlers.' + name)
+    handler = module.Handler(pipe.TestManager(), None)
+    parser = ConfigParser()
+    parser.optionxform = str
+    parser.read(os.path.join('conf', 'handlers', name + '.conf'))
+    config = dict(parser['settings']) if parser.has_section('settings') \
+        else {}
+    handler._packetsFactory = type(handler._packetsFactory)(config)
+    return handler
+
+def replay(handler, chunks, timings = None):
+    """
+     Replays chunks of data through the handler
+     @param handler: Handler instance
+     @param chunks: list of bytes
+     @param timings: list to append (time, count of packets) of every chunk
+     @return: tuple (count of packets, count of translated records)
+    """
+    factory = handler._packetsFactory
+    packetsCount = 0
+    recordsCount = 0
+    for chunk in chunks:
+        start = time.perf_counter()
+        packets = factory.getPacketsFromBuffer(chunk)
+        for packet in packets:
+            recordsCount += len(handler.translate(packet) or [])
+        if timings is not None:
+            timings.append((time.perf_counter() - start, len(packets)))
+        packetsCount += len(packets)
+    return packetsCount, recordsCount
+
+def getPercentile(values, percent):
+    """
+     Returns percentile of the sorted values
+     @param values: Sorted list of numbers
+     @param percent: Percent (0 - 100)
+     @return: number
+    """
+    if not values:
+        return 0
+    index = int(round((len(values) - 1) * percent / 100.0))
+    return values[index]
+
+def run(name, repeat):
+    """
+     Runs benchmark of the handler
+     @param name: Name of the handler
+     @param repeat: Count of replays of the corpus
+     @return: dict of results (see FIELDS)
+    """
+    handler = createHandler(name)
+    chunks = readCorpus(name)
+    packetsCount, recordsCount = replay(handler, chunks) # warm up
+    # memory is measured separately, tracing slows down the code
+    tracemalloc.start()
+    replay(handler, chunks)
+    memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    # throughput is calculated by the best time of every chunk as timeit
+    # does, other replays are slowed down by the system
+    timings = []
+    for i in range(repeat):
+        replay(handler, chunks, timings)
+    best = sum(min(elapsed for elapsed, count in timings[index::len(chunks)])
+        for index in range(len(chunks)))
+    latencies = []
+    for elapsed, count in timings:
+        if count:
+            latencies.extend([elapsed / count] * count)
+    latencies.sort()
+    return {
+        'packets': packetsCount,
+        'records': recordsCount,
+        'rate': packetsCount / best if best else 0,
+        'p50': getPercentile(latencies, 50) * 1e6,
+        'p99': getPercentile(latencies, 99) * 1e6,
+        'memory': memory / 1024.0
+    }
+
+def compare(result, baseline, tolerance):
+    """
+     Compares result of the handler with its baseline
+     @param result: dict of results
+     @param baseline: dict of baseline results
+     @param tolerance: Allowed relative degradation
+     @return: list of error messages
+    """
+    errors = []
+    for field in ['packets', 'records']:
+        if result[field] != baseline[field]:
+            errors.append('%s: %d (must be %d)' %
+                (field, result[field], baseline[field]))
+    if result['rate'] < baseline['rate'] * (1 - tolerance):
+        errors.append('rate: %.0f (baseline %.0f)' %
+            (result['rate'], baseline['rate']))
+    for field in ['p50', 'memory']:
+        if result[field] > baseline[field] * (1 + tolerance):
+            errors.append('%s: %.1f (baseline %.1f)' %
+                (field, result[field], baseline[field]))
+    return errors
+
+def main():
+    """
+     Runs benchmarks and checks them against the baseline
+     @return: Exit code
+    """
+    parser = argparse.ArgumentParser(
+        description = 'Benchmark of protocol parsers on recorded packets')
+    parser.add_argument('handlers', nargs = '*',
+        help = 'names of handlers (all handlers with corpus by default)')
+    parser.add_argument('-n', '--repeat', type = int, default = 200,
+        help = 'count of replays of the corpus')
+    parser.add_argument('-t', '--tolerance', type = float, default = 0.5,
+        help = 'allowed relative degradation against the baseline')
+    parser.add_argument('--save', action = 'store_true',
+        help = 'save results as a new baseline')
+    parser.add_argument('-v', '--verbose', action = 'store_true',
+        help = 'write debug messages to the log')
+    args = parser.parse_args()
+    # kernel.commandline parses arguments on import
+    sys.argv = sys.argv[:1]
+    from kernel.logger import log
+    if not args.verbose:
+        log.setLevel(logging.WARNING)
+
+    baseline = {}
+    if os.path.exists(PATH_BASELINE):
+        with open(PATH_BASELINE) as f:
+            baseline = json.load(f)
+
+    print(('%-22s' % 'handler') +
+        ''.join(' %*s' % (len(fmt % 0), title) for key, title, fmt in FIELDS))
+    results = {}
+    failed = False
+    for name in args.handlers or getCorpusNames():
+        result = run(name, args.repeat)
+        results[name] = result
+        print(('%-22s' % name) +
+            ''.join(' ' + fmt % result[key] for key, title, fmt in FIELDS))
+        if args.save:
+            continue
+        if name not in baseline:
+            print('  no baseline')
+            continue
+        for error in compare(result, baseline[name], args.tolerance):
+            print('  REGRESSION ' + error)
+            failed = True
+
+    if args.save:
+        baseline.update(results)
+        with open(PATH_BASELINE, 'w') as f:
+            json.dump(baseline, f, indent = 2, sort_keys = True)
+            f.write('\n')
+        print('Baseline is saved to ' + PATH_BASELINE)
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
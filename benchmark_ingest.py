@@ -0,0 +1,328 @@
+# -*- coding: utf8 -*-
+'''
+@project   Maprox <http://www.maprox.net>
+@info      End-to-end benchmark of the data ingest
+@copyright 2013, Maprox LLC
+
+Usage (from the root directory of the project):
+  python3 benchmark_ingest.py [-n CONNECTIONS] [-j CONCURRENCY]
+    [--server threading|asyncio] [handler]
+
+Starts kernel.server.Server (or AsyncServer) of the handler on a free port
+of the loopback interface. Message broker works with the memory://
+transport of kombu and redis is replaced by kernel.database.memory, so no
+external services are needed. Simulated devices connect to the server and
+send recorded data of the handler (see bench/corpus), the observer thread
+consumes packets published to the message broker.
+
+Reported values:
+  connections/s - connections served by the server
+  packets/s     - protocol packets parsed and records consumed by observer
+  ack latency   - time from sending data to receiving answer of the server
+  RSS           - resident memory of the process (server and clients)
+'''
+
+import argparse
+import logging
+import os
+import resource
+import socket
+import sys
+import time
+from threading import Thread, Lock
+
+from benchmark import readCorpus, getPercentile
+
+# timeout (in seconds) for the answer of the server
+ACK_TIMEOUT = 5
+# time (in seconds) to wait for answer of the server during calibration
+CALIBRATION_TIMEOUT = 0.5
+
+def getRss():
+    """
+     Returns current resident memory of the process
+     @return: int KiB (0 if it is unknown)
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages * resource.getpagesize() // 1024
+    except (IOError, IndexError, ValueError):
+        return 0
+
+def receive(sock, size):
+    """
+     Receives exactly size bytes from the socket
+     @param sock: socket
+     @param size: Count of bytes
+     @return: bytes
+    """
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionResetError('Connection is closed by server')
+        data += chunk
+    return data
+
+class Observer(object):
+    """
+     Consumer of packets published by the server (observer stand-in)
+    """
+
+    def __init__(self):
+        """ Constructor """
+        self.count = 0
+        self.lastTime = None
+        self._stopped = False
+        self._thread = Thread(target = self.threadHandler)
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped = True
+        self._thread.join()
+
+    def onPacket(self, body, message):
+        """
+         Executes when packet is consumed
+         @param body: Packet
+         @param message: Message instance
+        """
+        self.count += 1
+        self.lastTime = time.perf_counter()
+        message.ack()
+
+    def threadHandler(self):
+        """
+         Consumes packet queues declared by the broker
+        """
+        from kombu import BrokerConnection, Queue
+        from kernel.config import conf
+        from lib.broker import broker
+        exchange = broker._exchanges['mon.device']
+        consumed = set()
+        with BrokerConnection(conf.amqpConnection) as conn:
+            with conn.Consumer([], callbacks = [self.onPacket]) as consumer:
+                while True:
+                    # queues of devices are declared on the first packet
+                    for name in list(broker._declared):
+                        if name not in consumed:
+                            consumed.add(name)
+                            consumer.add_queue(Queue(name,
+                                exchange = exchange, routing_key = name))
+                            consumer.consume()
+                    try:
+                        conn.drain_events(timeout = 0.05)
+                        continue
+                    except socket.timeout:
+                        pass
+                    if self._stopped:
+                        break
+
+class Client(object):
+    """
+     Simulated devices, which send recorded data to the server
+    """
+
+    def __init__(self, port, chunks, answers):
+        """
+         Constructor
+         @param port: Port of the server
+         @param chunks: list of bytes to send
+         @param answers: list of sizes of server answers to chunks
+        """
+        self.port = port
+        self.chunks = chunks
+        self.answers = answers
+        self.latencies = []
+        self.connections = 0
+        self.errors = 0
+        self._lock = Lock()
+        self._remaining = 0
+
+    def connect(self):
+        sock = socket.create_connection(('127.0.0.1', self.port))
+        sock.settimeout(ACK_TIMEOUT)
+        return sock
+
+    def calibrate(self):
+        """
+         Sends chunks once and remembers sizes of server answers,
+         answer of the server is awaited for chunks with non-zero size
+        """
+        sock = self.connect()
+        answers = []
+        for chunk in self.chunks:
+            sock.sendall(chunk)
+            sock.settimeout(CALIBRATION_TIMEOUT)
+            size = 0
+            try:
+                while True:
+                    data = sock.recv(4096)
+                    if not data:
+                        break
+                    size += len(data)
+            except socket.timeout:
+                pass
+            answers.append(size)
+        sock.close()
+        self.answers = answers
+
+    def session(self):
+        """
+         Sends all chunks via one connection
+        """
+        latencies = []
+        sock = self.connect()
+        try:
+            for chunk, answer in zip(self.chunks, self.answers):
+                start = time.perf_counter()
+                sock.sendall(chunk)
+                if answer:
+                    receive(sock, answer)
+                    latencies.append(time.perf_counter() - start)
+        finally:
+            sock.close()
+        with self._lock:
+            self.latencies.extend(latencies)
+            self.connections += 1
+
+    def worker(self):
+        """
+         Opens connections until all of them are done
+        """
+        while True:
+            with self._lock:
+                if self._remaining <= 0:
+                    return
+                self._remaining -= 1
+            try:
+                self.session()
+            except (OSError, socket.timeout) as E:
+                with self._lock:
+                    self.errors += 1
+
+    def run(self, count, concurrency):
+        """
+         Runs sessions of devices
+         @param count: Count of connections
+         @param concurrency: Count of simultaneous connections
+        """
+        self._remaining = count
+        threads = [Thread(target = self.worker) for i in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+def startServer(handlerClass, mode):
+    """
+     Starts server of the handler on a free port
+     @param handlerClass: Protocol handler class
+     @param mode: "threading" or "asyncio"
+     @return: tuple (server, port, stop function)
+    """
+    from kernel.server import Server, AsyncServer
+    if mode == 'asyncio':
+        server = AsyncServer(0, handlerClass)
+        port = [sock.getsockname()[1] for sock in server.server.sockets
+            if sock.family == socket.AF_INET][0]
+        def stop():
+            server.loop.call_soon_threadsafe(server.loop.stop)
+            server.server_thread.join()
+    else:
+        server = Server(0, handlerClass)
+        port = server.server.server_address[1]
+        def stop():
+            server.server.shutdown()
+            server.server.server_close()
+    server.run()
+    return server, port, stop
+
+def main():
+    """
+     Runs the benchmark
+     @return: Exit code
+    """
+    parser = argparse.ArgumentParser(
+        description = 'End-to-end benchmark of the data ingest')
+    parser.add_argument('handler', nargs = '?', default = 'naviset.gt20',
+        help = 'name of the handler with corpus (default: %(default)s)')
+    parser.add_argument('-n', '--connections', type = int, default = 2000,
+        help = 'count of device connections')
+    parser.add_argument('-j', '--concurrency', type = int, default = 50,
+        help = 'count of simultaneous connections')
+    parser.add_argument('--server', choices = ['threading', 'asyncio'],
+        default = 'threading', help = 'server engine')
+    parser.add_argument('-v', '--verbose', action = 'store_true',
+        help = 'write debug messages to the log')
+    args = parser.parse_args()
+    # kernel.commandline parses arguments on import,
+    # settings of the handler are read from its configuration file
+    sys.argv = sys.argv[:1] + ['-c',
+        os.path.join('conf', 'handlers', args.handler + '.conf')]
+
+    from kernel.logger import log
+    from kernel.config import conf
+    if not args.verbose:
+        log.setLevel(logging.WARNING)
+    conf.amqpConnection = 'memory://'
+    conf.redisHost = 'memory'
+    from importlib import import_module
+    from kernel.supervisor import stats
+    from lib.broker import publisher
+    handlerClass = import_module('lib.handlers.' + args.handler).Handler
+    rssStart = getRss()
+
+    observer = Observer()
+    observer.start()
+    server, port, stopServer = startServer(handlerClass, args.server)
+    client = Client(port, readCorpus(args.handler), [])
+    client.calibrate()
+    if not any(client.answers):
+        print('Server does not answer, ack latency is not measured')
+    time.sleep(CALIBRATION_TIMEOUT)
+    stats.reset()
+    observer.count = 0
+
+    start = time.perf_counter()
+    client.run(args.connections, args.concurrency)
+    elapsed = time.perf_counter() - start
+    # wait until all packets are published and consumed
+    publisher.stop()
+    while True:
+        count = observer.count
+        time.sleep(0.5)
+        if count == observer.count:
+            break
+    observerElapsed = (observer.lastTime or start) - start
+    stopServer()
+    observer.stop()
+
+    counters = stats.get()
+    latencies = sorted(client.latencies)
+    print('handler       %s (%s server)' % (args.handler, args.server))
+    print('connections   %d (errors: %d) in %.2f s' %
+        (client.connections, client.errors, elapsed))
+    print('connections/s %.1f' % (client.connections / elapsed))
+    print('packets/s     %.1f parsed, %.1f consumed by observer' % (
+        counters.get('packets', 0) / elapsed,
+        observer.count / observerElapsed if observerElapsed > 0 else 0))
+    print('packets       %d parsed, %d consumed by observer' %
+        (counters.get('packets', 0), observer.count))
+    print('ack latency   p50 %.2f ms, p99 %.2f ms, max %.2f ms' % (
+        getPercentile(latencies, 50) * 1e3,
+        getPercentile(latencies, 99) * 1e3,
+        (latencies[-1] if latencies else 0) * 1e3))
+    print('RSS           %d KiB (start %d KiB, peak %d KiB)' % (getRss(),
+        rssStart, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+    return 1 if client.errors else 0
+
+if __name__ == '__main__':
+    code = main()
+    # command threads of the message broker are never stopped
+    sys.stdout.flush()
+    os._exit(code)
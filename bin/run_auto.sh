@@ -0,0 +1,2 @@
+echo 'Starting protocol auto-detection listener'
+python3 main.py -c conf/handlers/auto.conf -l conf/logs/auto.conf --pipe_process_mask=$1 -s $3
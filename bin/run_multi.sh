@@ -0,0 +1,2 @@
+echo 'Starting multi-protocol listener'
+python3 main.py -c conf/handlers/multi.conf -l conf/logs/multi.conf --pipe_process_mask=$1 -s $3
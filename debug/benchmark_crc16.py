@@ -0,0 +1,51 @@
+# -*- coding: utf8 -*-
+'''
+@project   Maprox <http://www.maprox.net>
+@info      Benchmark of checksums of lib.crc16 against Crc16 implementations
+@copyright 2013, Maprox LLC
+
+Usage (from the root directory of the project):
+  python3 debug/benchmark_crc16.py [size] [count]
+'''
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import lib.crc16 as crc16
+from lib.crc16 import Crc16
+
+# name => reference implementation
+LEGACY = {
+    crc16.MODBUS: lambda data:
+        Crc16.calcBinaryString(data, crc16.INITIAL_MODBUS),
+    crc16.DF1: lambda data:
+        Crc16.calcBinaryString(data, crc16.INITIAL_DF1),
+    crc16.CCITT: Crc16.calcCCITT,
+    crc16.KERMIT: Crc16.calcCCITT_Kermit
+}
+
+def run(size = 1024, count = 1000):
+    """
+     Checks results bit-for-bit and prints timings
+     @param size: Size of data in bytes
+     @param count: Count of calculations
+    """
+    data = os.urandom(size)
+    print('%-8s %12s %12s %8s' % ('name', 'legacy, us', 'new, us', 'speedup'))
+    for name in sorted(LEGACY):
+        legacy = LEGACY[name]
+        function = crc16.getChecksum(name)
+        for length in range(0, 64):
+            assert function(data[:length]) == legacy(data[:length]), name
+        assert function(data) == legacy(data), name
+        function(data) # tables are built on the first call
+        tLegacy = timeit.timeit(lambda: legacy(data), number = count)
+        tNew = timeit.timeit(lambda: function(data), number = count)
+        print('%-8s %12.2f %12.2f %7.1fx' % (name,
+            tLegacy * 1e6 / count, tNew * 1e6 / count, tLegacy / tNew))
+
+if __name__ == '__main__':
+    run(*[int(arg) for arg in sys.argv[1:3]])
@@ -7,21 +7,26 @@
 
 import time
 import socket
+import bisect
 import hashlib
 import json
 
 from collections import deque
 
-from threading import Thread
+from threading import Thread, RLock
 from kernel.logger import log
 from kernel.config import conf
 from lib.broker import broker
+from lib.timerwheel import TimerWheel
+from kernel.database.balancer import DatabaseBalancer
 from kombu import BrokerConnection, Queue
 
 # --------------------------------------------------------------------
 
 QUEUE_PREFIX = conf.environment + '.mon.device.packet'
 QUEUE_MAX_TIMEOUT = 60 * 5 # 5 minutes
+QUEUE_RETRY_INTERVAL = 5 # seconds before not published packets are resent
+RING_REPLICAS = 100 # points of every receiver on the hash ring
 
 # --------------------------------------------------------------------
 
@@ -44,9 +49,35 @@ class PacketReceiveBalancer:
          Starts balancer
          @return:
         """
-        self._receiveManager = PacketReceiveManager()
+        state = None
+        if conf.balancerPersist:
+            state = DatabaseBalancer()
+        if conf.balancerShards > 1:
+            self._receiveManager = ShardedPacketReceiveManager(
+                conf.balancerShards, state = state)
+        else:
+            self._receiveManager = PacketReceiveManager(state = state)
+        if state:
+            self.restoreState(state)
         self.initControlThreads()
 
+    def restoreState(self, state):
+        """
+         Restores consumed queues and locks of devices saved by the
+         previous run of the balancer. Packets, which were sent to observer
+         before restart, are not sent again until response or lock timeout
+         @param state: DatabaseBalancer instance
+        """
+        try:
+            uids, locks = state.load()
+        except Exception as E:
+            log.error('%s::restoreState(): %s', self.__class__, E)
+            return
+        for uid in uids:
+            self._receiveManager.adoptQueue(uid, locks.get(uid))
+        log.info('Balancer state is restored: %s queues, %s locks',
+            len(uids), len(locks))
+
     def initControlThreads(self):
         """
          Initialize control threads
@@ -167,20 +198,47 @@ class PacketReceiveBalancer:
 
 class PacketReceiveManager:
     """
-     Factory for packet receivers classes
+     Factory for packet receivers classes.
+     Consumes queues of devices on its own connection in its own thread
     """
     _queues = None
     _messages = None
     _queuesListNew = None
+    _queuesListOld = None
 
-    def __init__(self):
+    def __init__(self, name = 'ReceiverThread', window = None,
+            batchSize = None, idleTimeout = None, state = None):
         """
          Class initialization
+         @param name: Name of the receiver thread
+         @param window: Max count of packets of a device sent to observer
+           and waiting for response. Default is conf.balancerWindow
+         @param batchSize: Max count of packets sent in one message.
+           Default is conf.balancerBatchSize
+         @param idleTimeout: Time (in seconds) after which the queue of
+           a device without packets is not consumed any more.
+           Default is conf.balancerIdleTimeout, 0 - never
+         @param state: DatabaseBalancer instance to save state to
         """
+        self.name = name
+        self.window = window or conf.balancerWindow
+        self.batchSize = batchSize or conf.balancerBatchSize
+        self.idleTimeout = conf.balancerIdleTimeout
+        if idleTimeout is not None:
+            self.idleTimeout = idleTimeout
+        self._timers = TimerWheel() # lock and idle timers of devices
+        self._state = state
+        self._running = True
+        self._lock = RLock()
         self._queues = {}
         self._messages = {}
         self._messagesLocks = {}
+        self._deliveries = {} # uid => sizes of deliveries sent to observer
         self._queuesListNew = []
+        self._queuesListOld = []
+        # messages of released queues, which are returned to the broker
+        # by the receiver thread (owner of the channel)
+        self._returned = []
         self.initReceiverThread()
 
     def initReceiverThread(self):
@@ -193,15 +251,52 @@ class PacketReceiveManager:
         self._threadReceive = Thread(target = self.threadReceiveHandler)
         self._threadReceive.start()
 
+    def stop(self):
+        """
+         Stops receiver thread.
+         Messages which are not acknowledged are returned to queues
+         by the message broker when connection is closed
+        """
+        self._running = False
+        self.flushState()
+
+    def flushState(self):
+        """
+         Writes changes of the state to the database
+        """
+        if self._state:
+            self._state.flush()
+
+    def saveState(self, uid):
+        """
+         Saves lock of the device (see flushState())
+         @param uid: Device identifier
+        """
+        if not self._state:
+            return
+        deliveries = self._deliveries.get(uid)
+        if deliveries:
+            self._state.setLock(uid, {
+                'lockTime': self._messagesLocks.get(uid),
+                'deliveries': list(deliveries)
+            })
+        else:
+            self._state.clearLock(uid)
+
     def threadReceiveHandler(self):
-        threadName = 'ReceiverThread'
+        threadName = self.name
         log.debug('%s::started', threadName)
-        while True:
-            queues = []
-            for key in self._queues:
-                queues.append(self._queues[key])
+        while self._running:
+            with self._lock:
+                queues = list(self._queues.values())
+                self._queuesListNew = []
+                self._queuesListOld = []
+                # not acknowledged messages are returned by the broker
+                # when the previous connection is closed
+                self._returned = []
             if not queues:
                 time.sleep(2) # sleep for 2 seconds
+                self.processTimers()
                 continue
             try:
                 with BrokerConnection(conf.amqpConnection) as conn:
@@ -213,13 +308,15 @@ class PacketReceiveManager:
                         with conn.Consumer(queues, callbacks = [
                             self.threadReceiverOnMessage
                         ]) as consumer:
-                            while True:
+                            while self._running:
                                 conn.ensure_connection()
                                 try:
                                     conn.drain_events(timeout = 5) # 5 seconds
                                 except socket.timeout:
                                     pass
+                                self.processTimers()
                                 self.appendNewQueues(consumer)
+                                self.flushState()
                     except Exception as E:
                         log.error('%s::%s', threadName, E)
                     conn.release()
@@ -227,17 +324,31 @@ class PacketReceiveManager:
             except Exception as E:
                 log.error('%s::%s', threadName, E)
                 time.sleep(30) # sleep for 30 seconds after exception
+        log.debug('%s::stopped', threadName)
 
     def appendNewQueues(self, consumer):
         """
-         Check for new queues in the list
+         Check for new queues in the list (and queues to be removed).
+         Messages of removed queues are returned to the broker after
+         their consumers are cancelled, so they are delivered to the
+         new receiver of the device, not to this one again
          @param consumer: Consumer instance
         """
-        if self._queuesListNew:
-            for queue in self._queuesListNew:
+        with self._lock:
+            queuesNew = self._queuesListNew
+            queuesOld = self._queuesListOld
+            returned = self._returned
+            self._queuesListNew = []
+            self._queuesListOld = []
+            self._returned = []
+        for queue in queuesOld:
+            consumer.cancel_by_queue(queue.name)
+        for message in returned:
+            message.requeue()
+        if queuesNew:
+            for queue in queuesNew:
                 consumer.add_queue(queue)
             consumer.consume()
-        self._queuesListNew = []
 
     def threadReceiverOnMessage(self, body, message):
         """
@@ -245,19 +356,36 @@ class PacketReceiveManager:
          @param body: amqp message body
          @param message: message instance
         """
-        threadName = 'ReceiverThread'
+        threadName = self.name
         uid = 'unknown uid [!]'
         if 'uid' in body:
             uid = body['uid']
-        if uid not in self._messages:
-            self._messages[uid] = deque()
-        # store message to the queue
-        self._messages[uid].append({
-            "message": message,
-            "body": body
-        })
-        log.debug('%s::Packet %s added %s', threadName, body['time'], uid)
-        self.sendMessage(uid, body)
+        with self._lock:
+            if uid not in self._queues:
+                # queue is moved to another receiver, packet is returned
+                # when consumer of the queue is cancelled
+                log.debug('%s::Packet of %s is returned', threadName, uid)
+                self._returned.append(message)
+                return
+            if uid not in self._messages:
+                self._messages[uid] = deque()
+            # store message to the queue
+            self._messages[uid].append({
+                "message": message,
+                "body": body
+            })
+            log.debug('%s::Packet %s added %s',
+                threadName, body['time'], uid)
+            self.touch(uid)
+            self.sendMessages(uid)
+
+    def getUids(self):
+        """
+         Returns identifiers of devices, which queues are consumed
+         @return: list
+        """
+        with self._lock:
+            return list(self._queues.keys())
 
     def checkListeningForQueue(self, uid):
         """
@@ -266,64 +394,375 @@ class PacketReceiveManager:
          @param uid: Device identifier
          @return:
         """
-        if uid in self._queues: return
-        routingKey = QUEUE_PREFIX + '.create.' + uid
-        log.debug('--- ADDING QUEUE ---: %s', routingKey)
-        self._queues[uid] = Queue(
-            routingKey,
-            exchange = broker._exchanges['mon.device'],
-            routing_key = routingKey
-        )
-        self._queuesListNew.append(self._queues[uid])
+        with self._lock:
+            self.touch(uid)
+            if uid in self._queues: return
+            routingKey = QUEUE_PREFIX + '.create.' + uid
+            log.debug('--- ADDING QUEUE ---: %s', routingKey)
+            self._queues[uid] = Queue(
+                routingKey,
+                exchange = broker._exchanges['mon.device'],
+                routing_key = routingKey
+            )
+            self._queuesListNew.append(self._queues[uid])
+            if self._state:
+                self._state.addUid(uid)
+
+    def releaseQueue(self, uid):
+        """
+         Stops consuming of the device queue (when the queue is moved
+         to another receiver). Messages, which are not processed yet,
+         are returned to the queue in the same order by the receiver
+         thread (see appendNewQueues())
+         @param uid: Device identifier
+         @return: dict State of the device (see adoptQueue()) or None
+        """
+        with self._lock:
+            if not self.removeQueue(uid):
+                return None
+            for item in self._messages.pop(uid, []):
+                self._returned.append(item['message'])
+            return {
+                'lockTime': self._messagesLocks.pop(uid, None),
+                'deliveries': list(self._deliveries.pop(uid, []))
+            }
 
-    def sendMessage(self, uid, body = None, ignoreFlag = False):
+    def removeQueue(self, uid):
         """
-         Send message to the broker
+         Stops consuming of the device queue and cancels its timers
          @param uid: Device identifier
-         @param body: New packet body
-         @param ignoreFlag: Send message even if the checkFile is in progress
+         @return: True if the queue was consumed
         """
-        threadName = 'ReceiverThread'
-        if not body:
-            self._messagesLocks.pop(uid, None)
-            log.debug('%s::%s lock file cleared', threadName, uid)
+        queue = self._queues.pop(uid, None)
+        if queue is None:
+            return False
+        log.debug('--- REMOVING QUEUE ---: %s', queue.name)
+        if queue in self._queuesListNew:
+            self._queuesListNew.remove(queue)
+        else:
+            self._queuesListOld.append(queue)
+        self._timers.cancel(('lock', uid))
+        self._timers.cancel(('retry', uid))
+        self._timers.cancel(('idle', uid))
+        if self._state:
+            self._state.removeUid(uid)
+        return True
+
+    def adoptQueue(self, uid, state = None):
+        """
+         Starts consuming of the device queue moved from another receiver
+         @param uid: Device identifier
+         @param state: dict State of the device returned by releaseQueue().
+           Packets sent to observer are not sent again until response
+        """
+        with self._lock:
+            self.checkListeningForQueue(uid)
+            if state and state['deliveries']:
+                self._messagesLocks[uid] = state['lockTime']
+                self._deliveries[uid] = deque(state['deliveries'])
+                self._timers.schedule(('lock', uid),
+                    state['lockTime'] + QUEUE_MAX_TIMEOUT - time.time())
+                self.saveState(uid)
+
+    def touch(self, uid):
+        """
+         Restarts idle timer of the device
+         @param uid: Device identifier
+        """
+        if self.idleTimeout:
+            self._timers.schedule(('idle', uid), self.idleTimeout)
+
+    def processTimers(self, now = None):
+        """
+         Processes expired timers: resends packets of devices, which are
+         locked too long or were not published, and stops consuming
+         of idle queues
+         @param now: Current time (default is time.time())
+        """
+        with self._lock:
+            expired = self._timers.advance(now)
+            for kind, uid in expired:
+                if kind in ('lock', 'retry'):
+                    self.sendMessages(uid, now)
+                elif kind == 'idle':
+                    self.reapQueue(uid)
+        if expired:
+            # released queues must not be adopted again after restart
+            self.flushState()
+
+    def reapQueue(self, uid):
+        """
+         Stops consuming of the queue of the idle device
+         @param uid: Device identifier
+        """
+        if self._messages.get(uid) or self._deliveries.get(uid):
+            # there are packets waiting for response
+            self.touch(uid)
             return
+        log.debug('%s::%s is idle', self.name, uid)
+        self.removeQueue(uid)
+        self._messages.pop(uid, None)
+        self._deliveries.pop(uid, None)
+        self._messagesLocks.pop(uid, None)
 
-        currentTime = time.time()
-        isLocked = uid in self._messagesLocks and not ignoreFlag
-        if isLocked:
-            lockTime = self._messagesLocks[uid]
-            isLocked = currentTime - lockTime < QUEUE_MAX_TIMEOUT
-            if not isLocked:
+    def publish(self, uid, deliveries):
+        """
+         Sends packets to observer.
+         Every delivery is a separate message, delivery of several
+         packets is sent as {"uid": uid, "packets": [...]}
+         @param uid: Device identifier
+         @param deliveries: list of lists of packet bodies
+         @return: count of last deliveries, which are not sent
+        """
+        batch = []
+        for bodies in deliveries:
+            if len(bodies) > 1:
+                batch.append([{'uid': uid, 'packets': bodies}])
+            else:
+                batch.append(bodies)
+        # every delivery is one message, so it is sent entirely or not
+        return len(broker.sendBatch(batch, 'mon.device.packet.receive'))
+
+    def sendMessages(self, uid, now = None):
+        """
+         Sends packets of the device to observer, while count of packets
+         waiting for response is less than the window.
+         Packets are sent in order of their arrival
+         @param uid: Device identifier
+         @param now: Current time (default is time.time())
+        """
+        threadName = self.name
+        messages = self._messages.get(uid) or ()
+        if uid not in self._deliveries:
+            self._deliveries[uid] = deque()
+        deliveries = self._deliveries[uid]
+        inFlight = sum(deliveries)
+        currentTime = time.time() if now is None else now
+        if inFlight:
+            lockTime = self._messagesLocks.get(uid, currentTime)
+            if currentTime - lockTime >= QUEUE_MAX_TIMEOUT:
                 log.debug('%s::%s is unlocked by timeout!', threadName, uid)
-                body = self._messages[uid][0]['body']
-        if not isLocked:
+                deliveries.clear()
+                inFlight = 0
+        send = []
+        while inFlight < min(self.window, len(messages)):
+            count = min(self.batchSize, self.window - inFlight,
+                len(messages) - inFlight)
+            send.append([messages[inFlight + i]['body']
+                for i in range(count)])
+            deliveries.append(count)
+            inFlight += count
+        if send:
             self._messagesLocks[uid] = currentTime
-            broker.send([body], 'mon.device.packet.receive')
-            log.debug('%s::%s packet has been sent', threadName, uid)
+            self._timers.schedule(('lock', uid), QUEUE_MAX_TIMEOUT,
+                currentTime)
+            unsent = self.publish(uid, send)
+            if unsent:
+                # not sent deliveries do not hold the window,
+                # their packets are sent again by the retry timer
+                for i in range(unsent):
+                    deliveries.pop()
+                send = send[:-unsent]
+                self._timers.schedule(('retry', uid),
+                    QUEUE_RETRY_INTERVAL, currentTime)
+                log.debug('%s::%s %s delivery(ies) are not sent',
+                    threadName, uid, unsent)
+            log.debug('%s::%s %s packet(s) has been sent',
+                threadName, uid, sum(len(bodies) for bodies in send))
+        elif not deliveries:
+            self._timers.cancel(('lock', uid))
+            if self._messagesLocks.pop(uid, None):
+                log.debug('%s::%s lock file cleared', threadName, uid)
         else:
             log.debug('%s::%s is locked!', threadName, uid)
+        self.saveState(uid)
 
     def messageReceived(self, uid):
         """
-         Mark first message from queue as received and send next
+         Mark first sent delivery of the device as received and send next
          @param uid: Device identifier
         """
-        if uid not in self._messages:
-            self._messages[uid] = deque()
-        first = None
-        if self._messages[uid]:
-           first = self._messages[uid].popleft()
-        nextBody = None
-        if self._messages[uid]:
-            next = self._messages[uid][0]
-            nextBody = next['body']
-            log.debug('Got next message for %s: %s', uid, nextBody['time'])
-        else:
-            log.debug('Empty queue for %s', uid)
-        self.sendMessage(uid, nextBody, True)
-        if first:
-            first['message'].ack()
+        with self._lock:
+            self.touch(uid)
+            messages = self._messages.get(uid) or deque()
+            deliveries = self._deliveries.get(uid)
+            received = []
+            if deliveries:
+                for i in range(min(deliveries.popleft(), len(messages))):
+                    received.append(messages.popleft())
+            if messages:
+                log.debug('Got next message for %s: %s',
+                    uid, messages[0]['body']['time'])
+            else:
+                log.debug('Empty queue for %s', uid)
+            self.sendMessages(uid)
+            for item in received:
+                item['message'].ack()
+
+# --------------------------------------------------------------------
+
+class HashRing:
+    """
+     Consistent hash ring.
+     Every node has several points on the ring, a key belongs to the
+     node of the nearest point, so adding or removing of a node moves
+     only keys of this node
+    """
+
+    def __init__(self, nodes = None, replicas = RING_REPLICAS):
+        """
+         Constructor
+         @param nodes: list of node names
+         @param replicas: Count of points of every node on the ring
+        """
+        self.replicas = replicas
+        self._points = []
+        self._nodes = {}
+        for node in nodes or []:
+            self.add(node)
+
+    @classmethod
+    def hash(cls, key):
+        """
+         Returns position of the key on the ring
+         @param key: str
+         @return: int
+        """
+        return int(hashlib.md5(key.encode()).hexdigest()[:8], 16)
+
+    def add(self, node):
+        """
+         Adds node to the ring
+         @param node: Node name
+        """
+        for i in range(self.replicas):
+            point = self.hash('%s:%s' % (node, i))
+            bisect.insort(self._points, point)
+            self._nodes[point] = node
+
+    def remove(self, node):
+        """
+         Removes node from the ring
+         @param node: Node name
+        """
+        for i in range(self.replicas):
+            point = self.hash('%s:%s' % (node, i))
+            if self._nodes.get(point) == node:
+                del self._nodes[point]
+                self._points.remove(point)
+
+    def get(self, key):
+        """
+         Returns node of the key
+         @param key: str
+         @return: Node name or None if ring is empty
+        """
+        if not self._points:
+            return None
+        index = bisect.bisect(self._points, self.hash(key))
+        return self._nodes[self._points[index % len(self._points)]]
+
+# --------------------------------------------------------------------
+
+class ShardedPacketReceiveManager:
+    """
+     Packet receive manager which distributes devices between several
+     receivers (each one has its own connection, thread and lock table).
+     Device belongs to the receiver by consistent hash of its uid.
+     When receivers are added or removed, queues of the moved devices
+     are released by the old receiver and adopted by the new one
+    """
+    managerClass = PacketReceiveManager
+
+    def __init__(self, count, state = None):
+        """
+         Class initialization
+         @param count: Count of receivers
+         @param state: DatabaseBalancer instance to save state to
+        """
+        self._state = state
+        self._lock = RLock()
+        self._ring = HashRing()
+        self._shards = {}
+        self._shardIndex = 0
+        for i in range(count):
+            self.addShard()
+
+    def getShard(self, uid):
+        """
+         Returns receiver of the device
+         @param uid: Device identifier
+         @return: PacketReceiveManager instance
+        """
+        with self._lock:
+            return self._shards[self._ring.get(uid)]
+
+    def checkListeningForQueue(self, uid):
+        """
+         See PacketReceiveManager.checkListeningForQueue()
+        """
+        with self._lock:
+            self.getShard(uid).checkListeningForQueue(uid)
+
+    def messageReceived(self, uid):
+        """
+         See PacketReceiveManager.messageReceived()
+        """
+        with self._lock:
+            self.getShard(uid).messageReceived(uid)
+
+    def adoptQueue(self, uid, state = None):
+        """
+         See PacketReceiveManager.adoptQueue()
+        """
+        with self._lock:
+            self.getShard(uid).adoptQueue(uid, state)
+
+    def addShard(self):
+        """
+         Starts new receiver and moves part of devices to it
+         @return: Name of the receiver
+        """
+        with self._lock:
+            name = 'ReceiverThread-%s' % self._shardIndex
+            self._shardIndex += 1
+            self._shards[name] = self.managerClass(name, state = self._state)
+            self._ring.add(name)
+            self.rebalance()
+            log.info('Receiver %s is added, receivers: %s',
+                name, len(self._shards))
+            return name
+
+    def removeShard(self, name):
+        """
+         Stops receiver and moves its devices to other receivers
+         @param name: Name of the receiver
+        """
+        with self._lock:
+            if name not in self._shards or len(self._shards) < 2:
+                return
+            self._ring.remove(name)
+            shard = self._shards.pop(name)
+            self.rebalance([shard])
+            shard.stop()
+            log.info('Receiver %s is removed, receivers: %s',
+                name, len(self._shards))
+
+    def rebalance(self, removed = None):
+        """
+         Moves devices to their receivers according to the hash ring
+         @param removed: list of removed receivers
+        """
+        with self._lock:
+            shards = list(self._shards.values()) + (removed or [])
+            for shard in shards:
+                for uid in shard.getUids():
+                    owner = self._shards[self._ring.get(uid)]
+                    if owner is shard:
+                        continue
+                    log.debug('Queue of %s is moved from %s to %s',
+                        uid, shard.name, owner.name)
+                    owner.adoptQueue(uid, shard.releaseQueue(uid))
 
 # --------------------------------------------------------------------
 
@@ -350,4 +789,295 @@ class PacketReceiver:
         """
          Refresh connection
         """
-        log.debug('%s[%s]::Refresh', 'PacketReceiver', self._uid)
\ No newline at end of file
+        log.debug('%s[%s]::Refresh', 'PacketReceiver', self._uid)
+
+# ===========================================================================
+# TESTS
+# ===========================================================================
+
+import unittest
+
+class TestMessage(object):
+    """ AMQP message stub """
+    def __init__(self):
+        self.state = None
+    def ack(self):
+        self.state = 'ack'
+    def requeue(self):
+        self.state = 'requeue'
+
+class TestConsumer(object):
+    """ Consumer stub """
+    def __init__(self):
+        self.cancelled = []
+    def cancel_by_queue(self, name):
+        self.cancelled.append(name)
+    def add_queue(self, queue):
+        pass
+    def consume(self):
+        pass
+
+class TestReceiveManager(PacketReceiveManager):
+    """ Receive manager without receiver thread """
+    def initReceiverThread(self):
+        self.sent = []
+    def publish(self, uid, deliveries):
+        for bodies in deliveries:
+            if len(bodies) > 1:
+                self.sent.append({'uid': uid, 'packets': bodies})
+            else:
+                self.sent.append(bodies[0])
+        return 0
+
+class TestShardedReceiveManager(ShardedPacketReceiveManager):
+    managerClass = TestReceiveManager
+
+class TestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.uids = ['%015d' % (350000000000000 + i) for i in range(200)]
+
+    def receive(self, manager, uid, time):
+        message = TestMessage()
+        manager.threadReceiverOnMessage({'uid': uid, 'time': time}, message)
+        return message
+
+    def test_hashRing(self):
+        ring = HashRing(['a', 'b', 'c'])
+        owners = dict((uid, ring.get(uid)) for uid in self.uids)
+        self.assertEqual(set(owners.values()), {'a', 'b', 'c'})
+        ring.add('d')
+        moved = [uid for uid in self.uids if ring.get(uid) != owners[uid]]
+        # only keys of the new node are moved
+        self.assertTrue(0 < len(moved) < len(self.uids) / 2)
+        self.assertTrue(all(ring.get(uid) == 'd' for uid in moved))
+        ring.remove('d')
+        self.assertEqual(owners,
+            dict((uid, ring.get(uid)) for uid in self.uids))
+
+    def test_sendMessage(self):
+        manager = TestReceiveManager()
+        manager.checkListeningForQueue('1')
+        first = self.receive(manager, '1', 't1')
+        second = self.receive(manager, '1', 't2')
+        # next packet is not sent until the response
+        self.assertEqual(manager.sent, [{'uid': '1', 'time': 't1'}])
+        manager.messageReceived('1')
+        self.assertEqual(first.state, 'ack')
+        self.assertEqual(manager.sent[-1]['time'], 't2')
+        manager.messageReceived('1')
+        self.assertEqual(second.state, 'ack')
+        self.assertNotIn('1', manager._messagesLocks)
+
+    def test_window(self):
+        manager = TestReceiveManager('test', window = 3)
+        manager.checkListeningForQueue('1')
+        messages = [self.receive(manager, '1', 't%s' % i) for i in range(5)]
+        self.assertEqual([b['time'] for b in manager.sent], ['t0', 't1', 't2'])
+        manager.messageReceived('1')
+        self.assertEqual([m.state for m in messages],
+            ['ack', None, None, None, None])
+        self.assertEqual(manager.sent[-1]['time'], 't3')
+        for i in range(4):
+            manager.messageReceived('1')
+        self.assertEqual([b['time'] for b in manager.sent],
+            ['t0', 't1', 't2', 't3', 't4'])
+        self.assertTrue(all(m.state == 'ack' for m in messages))
+        self.assertNotIn('1', manager._messagesLocks)
+
+    def test_batch(self):
+        manager = TestReceiveManager('test', window = 4, batchSize = 3)
+        manager.checkListeningForQueue('1')
+        manager.window = 0 # collect packets before sending
+        messages = [self.receive(manager, '1', 't%s' % i) for i in range(6)]
+        manager.window = 4
+        manager.messageReceived('1')
+        self.assertEqual(manager.sent, [
+            {'uid': '1', 'packets': [
+                {'uid': '1', 'time': 't0'},
+                {'uid': '1', 'time': 't1'},
+                {'uid': '1', 'time': 't2'}
+            ]},
+            {'uid': '1', 'time': 't3'}
+        ])
+        # response to the batch acknowledges all its packets
+        manager.messageReceived('1')
+        self.assertEqual([m.state for m in messages],
+            ['ack', 'ack', 'ack', None, None, None])
+        self.assertEqual(manager.sent[-1]['packets'][-1]['time'], 't5')
+
+    def test_lockTimeout(self):
+        manager = TestReceiveManager()
+        manager.checkListeningForQueue('1')
+        self.receive(manager, '1', 't1')
+        self.receive(manager, '1', 't2')
+        self.assertEqual(len(manager.sent), 1)
+        manager._messagesLocks['1'] -= QUEUE_MAX_TIMEOUT
+        self.receive(manager, '1', 't3')
+        self.assertEqual([b['time'] for b in manager.sent], ['t1', 't1'])
+
+    def test_publishFailed(self):
+        manager = TestReceiveManager('test', window = 3, idleTimeout = 0)
+        manager.checkListeningForQueue('1')
+        publish = manager.publish
+        manager.publish = lambda uid, deliveries: \
+            publish(uid, deliveries[:1]) + len(deliveries[1:])
+        manager.window = 0 # collect packets before sending
+        for i in range(3):
+            self.receive(manager, '1', 't%s' % i)
+        manager.window = 3
+        now = time.time()
+        manager.sendMessages('1', now)
+        # not sent packets do not hold the window
+        self.assertEqual(list(manager._deliveries['1']), [1])
+        manager.publish = publish
+        manager.processTimers(now + QUEUE_RETRY_INTERVAL + 2)
+        self.assertEqual([b['time'] for b in manager.sent],
+            ['t0', 't1', 't2'])
+        self.assertEqual(list(manager._deliveries['1']), [1, 1, 1])
+
+    def test_lockTimer(self):
+        manager = TestReceiveManager('test', idleTimeout = 0)
+        manager.checkListeningForQueue('1')
+        self.receive(manager, '1', 't1')
+        now = time.time()
+        manager.processTimers(now + QUEUE_MAX_TIMEOUT - 2)
+        self.assertEqual(len(manager.sent), 1)
+        # locked packet is sent again without new packets of the device
+        manager.processTimers(now + QUEUE_MAX_TIMEOUT + 2)
+        self.assertEqual([b['time'] for b in manager.sent], ['t1', 't1'])
+        manager.messageReceived('1')
+        self.assertNotIn(('lock', '1'), manager._timers)
+        self.assertEqual(len(manager._timers), 0)
+
+    def test_idleQueues(self):
+        manager = TestReceiveManager('test', idleTimeout = 10)
+        for uid in ['1', '2']:
+            manager.checkListeningForQueue(uid)
+        message = self.receive(manager, '2', 't1')
+        now = time.time()
+        manager.processTimers(now + 5)
+        self.assertEqual(sorted(manager.getUids()), ['1', '2'])
+        manager.processTimers(now + 12)
+        # device with packets waiting for response is not idle
+        self.assertEqual(manager.getUids(), ['2'])
+        self.assertEqual([q.name for q in manager._queuesListNew],
+            [QUEUE_PREFIX + '.create.2'])
+        manager.messageReceived('2')
+        self.assertEqual(message.state, 'ack')
+        manager.processTimers(now + 30)
+        self.assertEqual(manager.getUids(), [])
+        self.assertEqual(manager._messages, {})
+        self.assertEqual(len(manager._timers), 0)
+        manager.checkListeningForQueue('1')
+        self.assertEqual(manager.getUids(), ['1'])
+
+    def test_idleQueuesState(self):
+        from kernel.database.memory import MemoryRedis
+        state = DatabaseBalancer()
+        state._store = MemoryRedis()
+        manager = TestReceiveManager('test', idleTimeout = 10, state = state)
+        for uid in ['1', '2']:
+            manager.checkListeningForQueue(uid)
+        state.flush()
+        self.assertEqual(state.load()[0], ['1', '2'])
+        self.receive(manager, '2', 't1')
+        manager.processTimers(time.time() + 12)
+        # released queue is removed from the saved state at once
+        self.assertEqual(state.load()[0], ['2'])
+
+    def test_releasedQueue(self):
+        manager = TestReceiveManager()
+        manager.checkListeningForQueue('1')
+        manager.appendNewQueues(TestConsumer())
+        first = self.receive(manager, '1', 't1')
+        manager.releaseQueue('1')
+        # packet delivered before the consumer is cancelled
+        second = self.receive(manager, '1', 't2')
+        self.assertEqual((first.state, second.state), (None, None))
+        consumer = TestConsumer()
+        manager.appendNewQueues(consumer)
+        self.assertEqual(consumer.cancelled, [QUEUE_PREFIX + '.create.1'])
+        self.assertEqual((first.state, second.state),
+            ('requeue', 'requeue'))
+        self.assertEqual(manager._returned, [])
+
+    def test_restoreState(self):
+        from kernel.database.memory import MemoryRedis
+        store = MemoryRedis()
+        pipelines = []
+        pipeline = store.pipeline
+        def countPipelines(transaction = True):
+            pipelines.append(transaction)
+            return pipeline(transaction)
+        store.pipeline = countPipelines
+        state = DatabaseBalancer()
+        state._store = store
+        manager = TestShardedReceiveManager(2, state = state)
+        for uid in ['1', '2']:
+            manager.checkListeningForQueue(uid)
+        shard = manager.getShard('1')
+        self.receive(shard, '1', 't1')
+        self.receive(shard, '1', 't2')
+        state.flush()
+        self.assertEqual(len(pipelines), 1)
+        # restart of the balancer
+        state = DatabaseBalancer()
+        state._store = store
+        balancer = PacketReceiveBalancer()
+        balancer._receiveManager = TestReceiveManager(state = state)
+        balancer.restoreState(state)
+        manager = balancer._receiveManager
+        self.assertEqual(sorted(manager.getUids()), ['1', '2'])
+        # redelivered packet is not sent again until response
+        self.receive(manager, '1', 't1')
+        self.receive(manager, '1', 't2')
+        self.assertEqual(manager.sent, [])
+        manager.messageReceived('1')
+        self.assertEqual([b['time'] for b in manager.sent], ['t2'])
+
+    def test_sharding(self):
+        manager = TestShardedReceiveManager(3)
+        for uid in self.uids:
+            manager.checkListeningForQueue(uid)
+        shards = list(manager._shards.values())
+        self.assertEqual(sum(len(s.getUids()) for s in shards),
+            len(self.uids))
+        self.assertTrue(all(s.getUids() for s in shards))
+        for uid in self.uids:
+            self.assertIn(uid, manager.getShard(uid).getUids())
+
+    def test_rebalance(self):
+        manager = TestShardedReceiveManager(2)
+        uids = self.uids[:50]
+        messages = {}
+        for uid in uids:
+            manager.checkListeningForQueue(uid)
+            shard = manager.getShard(uid)
+            messages[uid] = (shard,
+                self.receive(shard, uid, 't1'), self.receive(shard, uid, 't2'))
+        name = manager.addShard()
+        moved = [uid for uid in uids if manager.getShard(uid).name == name]
+        self.assertTrue(moved)
+        # packets are returned by receiver threads of the old shards
+        self.assertTrue(all(first.state is None and second.state is None
+            for old, first, second in messages.values()))
+        for old, first, second in messages.values():
+            old.appendNewQueues(TestConsumer())
+        for uid in moved:
+            old, first, second = messages[uid]
+            self.assertNotIn(uid, old.getUids())
+            self.assertEqual((first.state, second.state),
+                ('requeue', 'requeue'))
+            # redelivered packets are not sent again until the response
+            new = manager.getShard(uid)
+            self.receive(new, uid, 't1')
+            self.receive(new, uid, 't2')
+            sent = lambda: [b['time'] for b in new.sent if b['uid'] == uid]
+            self.assertEqual(sent(), [])
+            manager.messageReceived(uid)
+            self.assertEqual(sent(), ['t2'])
+        manager.removeShard(name)
+        self.assertNotIn(name, manager._shards)
+        for uid in uids:
+            self.assertIn(uid, manager.getShard(uid).getUids())
@@ -25,6 +25,29 @@ try:
     conf.redisPort = int(conf.get("redis", "port"))
     conf.redisPassword = conf.get("redis", "password")
     conf.amqpConnection = conf.get("amqp", "connection")
+    conf.publishAsync = conf.getboolean("amqp", "publishAsync",
+        fallback = False)
+    conf.publishBatchSize = conf.getint("amqp", "publishBatchSize",
+        fallback = 100)
+    conf.publishFlushInterval = conf.getint("amqp", "publishFlushInterval",
+        fallback = 50)
+    conf.publishQueueSize = conf.getint("amqp", "publishQueueSize",
+        fallback = 10000)
+    conf.publishOverflow = conf.get("amqp", "publishOverflow",
+        fallback = "block")
+    # count of receiver shards of the packet balancer
+    conf.balancerShards = conf.getint("balancer", "shards", fallback = 1)
+    # count of packets of a device sent to observer without response
+    conf.balancerWindow = conf.getint("balancer", "window", fallback = 1)
+    # count of packets of a device sent to observer in one message
+    conf.balancerBatchSize = conf.getint("balancer", "batchSize",
+        fallback = 1)
+    # time (in seconds) after which queue of idle device is not consumed
+    conf.balancerIdleTimeout = conf.getint("balancer", "idleTimeout",
+        fallback = 3600)
+    # save state of the balancer to redis to restore it after restart
+    conf.balancerPersist = conf.getboolean("balancer", "persist",
+        fallback = False)
     conf.hostName = conf.get("pipe", "hostname")
     conf.hostIp = conf.get("pipe", "hostip")
     if not conf.hostIp:
@@ -47,10 +70,38 @@ try:
     if options.port and (options.port != '0'):
         conf.port = int(options.port)
     else:
-        conf.port = conf.getint("general", "port")
+        conf.port = conf.getint("general", "port", fallback = 0)
     conf.socketPacketLength = conf.getint("general", "socketPacketLength")
+    conf.maxFrameSize = conf.getint("general", "maxFrameSize",
+        fallback = 1048576)
     conf.pathStorage = conf.get("general", "pathStorage")
     conf.pathTrash = conf.get("general", "pathTrash")
+    # max size of spool segment of the storage in bytes
+    conf.spoolSegmentSize = conf.getint("general", "spoolSegmentSize",
+        fallback = 16777216)
+    # max time (ms) stored data waits for fsync (0 - sync every save)
+    conf.spoolSyncInterval = conf.getint("general", "spoolSyncInterval",
+        fallback = 1000)
+    # compression of spool segments: "none", "zlib" or "lzma"
+    conf.spoolCompression = conf.get("general", "spoolCompression",
+        fallback = "none")
+    # size of data in compressed block of spool segment in bytes
+    conf.spoolBlockSize = conf.getint("general", "spoolBlockSize",
+        fallback = 65536)
+    # server engine: "threading" (thread per connection) or "asyncio"
+    conf.serverMode = conf.get("general", "server", fallback = "threading")
+    if conf.serverMode == 'asyncio' and conf.publishOverflow == 'block':
+        # event loop can not wait for a free space in the publish queue
+        log.warning('publishOverflow=block is not supported by asyncio '
+            'server, spill is used instead')
+        conf.publishOverflow = 'spill'
+    if conf.serverMode == 'asyncio' and not conf.publishAsync:
+        # event loop can not wait for the message broker
+        log.warning('publishAsync is required by asyncio server, '
+            'packets are published asynchronously')
+        conf.publishAsync = True
+    # count of worker processes, which listen the same port (SO_REUSEPORT)
+    conf.workers = conf.getint("general", "workers", fallback = 1)
 
 except Exception as E:
     log.critical("Error reading " + options.handlerconf + ": %s", E)
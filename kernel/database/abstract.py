@@ -7,6 +7,7 @@
 
 import json
 import redis
+from threading import Lock
 from urllib.request import urlopen
 from kernel.config import conf
 from kernel.logger import log
@@ -18,15 +19,39 @@ class DatabaseAbstract(object):
     _requestParam = None
     """ Store connection """
     _store = None
+    """ Connection pool shared by all database objects of the process """
+    _pool = None
+    _poolLock = Lock()
 
     def __init__(self):
-        """ Constructor. Inits redis connection """
-        if conf.redisPassword:
-            self._store = redis.StrictRedis(password=conf.redisPassword,
-                host=conf.redisHost, port=conf.redisPort, db=0)
-        else:
-            self._store = redis.StrictRedis(host=conf.redisHost,
-                port=conf.redisPort, db=0)
+        """
+         Constructor. Inits redis connection.
+         If redis host is "memory", data is kept in memory of the process
+        """
+        if conf.redisHost == 'memory':
+            from kernel.database.memory import store
+            self._store = store
+            return
+        self._store = redis.StrictRedis(
+            connection_pool=DatabaseAbstract.getConnectionPool())
+
+    @classmethod
+    def getConnectionPool(cls):
+        """
+         Returns redis connection pool of the process.
+         The pool is created on the first call
+         @return: redis.ConnectionPool
+        """
+        with DatabaseAbstract._poolLock:
+            if DatabaseAbstract._pool is None:
+                if conf.redisPassword:
+                    DatabaseAbstract._pool = redis.ConnectionPool(
+                        password=conf.redisPassword,
+                        host=conf.redisHost, port=conf.redisPort, db=0)
+                else:
+                    DatabaseAbstract._pool = redis.ConnectionPool(
+                        host=conf.redisHost, port=conf.redisPort, db=0)
+            return DatabaseAbstract._pool
 
     def getLogName(self):
         """ Returns name to write in logs """
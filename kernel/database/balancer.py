@@ -0,0 +1,170 @@
+# -*- coding: utf8 -*-
+'''
+@project   Maprox <http://www.maprox.net>
+@info      Database storage of the packet balancer state
+@copyright 2013, Maprox LLC
+'''
+
+import json
+from threading import Lock
+from kernel.config import conf
+from kernel.logger import log
+from kernel.database.abstract import DatabaseAbstract
+
+class DatabaseBalancer(DatabaseAbstract):
+    """
+     Storage of the balancer state: set of devices, which queues are
+     consumed, and locks of devices (packets sent to observer and waiting
+     for response). Changes are collected in memory and written by
+     flush() in one pipeline, the last change of a key wins
+    """
+
+    def __init__(self):
+        """ Constructor """
+        DatabaseAbstract.__init__(self)
+        self._uidsKey = 'zc:k:balancer_uids:' + conf.environment
+        self._locksKey = 'zc:k:balancer_locks:' + conf.environment
+        self._lock = Lock()
+        self._uids = {}   # uid => True (added) / False (removed)
+        self._locks = {}  # uid => lock state / None (removed)
+
+    def getLogName(self):
+        """ Returns name to write in logs """
+        return 'Balancer'
+
+    def addUid(self, uid):
+        """
+         Marks queue of the device as consumed
+         @param uid: Device identifier
+        """
+        with self._lock:
+            self._uids[uid] = True
+
+    def removeUid(self, uid):
+        """
+         Marks queue of the device as not consumed
+         @param uid: Device identifier
+        """
+        with self._lock:
+            self._uids[uid] = False
+            self._locks[uid] = None
+
+    def setLock(self, uid, state):
+        """
+         Saves lock of the device
+         @param uid: Device identifier
+         @param state: dict Lock state (lockTime, deliveries)
+        """
+        with self._lock:
+            self._locks[uid] = state
+
+    def clearLock(self, uid):
+        """
+         Removes lock of the device
+         @param uid: Device identifier
+        """
+        with self._lock:
+            self._locks[uid] = None
+
+    def flush(self):
+        """
+         Writes collected changes to the database in one pipeline.
+         If database is not available, changes are kept for the next call
+         @return: Count of written changes
+        """
+        with self._lock:
+            uids, self._uids = self._uids, {}
+            locks, self._locks = self._locks, {}
+        if not uids and not locks:
+            return 0
+        try:
+            pipe = self._store.pipeline(transaction = False)
+            added = [uid for uid, value in uids.items() if value]
+            removed = [uid for uid, value in uids.items() if not value]
+            if added:
+                pipe.sadd(self._uidsKey, *added)
+            if removed:
+                pipe.srem(self._uidsKey, *removed)
+            cleared = [uid for uid, state in locks.items() if state is None]
+            if cleared:
+                pipe.hdel(self._locksKey, *cleared)
+            for uid, state in locks.items():
+                if state is not None:
+                    pipe.hset(self._locksKey, uid, json.dumps(state))
+            pipe.execute()
+        except Exception as E:
+            log.error('%s::flush(): %s', self.getLogName(), E)
+            with self._lock:
+                uids.update(self._uids)
+                locks.update(self._locks)
+                self._uids, self._locks = uids, locks
+            return 0
+        return len(uids) + len(locks)
+
+    def load(self):
+        """
+         Reads saved state of the balancer
+         @return: tuple (list of uids, dict of lock states by uid)
+        """
+        pipe = self._store.pipeline(transaction = False)
+        pipe.smembers(self._uidsKey)
+        pipe.hgetall(self._locksKey)
+        uids, locks = pipe.execute()
+        result = {}
+        for uid, value in locks.items():
+            try:
+                result[uid.decode()] = json.loads(value.decode())
+            except ValueError as E:
+                log.error('%s::load(): incorrect lock of %s',
+                    self.getLogName(), uid)
+        return sorted(uid.decode() for uid in uids), result
+
+# ===========================================================================
+# TESTS
+# ===========================================================================
+
+import unittest
+from kernel.database.memory import MemoryRedis
+
+class TestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.db = DatabaseBalancer()
+        self.db._store = MemoryRedis()
+        self.pipelines = 0
+        pipeline = self.db._store.pipeline
+        def countPipelines(transaction = True):
+            self.pipelines += 1
+            return pipeline(transaction)
+        self.db._store.pipeline = countPipelines
+
+    def test_flush(self):
+        db = self.db
+        db.addUid('1')
+        db.addUid('2')
+        db.setLock('1', {'lockTime': 1, 'deliveries': [1]})
+        db.setLock('2', {'lockTime': 2, 'deliveries': [2]})
+        db.clearLock('2')
+        db.setLock('1', {'lockTime': 3, 'deliveries': [1, 1]})
+        self.assertEqual(db.flush(), 4)
+        # all changes are written in one pipeline
+        self.assertEqual(self.pipelines, 1)
+        self.assertEqual(db.flush(), 0)
+        self.assertEqual(db.load(),
+            (['1', '2'], {'1': {'lockTime': 3, 'deliveries': [1, 1]}}))
+        db.removeUid('1')
+        db.flush()
+        self.assertEqual(db.load(), (['2'], {}))
+
+    def test_flushError(self):
+        db = self.db
+        db.addUid('1')
+        pipeline = db._store.pipeline
+        def refuse(transaction = True):
+            raise ConnectionError('Connection refused')
+        db._store.pipeline = refuse
+        self.assertEqual(db.flush(), 0)
+        db.addUid('2')
+        db._store.pipeline = pipeline
+        self.assertEqual(db.flush(), 2)
+        self.assertEqual(db.load(), (['1', '2'], {}))
@@ -9,8 +9,16 @@ import time
 from kernel.database.abstract import DatabaseAbstract
 
 class DatabaseHandler(DatabaseAbstract):
-    """ uid storage """
+    """
+     uid storage.
+     Settings of the device are kept in the hash (task, reading, start),
+     read data is appended to the separate string key, so every operation
+     with settings is one round-trip to the database.
+     Data written to the "data" field of the hash by previous versions
+     is moved to the string key once, on the first access to the settings
+    """
     _uid = None
+    _settingsMigrated = False
 
     def __init__(self, uid):
         """
@@ -62,22 +70,33 @@ class DatabaseHandler(DatabaseAbstract):
 
     def isReadingSettings(self):
         """ Tests, if currently in reading state """
-        return self.has('reading') \
-            and float(self.get('start')) + 600 > time.time()
+        pipe = self._store.pipeline(transaction = False)
+        pipe.hexists(self._settingsKey(), 'reading')
+        pipe.hget(self._settingsKey(), 'start')
+        reading, start = pipe.execute()
+        return bool(reading) and float(start or 0) + 600 > time.time()
 
     def isSettingsReady(self):
         """ Tests, if currently have ready read """
-        return self.has('data') and not self.has('reading')
+        self._migrateSettings()
+        pipe = self._store.pipeline(transaction = False)
+        pipe.exists(self._settingsDataKey())
+        pipe.hexists(self._settingsKey(), 'reading')
+        data, reading = pipe.execute()
+        return bool(data) and not reading
 
     def startReadingSettings(self, task):
         """
          Starts reading
          @param task: id task
         """
-        self.set('task', task)
-        self.set('reading', 1)
-        self.set('start', time.time())
-        self.remove('data')
+        pipe = self._store.pipeline()
+        pipe.hset(self._settingsKey(), 'task', task)
+        pipe.hset(self._settingsKey(), 'reading', 1)
+        pipe.hset(self._settingsKey(), 'start', time.time())
+        pipe.hdel(self._settingsKey(), 'data')
+        pipe.delete(self._settingsDataKey())
+        pipe.execute()
 
     def finishSettingsRead(self):
         """ Marks data as ready """
@@ -85,11 +104,14 @@ class DatabaseHandler(DatabaseAbstract):
 
     def addSettings(self, string):
         """ Adds string reading """
-        return self.set('data', self.getSettings() + string)
+        self._migrateSettings()
+        return self._store.append(self._settingsDataKey(), string)
 
     def getSettings(self):
         """ return ready data """
-        return self.get('data').decode()
+        self._migrateSettings()
+        current = self._store.get(self._settingsDataKey())
+        return (current or b'').decode()
 
     def getSettingsTaskId(self):
         """ return ready data """
@@ -97,11 +119,32 @@ class DatabaseHandler(DatabaseAbstract):
 
     def deleteSettings(self):
         """ Deletes data """
-        self._store.delete(self._settingsKey())
+        self._store.delete(self._settingsKey(), self._settingsDataKey())
+
+    def _migrateSettings(self):
+        """
+         Moves data read by the previous version from the "data" field
+         of the settings hash to the string key.
+         Done once for the handler instance
+        """
+        if self._settingsMigrated:
+            return
+        pipe = self._store.pipeline()
+        pipe.hget(self._settingsKey(), 'data')
+        pipe.hdel(self._settingsKey(), 'data')
+        pipe.get(self._settingsDataKey())
+        legacyData, deleted, current = pipe.execute()
+        if legacyData is not None:
+            self._store.set(self._settingsDataKey(),
+                legacyData + (current or b''))
+        self._settingsMigrated = True
 
     def _settingsKey(self):
         return 'tracker_setting' + self._uid
 
+    def _settingsDataKey(self):
+        return 'tracker_setting_data' + self._uid
+
 # ===========================================================================
 # TESTS
 # ===========================================================================
@@ -131,4 +174,58 @@ class TestCase(unittest.TestCase):
         self.assertEqual(db.getSettings(), 'TEMPLATE')
         self.assertFalse(db.isSettingsReady())
         self.assertEqual(db.get('task'), b'22222')
-        db.deleteSettings()
\ No newline at end of file
+        db.deleteSettings()
+
+    def getMemoryHandler(self):
+        from kernel.database.memory import MemoryRedis
+        db = DatabaseHandler('UnitTest')
+        db._store = MemoryRedis()
+        return db
+
+    def test_settings(self):
+        db = self.getMemoryHandler()
+        self.assertFalse(db.isReadingSettings())
+        db.startReadingSettings(22222)
+        self.assertTrue(db.isReadingSettings())
+        db.addSettings('TEMPLATE')
+        db.addSettings(',1')
+        self.assertEqual(db.getSettings(), 'TEMPLATE,1')
+        self.assertFalse(db.isSettingsReady())
+        db.finishSettingsRead()
+        self.assertTrue(db.isSettingsReady())
+        self.assertEqual(db.getSettingsTaskId(), b'22222')
+        # new reading drops previous data
+        db.startReadingSettings(22223)
+        self.assertEqual(db.getSettings(), '')
+        db.deleteSettings()
+        self.assertEqual(db._store._data, {})
+
+    def test_legacySettings(self):
+        db = self.getMemoryHandler()
+        # data read by the previous version is kept in the hash
+        db.set('task', 22222)
+        db.set('data', 'TEMPLATE')
+        self.assertTrue(db.isSettingsReady())
+        self.assertFalse(db.has('data'))
+        self.assertEqual(db.getSettings(), 'TEMPLATE')
+        db.set('reading', 1)
+        db.addSettings(',1')
+        self.assertFalse(db.has('data'))
+        self.assertEqual(db.getSettings(), 'TEMPLATE,1')
+        db.addSettings(',2')
+        self.assertEqual(db.getSettings(), 'TEMPLATE,1,2')
+        db.startReadingSettings(22223)
+        self.assertEqual(db.getSettings(), '')
+    def test_settingsMigratedOnce(self):
+        db = self.getMemoryHandler()
+        db.startReadingSettings(22222)
+        db.addSettings('TEMPLATE')
+        pipeline = db._store.pipeline
+        calls = []
+        db._store.pipeline = lambda *args, **kwargs: \
+            calls.append(args) or pipeline(*args, **kwargs)
+        db.finishSettingsRead()
+        self.assertTrue(db.isSettingsReady())
+        self.assertEqual(db.getSettings(), 'TEMPLATE')
+        # isSettingsReady is a single pipeline, no legacy checks
+        self.assertEqual(len(calls), 1)
@@ -0,0 +1,198 @@
+# -*- coding: utf8 -*-
+'''
+@project   Maprox <http://www.maprox.net>
+@info      In-process replacement of the redis server
+@copyright 2013, Maprox LLC
+'''
+
+from threading import Lock
+
+def encode(value):
+    """
+     Converts value to bytes as redis client does
+     @param value: str, bytes or number
+     @return: bytes
+    """
+    if isinstance(value, bytes):
+        return value
+    if isinstance(value, float):
+        return repr(value).encode()
+    return str(value).encode()
+
+class MemoryRedis(object):
+    """
+     Redis client replacement, which keeps data in memory of the process.
+     Implements commands used by kernel.database (strings, hashes, sets
+     and pipelines). Used when host of [redis] section is "memory",
+     like memory:// transport of kombu for amqp, e.g. for benchmarks
+    """
+
+    def __init__(self):
+        """ Constructor """
+        self._lock = Lock()
+        self._data = {}
+
+    def _call(self, name, *args):
+        """
+         Executes command under lock
+         @param name: Name of the command method
+         @param args: Arguments of the command
+         @return: Result of the command
+        """
+        with self._lock:
+            return getattr(self, '_' + name)(*args)
+
+    def _getHash(self, key):
+        return self._data.setdefault(encode(key), {})
+
+    def _getSet(self, key):
+        return self._data.setdefault(encode(key), set())
+
+    def _get(self, key):
+        return self._data.get(encode(key))
+
+    def _set(self, key, value):
+        self._data[encode(key)] = encode(value)
+        return True
+
+    def _append(self, key, value):
+        key = encode(key)
+        self._data[key] = self._data.get(key, b'') + encode(value)
+        return len(self._data[key])
+
+    def _exists(self, *keys):
+        return sum(1 for key in keys if encode(key) in self._data)
+
+    def _hset(self, key, field, value):
+        values = self._getHash(key)
+        field = encode(field)
+        isNew = field not in values
+        values[field] = encode(value)
+        return int(isNew)
+
+    def _hget(self, key, field):
+        return self._data.get(encode(key), {}).get(encode(field))
+
+    def _hexists(self, key, field):
+        return encode(field) in self._data.get(encode(key), {})
+
+    def _hdel(self, key, *fields):
+        values = self._data.get(encode(key), {})
+        return sum(1 for field in fields
+            if values.pop(encode(field), None) is not None)
+
+    def _hgetall(self, key):
+        return dict(self._data.get(encode(key), {}))
+
+    def _sadd(self, key, *members):
+        values = self._getSet(key)
+        members = set(encode(member) for member in members)
+        count = len(members - values)
+        values.update(members)
+        return count
+
+    def _srem(self, key, *members):
+        values = self._getSet(key)
+        members = set(encode(member) for member in members)
+        count = len(members & values)
+        values.difference_update(members)
+        return count
+
+    def _smembers(self, key):
+        return set(self._data.get(encode(key), set()))
+
+    def _delete(self, *keys):
+        return sum(1 for key in keys
+            if self._data.pop(encode(key), None) is not None)
+
+    def __getattr__(self, name):
+        if name.startswith('_') or not hasattr(self, '_' + name):
+            raise AttributeError(name)
+        return lambda *args: self._call(name, *args)
+
+    def pipeline(self, transaction = True):
+        """
+         Returns pipeline of commands
+         @param transaction: Ignored, commands are always executed atomically
+         @return: MemoryPipeline
+        """
+        return MemoryPipeline(self)
+
+class MemoryPipeline(object):
+    """
+     Pipeline of MemoryRedis commands
+    """
+
+    def __init__(self, store):
+        """
+         Constructor
+         @param store: MemoryRedis instance
+        """
+        self._store = store
+        self._calls = []
+
+    def __getattr__(self, name):
+        if name.startswith('_') or not hasattr(self._store, '_' + name):
+            raise AttributeError(name)
+        def command(*args):
+            self._calls.append((name, args))
+            return self
+        return command
+
+    def execute(self):
+        """
+         Executes collected commands at once
+         @return: list of results of commands
+        """
+        calls, self._calls = self._calls, []
+        with self._store._lock:
+            return [getattr(self._store, '_' + name)(*args)
+                for name, args in calls]
+
+# store of the process
+store = MemoryRedis()
+
+# ===========================================================================
+# TESTS
+# ===========================================================================
+
+import unittest
+
+class TestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.store = MemoryRedis()
+
+    def test_hash(self):
+        s = self.store
+        self.assertEqual(s.hset('key', 'task', 10202), 1)
+        self.assertEqual(s.hset('key', 'task', 1.5), 0)
+        self.assertEqual(s.hget('key', 'task'), b'1.5')
+        self.assertIsNone(s.hget('key', 'data'))
+        self.assertTrue(s.hexists('key', 'task'))
+        self.assertEqual(s.hgetall('key'), {b'task': b'1.5'})
+        self.assertEqual(s.hdel('key', 'task', 'data'), 1)
+        self.assertFalse(s.hexists('key', 'task'))
+        s.hset('key', 'data', 'TEMPLATE')
+        self.assertEqual(s.delete('key', 'other'), 1)
+        self.assertIsNone(s.hget('key', 'data'))
+
+    def test_string(self):
+        s = self.store
+        self.assertIsNone(s.get('key'))
+        self.assertEqual(s.exists('key'), 0)
+        self.assertEqual(s.append('key', 'AB'), 2)
+        self.assertEqual(s.append('key', b'C'), 3)
+        self.assertEqual(s.get('key'), b'ABC')
+        self.assertTrue(s.set('key', 'D'))
+        self.assertEqual(s.get('key'), b'D')
+        self.assertEqual(s.exists('key', 'other'), 1)
+
+    def test_pipeline(self):
+        s = self.store
+        pipe = s.pipeline(transaction = False)
+        pipe.sadd('uids', '1', '2').srem('uids', '2')
+        pipe.smembers('uids')
+        self.assertEqual(pipe.execute(), [2, 1, {b'1'}])
+        self.assertEqual(pipe.execute(), [])
+        self.assertRaises(AttributeError, getattr, pipe, 'unknown')
@@ -2,27 +2,42 @@
 '''
 @project   Maprox <http://www.maprox.net>
 @info      Database handler class
-@copyright 2009-2012, Maprox LLC
+@copyright 2009-2013, Maprox LLC
 '''
 
+from collections import OrderedDict
+from threading import Lock
 from kernel.database.controller import DatabaseController
 from kernel.database.handler import DatabaseHandler
 
 class DatabaseManager(object):
-    """ Database handlers """
-    __db = {}
+    """
+     Database handlers.
+     Handlers of recently used devices are cached, the least recently
+     used handler is dropped when count of handlers exceeds the size
+    """
     __dbController = False
 
-    def __init__(self):
-        self.__db = {}
+    def __init__(self, size = 1024):
+        """
+         Constructor
+         @param size: Max count of cached database handlers
+        """
+        self.__db = OrderedDict()
+        self.__size = size
+        self.__lock = Lock()
 
     def get(self, uid):
         """ Returns the database object """
 
-        if not uid in self.__db:
-            self.__db[uid] = DatabaseHandler(uid)
-
-        return self.__db[uid]
+        with self.__lock:
+            if uid in self.__db:
+                self.__db.move_to_end(uid)
+            else:
+                self.__db[uid] = DatabaseHandler(uid)
+                if len(self.__db) > self.__size:
+                    self.__db.popitem(last = False)
+            return self.__db[uid]
 
     def getController(self):
         """ Returns the database object for controller """
@@ -34,3 +49,22 @@ class DatabaseManager(object):
 
 # let's create instance of global database manager
 db = DatabaseManager()
+
+# ===========================================================================
+# TESTS
+# ===========================================================================
+
+import unittest
+
+class TestCase(unittest.TestCase):
+
+    def test_cache(self):
+        manager = DatabaseManager(2)
+        first = manager.get('1')
+        self.assertIs(manager.get('1'), first)
+        second = manager.get('2')
+        manager.get('1')
+        # the least recently used handler is dropped
+        manager.get('3')
+        self.assertIs(manager.get('1'), first)
+        self.assertIsNot(manager.get('2'), second)
@@ -14,7 +14,7 @@ import urllib.parse
 import urllib.request
 
 import lib.falcon
-from lib.broker import broker
+from lib.broker import broker, publisher
 
 # RabbitMQ processing features
 
@@ -40,7 +40,8 @@ class Manager(Store):
             else:
                 return result
             # Let's send packets to AMQP broker
-            self.sendPacketsViaBroker(packets)
+            if not self.sendPacketsViaBroker(packets):
+                result.error('503', ['Publish queue is full'])
         except Exception as E:
             result.error('500', ['Error sending packets: ' + str(E)])
             log.error(E)
@@ -50,13 +51,16 @@ class Manager(Store):
         """
          Sends data to the message broker (AMQP)
          @param packets: list of packets
-         @return:
+         @return: bool False if packets are rejected by publish queue
         """
         try:
+            if conf.publishAsync:
+                return publisher.put(packets)
             broker.send(packets)
         except Exception as E:
             #~print(E)
             log.error(E)
+        return True
 
 class TestManager(Manager):
     stored_packets = []
@@ -5,7 +5,10 @@
 @copyright 2009-2013, Maprox LLC
 '''
 
+import socket
+import asyncio
 import traceback
+from collections import deque
 from threading import Thread
 from socketserver import TCPServer
 from socketserver import ThreadingMixIn
@@ -13,9 +16,14 @@ from socketserver import BaseRequestHandler
 
 from kernel.logger import log
 from kernel.config import conf
+from kernel.supervisor import stats
 import kernel.pipe as pipe
 from lib.handlers.list import HandlerClass
 
+# interval (in seconds) between handler.processEvents() calls
+# for idle connections of the asyncio server
+EVENTS_INTERVAL = 60
+
 # ===========================================================================
 class ClientThread(BaseRequestHandler):
     """
@@ -26,21 +34,66 @@ class ClientThread(BaseRequestHandler):
     __handler = None
 
     def setup(self):
-        pass
+        self._scheduled = deque()
+        # socket pair, which wakes up the connection thread waiting
+        # for data, when callback is scheduled (see schedule())
+        self.wakeup, self._wakeupWriter = socket.socketpair()
+        self.wakeup.setblocking(False)
+        self._wakeupWriter.setblocking(False)
 
     def handle(self):
+        stats.add('connections')
         try:
-            if HandlerClass:
-                log.debug('Protocol handler: %s', HandlerClass.__doc__)
-                self.__handler = HandlerClass(pipe.Manager(), self)
+            handlerClass = self.server.handlerClass or HandlerClass
+            if handlerClass:
+                log.debug('Protocol handler: %s', handlerClass.__doc__)
+                self.__handler = handlerClass(pipe.Manager(), self)
                 self.__handler.dispatch()
             else:
                 log.error('No protocol handlers found!')
         except Exception as E:
             log.error("Dispatch error: %s", traceback.format_exc())
 
+    @property
+    def port(self):
+        """ Port of the listener, which accepted the connection """
+        return self.server.server_address[1]
+
+    def schedule(self, callback):
+        """
+         Executes callback for the connection.
+         Callback is queued and called from the connection thread,
+         which is woken up if it waits for data (see runScheduled())
+         @param callback: callable
+        """
+        self._scheduled.append(callback)
+        try:
+            self._wakeupWriter.send(b'\x00')
+        except (BlockingIOError, OSError):
+            pass # thread is already woken up or connection is closed
+
+    def runScheduled(self):
+        """
+         Calls queued callbacks of the connection.
+         Must be called from the connection thread only
+        """
+        try:
+            while self.wakeup.recv(4096):
+                pass
+        except (BlockingIOError, OSError):
+            pass
+        while self._scheduled:
+            callback = self._scheduled.popleft()
+            try:
+                callback()
+            except Exception as E:
+                log.error("Scheduled callback error: %s",
+                    traceback.format_exc())
+
     def finish(self):
         log.debug('ClientThread finish')
+        self.wakeup.close()
+        self._wakeupWriter.close()
         if self.__handler:
             log.debug('Delete handler: %s', self.__handler.__class__)
             del self.__handler
@@ -51,6 +104,17 @@ class ThreadingServer(ThreadingMixIn, TCPServer):
      Base class for tcp-server multithreading
     """
     allow_reuse_address = True
+    handlerClass = None
+    reusePort = False
+
+    def server_bind(self):
+        """
+         Several worker processes can listen the same port,
+         connections are distributed between them by the kernel
+        """
+        if self.reusePort:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        TCPServer.server_bind(self)
 
 # ===========================================================================
 class Server():
@@ -58,15 +122,27 @@ class Server():
      Multithreaded TCP-server
     """
 
-    def __init__(self, port = 30003):
+    def __init__(self, port = 30003, handlerClass = None, reusePort = False):
         """
          Server class constructor
          @param port: Listening port. Optional, default is 30003.
+         @param handlerClass: Protocol handler class.
+           Optional, default is lib.handlers.list.HandlerClass
+         @param reusePort: If True, the port is bound with SO_REUSEPORT
         """
         log.debug("Server::__init__(%s)", port)
         self.host = ""
         self.port = port
-        self.server = ThreadingServer((self.host, self.port), ClientThread)
+        self.server = ThreadingServer((self.host, self.port), ClientThread,
+            bind_and_activate = False)
+        self.server.handlerClass = handlerClass
+        self.server.reusePort = reusePort
+        try:
+            self.server.server_bind()
+            self.server.server_activate()
+        except:
+            self.server.server_close()
+            raise
 
     def run(self):
         """
@@ -77,3 +153,361 @@ class Server():
         self.server_thread.setDaemon(False)
         self.server_thread.start()
         log.info("Server is started on port %s", self.port)
+
+# ===========================================================================
+class ClientRequest(object):
+    """
+     Socket-like wrapper of the asyncio transport.
+     Protocol handlers use it as clientThread.request for sending data.
+    """
+
+    def __init__(self, transport):
+        """
+         Constructor
+         @param transport: asyncio transport of the connection
+        """
+        self.transport = transport
+
+    def send(self, data):
+        """
+         Writes data to the transport (never blocks)
+         @param data: bytes
+         @return: int Count of bytes written
+        """
+        self.transport.write(data)
+        return len(data)
+
+    def settimeout(self, value):
+        pass
+
+    def recv(self, bufsize):
+        """
+         Synchronous reading is not possible inside of the event loop,
+         all incoming data is delivered through data_received()
+        """
+        raise BlockingIOError('recv() is not supported by asyncio server')
+
+    def recv_into(self, buffer):
+        """
+         See recv()
+        """
+        raise BlockingIOError('recv() is not supported by asyncio server')
+
+    def close(self):
+        self.transport.close()
+
+# ===========================================================================
+class ClientProtocol(asyncio.Protocol):
+    """
+     asyncio protocol for our server.
+     An object of this class is created for each connection to the server.
+     Incoming data is passed to the protocol handler from the event loop,
+     so there is no dedicated thread per connection.
+    """
+    handler = None
+    request = None
+
+    def __init__(self, handlerClass = None, port = None):
+        """
+         Constructor
+         @param handlerClass: Protocol handler class.
+           Optional, default is lib.handlers.list.HandlerClass
+         @param port: Port of the listener, which accepted the connection
+        """
+        self.handlerClass = handlerClass or HandlerClass
+        self.port = port
+        self._timer = None
+
+    def connection_made(self, transport):
+        stats.add('connections')
+        self.loop = asyncio.get_event_loop()
+        self.request = ClientRequest(transport)
+        try:
+            if self.handlerClass:
+                log.debug('Protocol handler: %s', self.handlerClass.__doc__)
+                self.handler = self.handlerClass(pipe.Manager(), self)
+                self.scheduleEvents()
+            else:
+                log.error('No protocol handlers found!')
+                transport.close()
+        except Exception as E:
+            log.error("Dispatch error: %s", traceback.format_exc())
+            transport.close()
+
+    def data_received(self, data):
+        if not self.handler:
+            return
+        self.scheduleEvents()
+        try:
+            self.handler.receiveData(data)
+        except Exception as E:
+            log.error("Dispatch error: %s", traceback.format_exc())
+
+    def connection_lost(self, exc):
+        log.debug('ClientProtocol finish')
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        if self.handler:
+            log.debug('Delete handler: %s', self.handler.__class__)
+            self.handler = None
+
+    def schedule(self, callback):
+        """
+         Executes callback for the connection in the event loop thread.
+         Can be called from any thread
+         @param callback: callable
+        """
+        self.loop.call_soon_threadsafe(self.callHandler, callback)
+
+    def runInExecutor(self, function, callback = None):
+        """
+         Calls blocking function (database, message broker) in the
+         executor of the event loop, so other connections do not wait
+         @param function: callable
+         @param callback: callable, which is called with the result
+           of the function in the event loop thread
+        """
+        future = self.loop.run_in_executor(None, function)
+        if callback:
+            future.add_done_callback(lambda future:
+                self.callHandler(lambda: callback(future.result())))
+
+    def callHandler(self, callback):
+        """
+         Calls handler callback if connection is still alive
+         @param callback: callable
+        """
+        if not self.handler:
+            return
+        try:
+            callback()
+        except Exception as E:
+            log.error("Dispatch error: %s", traceback.format_exc())
+
+    def scheduleEvents(self):
+        """
+         (Re)starts timer of handler.processEvents() call
+        """
+        if self._timer:
+            self._timer.cancel()
+        loop = asyncio.get_event_loop()
+        self._timer = loop.call_later(EVENTS_INTERVAL, self.onEventsTimer)
+
+    def onEventsTimer(self):
+        """
+         Executes when there is no data from device for EVENTS_INTERVAL
+        """
+        self._timer = None
+        if not self.handler:
+            return
+        try:
+            self.handler.processEvents()
+        except Exception as E:
+            log.error("Process events error: %s", traceback.format_exc())
+        self.scheduleEvents()
+
+# ===========================================================================
+class AsyncServer():
+    """
+     Single threaded TCP-server based on asyncio event loop
+    """
+
+    def __init__(self, port = 30003, handlerClass = None, loop = None,
+            reusePort = False):
+        """
+         Server class constructor
+         @param port: Listening port. Optional, default is 30003.
+         @param handlerClass: Protocol handler class.
+           Optional, default is lib.handlers.list.HandlerClass
+         @param loop: Event loop. Several servers can share one loop,
+           then run() must be called for one of them only
+         @param reusePort: If True, the port is bound with SO_REUSEPORT
+        """
+        log.debug("AsyncServer::__init__(%s)", port)
+        self.host = ""
+        self.port = port
+        self.loop = loop or asyncio.new_event_loop()
+        self.server = self.loop.run_until_complete(
+            self.loop.create_server(
+                lambda: ClientProtocol(handlerClass, self.port),
+                self.host, self.port, reuse_address = True,
+                reuse_port = reusePort or None))
+
+    def serve_forever(self):
+        """
+         Runs event loop of the server
+        """
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def run(self):
+        """
+         Method wich starts TCP-server
+        """
+        log.debug("AsyncServer::run()")
+        self.server_thread = Thread(target = self.serve_forever)
+        self.server_thread.setDaemon(False)
+        self.server_thread.start()
+        log.info("AsyncServer is started on port %s", self.port)
+
+# ===========================================================================
+# TESTS
+# ===========================================================================
+
+import unittest
+from lib.handler import AbstractHandler
+import select
+import threading
+import time
+
+class EchoHandler(AbstractHandler):
+    """ Test handler, which sends received data back """
+    def processData(self, data):
+        self.send(data)
+        return self
+
+class TestTransport(object):
+    """ Test transport, which stores written data """
+    closed = False
+    def __init__(self):
+        self.data = b''
+    def write(self, data):
+        self.data += data
+    def close(self):
+        self.closed = True
+
+class TestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        asyncio.set_event_loop(None)
+        self.loop.close()
+
+    def test_protocolDispatch(self):
+        transport = TestTransport()
+        protocol = ClientProtocol(EchoHandler)
+        protocol.connection_made(transport)
+        self.assertIsInstance(protocol.handler, EchoHandler)
+        self.assertIs(protocol.handler.getThread(), protocol)
+        protocol.data_received(b'\x00\x0f012896001609129')
+        protocol.data_received(b'\x01')
+        self.assertEqual(transport.data, b'\x00\x0f012896001609129\x01')
+        protocol.connection_lost(None)
+        self.assertIsNone(protocol.handler)
+        self.assertIsNone(protocol._timer)
+
+    def test_reusePort(self):
+        if not hasattr(socket, 'SO_REUSEPORT'):
+            return self.skipTest('SO_REUSEPORT is not supported')
+        first = Server(0, EchoHandler, True)
+        port = first.server.server_address[1]
+        second = Server(port, EchoHandler, True)
+        self.assertEqual(second.server.server_address[1], port)
+        second.server.server_close()
+        first.server.server_close()
+
+    def test_protocolPort(self):
+        protocol = ClientProtocol(EchoHandler, 21120)
+        protocol.connection_made(TestTransport())
+        # data of the handler is spilled to the storage of this port
+        self.assertEqual(protocol.handler.getPort(), 21120)
+        protocol.connection_lost(None)
+
+    def test_protocolSchedule(self):
+        calls = []
+        protocol = ClientProtocol(EchoHandler)
+        protocol.connection_made(TestTransport())
+        protocol.schedule(lambda: calls.append(1))
+        self.loop.call_soon(self.loop.stop)
+        self.loop.run_forever()
+        self.assertEqual(calls, [1])
+        protocol.connection_lost(None)
+
+    def test_protocolRunInExecutor(self):
+        results = []
+        protocol = ClientProtocol(EchoHandler)
+        protocol.connection_made(TestTransport())
+        protocol.runInExecutor(threading.get_ident, results.append)
+        for i in range(50):
+            if results: break
+            self.loop.call_later(0.01, self.loop.stop)
+            self.loop.run_forever()
+        # function is called out of the event loop thread
+        self.assertEqual(len(results), 1)
+        self.assertNotEqual(results[0], threading.get_ident())
+        protocol.connection_lost(None)
+
+    def test_threadSchedule(self):
+        calls = []
+        thread = ClientThread.__new__(ClientThread)
+        thread.setup()
+        thread.schedule(lambda: calls.append(1))
+        # callback is not called from the thread of the caller
+        self.assertEqual(calls, [])
+        thread.schedule(lambda: 1 / 0)
+        thread.schedule(lambda: calls.append(2))
+        # waiting connection thread is woken up
+        self.assertEqual(select.select([thread.wakeup], [], [], 0)[0],
+            [thread.wakeup])
+        thread.runScheduled()
+        self.assertEqual(calls, [1, 2])
+        self.assertEqual(select.select([thread.wakeup], [], [], 0)[0], [])
+        thread.runScheduled()
+        self.assertEqual(calls, [1, 2])
+        thread.finish()
+
+    def test_threadWakeup(self):
+        calls = []
+        thread = ClientThread.__new__(ClientThread)
+        thread.setup()
+        thread.request, device = socket.socketpair()
+        handler = AbstractHandler(pipe.TestManager(), thread)
+        def command():
+            calls.append(time.time())
+            device.send(b'data')
+        timer = threading.Timer(0.05,
+            lambda: thread.schedule(command))
+        timer.start()
+        started = time.time()
+        # callback is called as soon as it is scheduled
+        self.assertEqual(handler.recvInto(), b'data')
+        self.assertEqual(len(calls), 1)
+        self.assertLess(calls[0] - started, 0.5)
+        timer.join()
+        thread.request.close()
+        device.close()
+        thread.finish()
+
+    def test_serversShareLoop(self):
+        class UpperHandler(EchoHandler):
+            def processData(self, data):
+                self.send(data.upper())
+                return self
+        servers = [
+            AsyncServer(0, EchoHandler, self.loop),
+            AsyncServer(0, UpperHandler, self.loop)
+        ]
+        for server, answer in zip(servers, [b'ping', b'PING']):
+            self.assertIs(server.loop, self.loop)
+            port = [sock.getsockname()[1] for sock in server.server.sockets
+                if sock.family == socket.AF_INET][0]
+            client = socket.create_connection(('127.0.0.1', port))
+            client.sendall(b'ping')
+            for i in range(10):
+                self.loop.run_until_complete(asyncio.sleep(0.05))
+            client.settimeout(1)
+            self.assertEqual(client.recv(4), answer)
+            client.close()
+        for server in servers:
+            server.server.close()
+
+    def test_protocolWithoutHandler(self):
+        transport = TestTransport()
+        protocol = ClientProtocol()
+        protocol.handlerClass = None
+        protocol.connection_made(transport)
+        self.assertTrue(transport.closed)
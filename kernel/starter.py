@@ -5,9 +5,14 @@
 @copyright 2009-2011, Maprox LLC
 '''
 
+import os
+import socket
+import asyncio
 from kernel.logger import log
 from kernel.config import conf
-from kernel.server import Server
+from kernel.server import Server, AsyncServer
+from kernel.supervisor import Supervisor
+from lib.handlers.list import getListeners, initAmqpThreads
 
 # ===========================================================================
 class Starter(object):
@@ -16,11 +21,15 @@ class Starter(object):
     """
 
     # -----------------------------
-    def __init__(self):
+    def __init__(self, listeners = None):
         """
          Constructor
+         @param listeners: list of tuples (HandlerClass, port).
+           Optional, default is lib.handlers.list.getListeners()
         """
         log.debug('Starter::__init__')
+        self.listeners = listeners
+        self.servers = []
 
     # -----------------------------
     def run(self):
@@ -29,6 +38,56 @@ class Starter(object):
         """
         log.debug('Starter::run()')
         try:
-            Server(conf.port).run()
+            prefork = conf.workers > 1
+            if prefork and not (hasattr(os, 'fork') and
+                    hasattr(socket, 'SO_REUSEPORT')):
+                log.error('Pre-fork mode is not supported by the system, '
+                    'starting single process')
+                prefork = False
+            listeners = self.listeners
+            if listeners is None:
+                # threads are not copied by fork(), so in pre-fork mode
+                # AMQP threads of handlers are started by workers
+                listeners = getListeners(not prefork)
+            if not listeners:
+                log.critical('No protocol handlers found!')
+                return
+            if prefork:
+                Supervisor(conf.workers,
+                    lambda: self.startWorker(listeners)).run()
+                return
+            self.startServers(listeners)
         except Exception as E:
             log.critical(E)
+
+    # -----------------------------
+    def startWorker(self, listeners):
+        """
+         Starts AMQP threads of handlers and servers of the listeners
+         in the worker process
+         @param listeners: list of tuples (HandlerClass, port)
+        """
+        initAmqpThreads()
+        self.startServers(listeners, True)
+
+    # -----------------------------
+    def startServers(self, listeners, reusePort = False):
+        """
+         Starts servers of the listeners
+         @param listeners: list of tuples (HandlerClass, port)
+         @param reusePort: If True, ports are bound with SO_REUSEPORT
+        """
+        if conf.serverMode == 'asyncio':
+            # all listeners are served by one event loop
+            loop = asyncio.new_event_loop()
+            for handlerClass, port in listeners:
+                self.servers.append(AsyncServer(port, handlerClass, loop,
+                    reusePort))
+                log.info("%s is listening on port %s",
+                    handlerClass.__doc__, port)
+            self.servers[0].run()
+        else:
+            for handlerClass, port in listeners:
+                server = Server(port, handlerClass, reusePort)
+                server.run()
+                self.servers.append(server)
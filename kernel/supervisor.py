@@ -0,0 +1,312 @@
+# -*- coding: utf8 -*-
+'''
+@project   Maprox <http://www.maprox.net>
+@info      Supervisor of pre-forked worker processes
+@copyright 2013, Maprox LLC
+'''
+
+import os
+import json
+import time
+import signal
+import select
+from threading import Lock
+
+from kernel.logger import log
+
+# interval (in seconds) between stats reports of workers
+STATS_INTERVAL = 60
+# delay (in seconds) before restart of a dead worker
+RESTART_DELAY = 1
+
+# ===========================================================================
+class Stats(object):
+    """
+     Counters of the current process (connections, packets, etc.)
+    """
+
+    def __init__(self):
+        """
+         Constructor
+        """
+        self._lock = Lock()
+        self._values = {}
+
+    def add(self, name, value = 1):
+        """
+         Increases counter
+         @param name: Name of the counter
+         @param value: Increment
+        """
+        with self._lock:
+            self._values[name] = self._values.get(name, 0) + value
+
+    def get(self):
+        """
+         Returns copy of all counters
+         @return: dict
+        """
+        with self._lock:
+            return dict(self._values)
+
+    def reset(self):
+        """
+         Resets all counters
+        """
+        with self._lock:
+            self._values = {}
+
+# counters of the process
+stats = Stats()
+
+# ===========================================================================
+class Supervisor(object):
+    """
+     Pre-fork supervisor.
+     Runs target in several worker processes (all of them listen
+     the same port with SO_REUSEPORT), restarts dead workers
+     and aggregates stats of the workers
+    """
+
+    def __init__(self, count, target, statsInterval = STATS_INTERVAL):
+        """
+         Constructor
+         @param count: Count of worker processes
+         @param target: Function which starts listeners of a worker
+         @param statsInterval: Interval (in seconds) of stats reports
+        """
+        self.count = count
+        self.target = target
+        self.statsInterval = statsInterval
+        self.restartDelay = RESTART_DELAY
+        self._running = False
+        self._workers = {}  # pid => (index, fd)
+        self._stats = {}    # index => last stats of the worker
+        self._retired = {}  # stats of dead workers
+        self._buffers = {}  # fd => unfinished line of stats
+        self._restarts = 0
+
+    def run(self):
+        """
+         Starts workers and supervises them until SIGTERM / SIGINT
+        """
+        log.info('Supervisor is started with %s workers', self.count)
+        self._running = True
+        signal.signal(signal.SIGTERM, self.onSignal)
+        signal.signal(signal.SIGINT, self.onSignal)
+        for index in range(self.count):
+            self.spawn(index)
+        nextReport = time.time() + self.statsInterval
+        while self._running:
+            self.readStats(1)
+            self.reapWorkers()
+            if time.time() >= nextReport:
+                nextReport = time.time() + self.statsInterval
+                log.info('Workers: %s, stats: %s',
+                    len(self._workers), self.getStats())
+        self.stopWorkers()
+        log.info('Supervisor is stopped')
+
+    def onSignal(self, signum, frame):
+        """
+         Stops supervisor
+        """
+        self._running = False
+
+    def spawn(self, index):
+        """
+         Forks new worker process
+         @param index: Index of the worker
+         @return: pid of the worker
+        """
+        rfd, wfd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(rfd)
+            code = 0
+            try:
+                self.runWorker(wfd)
+            except BaseException:
+                code = 1
+            os._exit(code)
+        os.close(wfd)
+        self._workers[pid] = (index, rfd)
+        self._buffers[rfd] = b''
+        log.info('Worker #%s is started, pid = %s', index, pid)
+        return pid
+
+    def runWorker(self, fd):
+        """
+         Main function of the worker process.
+         Starts listeners and reports stats to the supervisor
+         @param fd: Write end of the stats pipe
+        """
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        from lib.broker import resetAfterFork
+        resetAfterFork()
+        stats.reset()
+        parent = os.getppid()
+        self.target()
+        while os.getppid() == parent:
+            data = json.dumps(stats.get()) + '\n'
+            os.write(fd, data.encode())
+            time.sleep(self.statsInterval)
+
+    def readStats(self, timeout):
+        """
+         Reads stats reported by workers
+         @param timeout: Max time (in seconds) to wait for reports
+        """
+        fds = [fd for index, fd in self._workers.values()]
+        if not fds:
+            time.sleep(timeout)
+            return
+        try:
+            ready = select.select(fds, [], [], timeout)[0]
+        except InterruptedError:
+            return
+        indexes = dict((fd, index) for index, fd in self._workers.values())
+        for fd in ready:
+            data = os.read(fd, 65536)
+            if not data:
+                continue
+            lines = (self._buffers[fd] + data).split(b'\n')
+            self._buffers[fd] = lines.pop()
+            for line in lines:
+                try:
+                    self._stats[indexes[fd]] = json.loads(line.decode())
+                except ValueError as E:
+                    log.error('Incorrect stats of worker: %s', E)
+
+    def reapWorkers(self):
+        """
+         Restarts dead workers
+        """
+        while self._workers:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0 or pid not in self._workers:
+                return
+            index = self.removeWorker(pid)
+            if not self._running:
+                continue
+            log.error('Worker #%s (pid = %s) is dead with status %s',
+                index, pid, status)
+            time.sleep(self.restartDelay)
+            self._restarts += 1
+            self.spawn(index)
+
+    def removeWorker(self, pid):
+        """
+         Forgets dead worker: closes its stats pipe and keeps its stats
+         @param pid: pid of the worker
+         @return: Index of the worker
+        """
+        index, fd = self._workers.pop(pid)
+        os.close(fd)
+        self._buffers.pop(fd, None)
+        for name, value in self._stats.pop(index, {}).items():
+            self._retired[name] = self._retired.get(name, 0) + value
+        return index
+
+    def stopWorkers(self, timeout = 10):
+        """
+         Stops all workers
+         @param timeout: Time (in seconds) to wait for workers exit
+        """
+        self._running = False
+        for pid in list(self._workers):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        deadline = time.time() + timeout
+        while self._workers and time.time() < deadline:
+            self.reapWorkers()
+            time.sleep(0.1)
+        for pid in list(self._workers):
+            log.error('Worker (pid = %s) is killed', pid)
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+            self.removeWorker(pid)
+
+    def getStats(self):
+        """
+         Returns stats of all workers (including dead ones)
+         @return: dict
+        """
+        result = dict(self._retired)
+        result['restarts'] = self._restarts
+        for values in self._stats.values():
+            for name, value in values.items():
+                result[name] = result.get(name, 0) + value
+        return result
+
+# ===========================================================================
+# TESTS
+# ===========================================================================
+
+import unittest
+class TestCase(unittest.TestCase):
+
+    def setUp(self):
+        def target():
+            stats.add('packets', 5)
+        self.supervisor = Supervisor(2, target, 0.05)
+        self.supervisor.restartDelay = 0
+        self.supervisor._running = True
+
+    def tearDown(self):
+        self.supervisor.stopWorkers()
+
+    def waitStats(self, name, value):
+        deadline = time.time() + 5
+        while time.time() < deadline:
+            self.supervisor.readStats(0.05)
+            self.supervisor.reapWorkers()
+            if self.supervisor.getStats().get(name) == value:
+                break
+            time.sleep(0.01)
+        return self.supervisor.getStats()
+
+    def test_stats(self):
+        s = Stats()
+        s.add('connections')
+        s.add('bytes', 10)
+        s.add('bytes', 5)
+        self.assertEqual(s.get(), {'connections': 1, 'bytes': 15})
+        s.reset()
+        self.assertEqual(s.get(), {})
+
+    def test_workers(self):
+        sv = self.supervisor
+        for index in range(sv.count):
+            sv.spawn(index)
+        self.assertEqual(self.waitStats('packets', 10)['packets'], 10)
+        pid = list(sv._workers)[0]
+        os.kill(pid, signal.SIGKILL)
+        result = self.waitStats('packets', 15)
+        self.assertEqual(result['packets'], 15)
+        self.assertEqual(result['restarts'], 1)
+        self.assertEqual(len(sv._workers), 2)
+        self.assertNotIn(pid, sv._workers)
+        self.assertEqual(sorted(sv._buffers),
+            sorted(fd for index, fd in sv._workers.values()))
+        sv.stopWorkers()
+        self.assertEqual(sv._workers, {})
+        self.assertEqual(sv._buffers, {})
+        self.assertEqual(sv._stats, {})
+
+    def test_killWorkers(self):
+        sv = self.supervisor
+        for index in range(sv.count):
+            sv.spawn(index)
+        self.waitStats('packets', 10)
+        # workers, which are not stopped in time, are killed
+        sv.stopWorkers(0)
+        self.assertEqual(sv._workers, {})
+        self.assertEqual(sv._buffers, {})
+        self.assertEqual(sv.getStats()['packets'], 10)
@@ -14,6 +14,9 @@ from struct import pack
 class NeedMoreDataException(Exception):
     pass
 
+class FrameTooLargeException(Exception):
+    pass
+
 # ---------------------------------------------------------------------------
 
 def dictCheckItem(data, name, value):
@@ -6,21 +6,34 @@
 """
 
 from datetime import datetime
-from threading import Thread
+from threading import Thread, Lock, RLock
 from kernel.config import conf
 from kernel.logger import log
 
 from kombu import BrokerConnection, Exchange, Queue
+from kombu.pools import producers
 
 import re
 import json
 import time
+import queue
+import atexit
+import socket
+from weakref import WeakValueDictionary
 #import hashlib
 
 COMMAND_STATUS_CREATED = 1
 COMMAND_STATUS_SUCCESS = 2
 COMMAND_STATUS_ERROR = 3
 
+# retry policy of the pooled producer (reconnect on connection errors)
+PUBLISH_RETRY_POLICY = {
+    'interval_start': 0,
+    'interval_step': 1,
+    'interval_max': 10,
+    'max_retries': 30
+}
+
 class MessageBroker:
     """
      RabbitMQ message broker
@@ -28,6 +41,9 @@ class MessageBroker:
 
     _exchanges = None
     _commands = None
+    _connection = None
+    _declared = None
+    _handlers = None
 
     def __init__(self):
         """
@@ -35,6 +51,13 @@ class MessageBroker:
         """
         log.debug('%s::__init__()', self.__class__)
         self._commands = {}
+        self._commandsLock = Lock()
+        self._handlers = {}
+        self._handlersUids = {}
+        self._handlersLock = RLock()
+        self._connection = None
+        self._declared = set()
+        self._lock = Lock()
         self._exchanges = {
             'mon.device': Exchange('mon.device', 'topic', durable = True),
             'n.work': Exchange('n.work', 'topic', durable = True)
@@ -47,6 +70,44 @@ class MessageBroker:
         """
         return 'mon.device.packet.create.%s' % imei
 
+    def getConnection(self):
+        """
+         Returns broker connection shared by the whole process.
+         Connection is established lazily by the producers pool
+         and re-established automatically after errors.
+         @return: BrokerConnection instance
+        """
+        with self._lock:
+            if self._connection is None:
+                self._connection = BrokerConnection(conf.amqpConnection)
+            return self._connection
+
+    def publish(self, producer, body, exchange, routingKey, queue):
+        """
+         Publishes message via pooled producer.
+         Queue is declared only once per process for each routing key,
+         so publishing of the next messages is a single frame write
+         @param producer: kombu Producer instance
+         @param body: message body
+         @param exchange: Exchange instance
+         @param routingKey: str
+         @param queue: Queue instance to declare
+        """
+        declare = []
+        with self._lock:
+            if routingKey not in self._declared:
+                declare = [queue]
+        producer.publish(
+            body,
+            exchange = exchange,
+            routing_key = routingKey,
+            declare = declare,
+            retry = True,
+            retry_policy = PUBLISH_RETRY_POLICY
+        )
+        with self._lock:
+            self._declared.add(routingKey)
+
     def send(self, packets, routing_key = None, exchangeName = None):
         """
          Sends packets to the message broker
@@ -54,91 +115,128 @@ class MessageBroker:
          @param routing_key: str
          @param exchangeName: str
         """
+        self.sendBatch([packets], routing_key, exchangeName)
+
+    def sendBatch(self, batch, routing_key = None, exchangeName = None):
+        """
+         Sends several lists of packets to the message broker
+         using one producer. Every list is processed like a separate
+         send() call, so packets of different lists are not mixed
+         @param batch: list of lists of dict
+         @param routing_key: str
+         @param exchangeName: str
+         @return: list of lists of dict, which are not sent.
+           Packets of partially sent list are not returned
+        """
         exchange = self._exchanges['mon.device']
         if (exchangeName is not None) and (exchangeName in self._exchanges):
             exchange = self._exchanges[exchangeName]
 
+        sent = 0
+        progress = [0]
         try:
-            with BrokerConnection(conf.amqpConnection) as conn:
-                log.debug('BROKER: Connect to %s' % conf.amqpConnection)
-                conn.connect()
-                connChannel = conn.channel()
-                queuesConfig = {}
-
-                # spike-nail START
-                timePrev = None
-                # spike-nail END
-
-                reUid = re.compile('[\w-]+')
-                for packet in packets:
-                    uid = None if 'uid' not in packet else packet['uid']
-
-                    # we should check uid for correctness
-                    uidIsCorrect = uid is not None and reUid.match(uid)
-
-                    timeCurr = None
-                    if 'time' in packet:
-                        timeCurr = packet['time']
-
-                    if uidIsCorrect and uid in queuesConfig:
-                        config = queuesConfig[uid]
-                    else:
-                        routingKey = routing_key
-                        if not routing_key:
-                            if not uidIsCorrect: continue # skip incorrect uid
-                            routingKey = self.getRoutingKey(uid)
-
-                        routingKey = conf.environment + '.' + routingKey
-                        config = {
-                            'routingKey': routingKey,
-                            'queue': Queue(
-                                routingKey,
-                                exchange = exchange,
-                                routing_key = routingKey
-                            )
-                        }
-                        if uidIsCorrect:
-                            queuesConfig[uid] = config
+            connection = self.getConnection()
+            with producers[connection].acquire(block = True) as producer:
+                log.debug('BROKER: Producer acquired for %s',
+                    conf.amqpConnection)
+                for packets in batch:
+                    progress[0] = 0
+                    self.publishPackets(producer, packets,
+                        routing_key, exchange, progress)
+                    sent += 1
+        except Exception as E:
+            # queues could be lost together with the connection,
+            # so we should declare them again
+            with self._lock:
+                self._declared.clear()
+            log.error('Error during packet send: %s', E)
+        log.debug('BROKER: Producer released')
+        remaining = batch[sent:]
+        if remaining and progress[0]:
+            # published packets of the list are not sent again
+            remaining[0] = remaining[0][progress[0]:]
+        return remaining
+
+    def publishPackets(self, producer, packets, routing_key, exchange,
+            progress = None):
+        """
+         Publishes list of packets via supplied producer
+         @param producer: kombu Producer instance
+         @param packets: list of dict
+         @param routing_key: str
+         @param exchange: Exchange instance
+         @param progress: list, first item of which is set to count
+           of processed packets of the list
+        """
+        if progress is None:
+            progress = [0]
+        queuesConfig = {}
+
+        # spike-nail START
+        timePrev = None
+        # spike-nail END
+
+        reUid = re.compile('[\w-]+')
+        for index, packet in enumerate(packets):
+            progress[0] = index
+            uid = None if 'uid' not in packet else packet['uid']
+
+            # we should check uid for correctness
+            uidIsCorrect = uid is not None and reUid.match(uid)
+
+            timeCurr = None
+            if 'time' in packet:
+                timeCurr = packet['time']
+
+            if uidIsCorrect and uid in queuesConfig:
+                config = queuesConfig[uid]
+            else:
+                routingKey = routing_key
+                if not routing_key:
+                    if not uidIsCorrect: continue # skip incorrect uid
+                    routingKey = self.getRoutingKey(uid)
+
+                routingKey = conf.environment + '.' + routingKey
+                config = {
+                    'routingKey': routingKey,
+                    'queue': Queue(
+                        routingKey,
+                        exchange = exchange,
+                        routing_key = routingKey
+                    )
+                }
+                if uidIsCorrect:
+                    queuesConfig[uid] = config
+
+            # spike-nail START
+            if timePrev and timeCurr:
+                fmtDate = "%Y-%m-%dT%H:%M:%S.%f"
+                t1 = datetime.strptime(timeCurr, fmtDate)
+                t2 = datetime.strptime(timePrev, fmtDate)
+                if t2 > t1:
+                    tt = t1
+                    t1 = t2
+                    t2 = tt
+                if (t1 - t2).seconds < 10:
+                    log.debug('Skip packet with time = ' + timeCurr)
+                    continue # skip this packet if it's too close
+            # spike-nail END
+
+            self.publish(producer, packet, exchange,
+                config['routingKey'], config['queue'])
+            if uid:
+                msg = 'Packet for "%s" is sent. ' % uid
+                if 'time' in packet:
+                    msg += 'packet[\'time\'] = ' + timeCurr
 
                     # spike-nail START
-                    if timePrev and timeCurr:
-                        fmtDate = "%Y-%m-%dT%H:%M:%S.%f"
-                        t1 = datetime.strptime(timeCurr, fmtDate)
-                        t2 = datetime.strptime(timePrev, fmtDate)
-                        if t2 > t1:
-                            tt = t1
-                            t1 = t2
-                            t2 = tt
-                        if (t1 - t2).seconds < 10:
-                            log.debug('Skip packet with time = ' + timeCurr)
-                            continue # skip this packet if it's too close
+                    timePrev = packet['time']
                     # spike-nail END
 
-                    with conn.Producer(channel = connChannel) as producer:
-                        conn.ensure_connection()
-                        producer.publish(
-                            packet,
-                            exchange = exchange,
-                            routing_key = config['routingKey'],
-                            declare = [config['queue']],
-                            retry = True
-                        )
-                    if uid:
-                        msg = 'Packet for "%s" is sent. ' % uid
-                        if 'time' in packet:
-                            msg += 'packet[\'time\'] = ' + timeCurr
-
-                            # spike-nail START
-                            timePrev = packet['time']
-                            # spike-nail END
-
-                        log.debug(msg)
-                    else:
-                        log.debug('Message is sent via message broker')
-                conn.release()
-        except Exception as E:
-            log.error('Error during packet send: %s', E)
-        log.debug('BROKER: Disconnected')
+                log.debug(msg)
+            else:
+                log.debug('Message is sent via message broker')
+        progress[0] = len(packets)
 
     def amqpCommandUpdate(self, handler, status, data):
         """
@@ -167,7 +265,8 @@ class MessageBroker:
         }
 
         log.debug("[%s] Sending answer: %s", handler.handlerId, answer_update)
-        self.send([answer_update], routing_key = "mon.device.command.update")
+        handler.runBlocking(lambda: self.send([answer_update],
+            routing_key = "mon.device.command.update"))
         self.clearCommand(command)
 
     def sendAmqpAnswer(self, handler, data):
@@ -188,39 +287,18 @@ class MessageBroker:
 
     def getCommands(self, handler):
         """
-         Receives packets from the message broker.
-         Runs until receives packet or timeout passes
+         Returns command for the handler from local mailbox.
+         Commands are put into mailbox by the shared command thread,
+         so there is no communication with message broker here
          @param handler: AbstractHandler
-         @return: received packets
+         @return: received command or None
         """
-        content = None
-        try:
-            with BrokerConnection(conf.amqpConnection) as conn:
-                routing_key = conf.environment + '.mon.device.command.' + \
-                    str(handler.uid)
-                log.debug('[%s] Check commands queue %s',
-                    handler.handlerId, routing_key)
-                command_queue = Queue(
-                    routing_key,
-                    exchange = self._exchanges['mon.device'],
-                    routing_key = routing_key)
-
-                conn.connect()
-                with conn.Consumer([command_queue],
-                    callbacks = [self.onCommand]):
-                    conn.ensure_connection()
-                    conn.drain_events(timeout = 1)
-                    command = self.getCommand(handler)
-                    if command:
-                        log.debug('[%s] We got command: %s',
-                            handler.handlerId, command)
-                        content = command
-                    else:
-                        log.debug('[%s] No commands found', handler.handlerId)
-                conn.release()
-        except Exception as E:
-            log.error('[%s] %s', handler.handlerId, E)
-        return content
+        command = self.getCommand(handler)
+        if command:
+            log.debug('[%s] We got command: %s', handler.handlerId, command)
+        else:
+            log.debug('[%s] No commands found', handler.handlerId)
+        return command
 
     def onCommand(self, body, message):
         """
@@ -241,9 +319,10 @@ class MessageBroker:
         if isinstance(command, str):
             command = json.loads(command)
         uid = command["uid"]
-        if uid not in self._commands:
-            self._commands[uid] = {}
-        self._commands[uid][command['guid']] = command
+        with self._commandsLock:
+            if uid not in self._commands:
+                self._commands[uid] = {}
+            self._commands[uid][command['guid']] = command
         return command
 
     def getCommand(self, handler):
@@ -251,9 +330,11 @@ class MessageBroker:
          Returns an AMQP message from local buffer
          @param handler: AbstractHandler
         """
-        if (handler.uid in self._commands) and self._commands[handler.uid]:
-            for guid in self._commands[handler.uid]:
-                return self._commands[handler.uid][guid]
+        with self._commandsLock:
+            commands = self._commands.get(handler.uid)
+            if commands:
+                for guid in commands:
+                    return commands[guid]
         return None
 
     def clearCommand(self, command):
@@ -263,8 +344,11 @@ class MessageBroker:
         """
         uid = command['uid']
         guid = command['guid']
-        if (uid in self._commands) and (guid in self._commands[uid]):
-            del self._commands[uid][guid]
+        with self._commandsLock:
+            if (uid in self._commands) and (guid in self._commands[uid]):
+                del self._commands[uid][guid]
+                if not self._commands[uid]:
+                    del self._commands[uid]
 
     def handlerInitialize(self, handler):
         """
@@ -272,13 +356,35 @@ class MessageBroker:
          @param handler: AbstractHandler
          @return:
         """
+        if handler.uid:
+            self.handlerUpdate(handler)
 
     def handlerUpdate(self, handler):
         """
-         Update of handler
+         Update of handler.
+         Handlers of connected devices are registered by uid, so commands
+         for these devices are delivered to them as soon as they arrive
          @param handler: AbstractHandler
          @return:
         """
+        thread = handler.getThread()
+        if not thread or not getattr(thread, 'receivesCommands', True):
+            # handlers without connection (or of replayed connection)
+            # can not receive commands
+            return
+        uid = handler.uid
+        with self._handlersLock:
+            prevUid = self._handlersUids.get(handler.handlerId)
+            if prevUid == uid:
+                return
+            self.handlerFinalize(handler)
+            if not uid:
+                return
+            self._handlersUids[handler.handlerId] = uid
+            if uid not in self._handlers:
+                self._handlers[uid] = WeakValueDictionary()
+            self._handlers[uid][handler.handlerId] = handler
+            commandThread.subscribe(uid)
 
     def handlerFinalize(self, handler):
         """
@@ -286,6 +392,172 @@ class MessageBroker:
          @param handler: AbstractHandler
          @return:
         """
+        with self._handlersLock:
+            uid = self._handlersUids.pop(handler.handlerId, None)
+            if uid is None or uid not in self._handlers:
+                return
+            handlers = self._handlers[uid]
+            handlers.pop(handler.handlerId, None)
+            if not handlers:
+                del self._handlers[uid]
+                commandThread.unsubscribe(uid)
+                # commands of disconnected device are not kept
+                with self._commandsLock:
+                    self._commands.pop(uid, None)
+
+    def getHandlers(self, uid):
+        """
+         Returns list of connected handlers of the device
+         @param uid: Device identifier
+         @return: list of AbstractHandler
+        """
+        with self._handlersLock:
+            handlers = self._handlers.get(uid)
+            if not handlers:
+                return []
+            return list(handlers.values())
+
+    def commandReceived(self, command):
+        """
+         Stores command into mailbox and notifies connected handlers.
+         Command is not stored if device is not connected
+         @param command: Command object as dict or string
+         @return: bool False if there are no handlers of the device
+        """
+        if isinstance(command, str):
+            command = json.loads(command)
+        with self._handlersLock:
+            handlers = self.getHandlers(command['uid'])
+            if not handlers:
+                return False
+            self.storeCommand(command)
+        for handler in handlers:
+            handler.commandReceived()
+        return True
+
+# --------------------------------------------------------------------
+
+# overflow policies of the publish queue
+OVERFLOW_BLOCK = 'block' # wait until there is a free space in queue
+OVERFLOW_SPILL = 'spill' # reject packets, handler saves data to storage
+OVERFLOW_DROP = 'drop'   # reject packets, they are lost
+
+class MessageBrokerPublisher:
+    """
+     Asynchronous publisher of device packets.
+     Packets from all connections are put into bounded queue and published
+     by a dedicated thread in batches, so socket threads do not wait for
+     the message broker
+    """
+
+    _queue = None
+    _thread = None
+    retryInterval = 1 # seconds between attempts to publish failed batch
+
+    def __init__(self, batchSize = 100, flushInterval = 50,
+            queueSize = 10000, overflow = OVERFLOW_BLOCK):
+        """
+         Constructor
+         @param batchSize: int Max count of packets published at once
+         @param flushInterval: int Max time (ms) packets wait in batch
+         @param queueSize: int Max count of packet lists in queue
+         @param overflow: str Policy when queue is full (block|spill|drop)
+        """
+        log.debug('%s::__init__()', self.__class__)
+        self.batchSize = batchSize
+        self.flushInterval = flushInterval
+        self.overflow = overflow
+        self._queue = queue.Queue(queueSize)
+        self._lock = Lock()
+
+    def start(self):
+        """
+         Starts publisher thread (if it is not started yet)
+        """
+        with self._lock:
+            if self._thread is None:
+                self._thread = Thread(target = self.threadHandler)
+                self._thread.daemon = True
+                self._thread.start()
+                atexit.register(self.stop)
+
+    def stop(self):
+        """
+         Stops publisher thread, remaining packets are published
+        """
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join(10)
+            self._thread = None
+
+    def put(self, packets):
+        """
+         Puts packets into publish queue
+         @param packets: list of dict
+         @return: bool False if packets are rejected because of overflow
+        """
+        self.start()
+        if self.overflow == OVERFLOW_BLOCK:
+            self._queue.put(packets)
+            return True
+        try:
+            self._queue.put_nowait(packets)
+        except queue.Full:
+            log.error('Publish queue is full, %s packets are rejected',
+                len(packets))
+            return False
+        return True
+
+    def threadHandler(self):
+        """
+         Thread handler. Collects packets into batches and publishes them
+         when batchSize is reached or flushInterval is passed
+        """
+        log.debug('%s::started', self.__class__)
+        stopped = False
+        batch = []
+        while not stopped:
+            if not batch:
+                packets = self._queue.get()
+                if packets is None:
+                    break
+                batch = [packets]
+            count = sum(len(packets) for packets in batch)
+            deadline = time.time() + self.flushInterval / 1000
+            while count < self.batchSize:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    packets = self._queue.get(timeout = timeout)
+                except queue.Empty:
+                    break
+                if packets is None:
+                    stopped = True
+                    break
+                batch.append(packets)
+                count += len(packets)
+            batch = self.flush(batch)
+            if batch and not stopped:
+                # lists which are not published are sent with next batch
+                time.sleep(self.retryInterval)
+        if batch:
+            log.error('Publisher is stopped, %s packet lists are lost',
+                len(batch))
+        log.debug('%s::stopped', self.__class__)
+
+    def flush(self, batch):
+        """
+         Publishes collected batch
+         @param batch: list of lists of dict
+         @return: list of lists of dict, which are not published
+        """
+        log.debug('Publishing batch of %s packet lists', len(batch))
+        try:
+            return broker.sendBatch(batch)
+        except Exception as E:
+            log.error('Error during batch publish: %s', E)
+            return batch
 
 # --------------------------------------------------------------------
 
@@ -358,8 +630,354 @@ class MessageBrokerThread:
 
 class MessageBrokerCommandThread:
     """
-     Message broker thread for receiving AMQP commands for particular device
+     Message broker thread for receiving AMQP commands for connected devices.
+     There is one consumer per process, queues of devices are added to it
+     and removed from it when devices connect and disconnect
     """
-    pass
 
-broker = MessageBroker()
\ No newline at end of file
+    _queues = None
+    _thread = None
+
+    def __init__(self):
+        """
+         Constructor
+        """
+        log.debug('%s::__init__()', self.__class__)
+        self._queues = {}
+        self._queuesNew = []
+        self._queuesOld = []
+        self._lock = Lock()
+
+    def getQueue(self, uid):
+        """
+         Returns commands queue of the device
+         @param uid: Device identifier
+         @return: Queue instance
+        """
+        routingKey = conf.environment + '.mon.device.command.' + str(uid)
+        return Queue(
+            routingKey,
+            exchange = broker._exchanges['mon.device'],
+            routing_key = routingKey
+        )
+
+    def start(self):
+        """
+         Starts consumer thread (if it is not started yet)
+        """
+        with self._lock:
+            if self._thread is None:
+                self._thread = Thread(target = self.threadHandler)
+                self._thread.daemon = True
+                self._thread.start()
+
+    def subscribe(self, uid):
+        """
+         Starts consuming commands of the device
+         @param uid: Device identifier
+        """
+        with self._lock:
+            if uid in self._queues:
+                return
+            queue = self.getQueue(uid)
+            self._queues[uid] = queue
+            self._queuesNew.append(queue)
+        log.debug('Commands of %s are subscribed', uid)
+        self.start()
+
+    def unsubscribe(self, uid):
+        """
+         Stops consuming commands of the device
+         @param uid: Device identifier
+        """
+        with self._lock:
+            queue = self._queues.pop(uid, None)
+            if queue is None:
+                return
+            if queue in self._queuesNew:
+                self._queuesNew.remove(queue)
+            else:
+                self._queuesOld.append(queue)
+        log.debug('Commands of %s are unsubscribed', uid)
+
+    def updateQueues(self, consumer):
+        """
+         Applies subscription changes to the consumer
+         @param consumer: Consumer instance
+        """
+        with self._lock:
+            queuesNew = self._queuesNew
+            queuesOld = self._queuesOld
+            self._queuesNew = []
+            self._queuesOld = []
+        for queue in queuesOld:
+            consumer.cancel_by_queue(queue.name)
+        if queuesNew:
+            for queue in queuesNew:
+                consumer.add_queue(queue)
+            consumer.consume()
+
+    def threadHandler(self):
+        """
+         Thread handler
+        """
+        while True:
+            try:
+                with BrokerConnection(conf.amqpConnection) as conn:
+                    conn.ensure_connection()
+                    log.debug('CommandThread::Connected to %s',
+                        conf.amqpConnection)
+                    with self._lock:
+                        queues = list(self._queues.values())
+                        self._queuesNew = []
+                        self._queuesOld = []
+                    with conn.Consumer(queues,
+                            callbacks = [self.onCommand]) as consumer:
+                        while True:
+                            self.updateQueues(consumer)
+                            try:
+                                conn.drain_events(timeout = 1)
+                            except socket.timeout:
+                                pass
+            except Exception as E:
+                log.error('CommandThread::%s', E)
+                time.sleep(10) # sleep for 10 seconds after exception
+
+    def onCommand(self, body, message):
+        """
+         Executes when command is received from queue
+         @param body: amqp message body
+         @param message: message instance
+        """
+        log.debug('CommandThread::Received command = %s', body)
+        try:
+            if not broker.commandReceived(body):
+                # device is disconnected, command is left in its queue
+                # (consumer of the queue is cancelled by updateQueues())
+                message.requeue()
+                return
+        except Exception as E:
+            log.error('CommandThread::%s', E)
+        message.ack()
+
+broker = MessageBroker()
+commandThread = MessageBrokerCommandThread()
+publisher = MessageBrokerPublisher(
+    conf.publishBatchSize,
+    conf.publishFlushInterval,
+    conf.publishQueueSize,
+    conf.publishOverflow
+)
+
+def resetAfterFork():
+    """
+     Resets broker state inherited from the parent process.
+     Threads are not copied by fork(), and sockets of the parent
+     must not be shared, so the child process opens its own connection
+     and starts its own publisher and command threads on demand
+    """
+    producers.clear()
+    broker._connection = None
+    broker._declared = set()
+    broker._lock = Lock()
+    broker._commandsLock = Lock()
+    broker._handlersLock = RLock()
+    publisher._thread = None
+    publisher._lock = Lock()
+    publisher._queue = queue.Queue(publisher._queue.maxsize)
+    commandThread._thread = None
+    commandThread._lock = Lock()
+    commandThread._queues = {}
+    commandThread._queuesNew = []
+    commandThread._queuesOld = []
+
+# ===========================================================================
+# TESTS
+# ===========================================================================
+
+import unittest
+import kombu.transport.memory # avoid concurrent imports by test threads
+class TestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.broker = MessageBroker()
+        self.broker._connection = BrokerConnection('memory://')
+
+    def getMessages(self, routingKey):
+        routingKey = conf.environment + '.' + routingKey
+        queue = Queue(routingKey,
+            exchange = self.broker._exchanges['mon.device'],
+            routing_key = routingKey)
+        messages = []
+        with BrokerConnection('memory://') as conn:
+            with conn.SimpleQueue(queue) as simpleQueue:
+                while True:
+                    try:
+                        message = simpleQueue.get(block = False)
+                    except simpleQueue.Empty:
+                        break
+                    messages.append(message.payload)
+                    message.ack()
+        return messages
+
+    def test_sendReusesConnection(self):
+        b = self.broker
+        connection = b.getConnection()
+        b.send([{'uid': 'test-uid-1', 'time': '2013-02-01T10:15:20.000000'}])
+        b.send([{'uid': 'test-uid-1', 'time': '2013-02-01T10:25:20.000000'}])
+        self.assertIs(b.getConnection(), connection)
+        routingKey = b.getRoutingKey('test-uid-1')
+        self.assertEqual(b._declared,
+            set([conf.environment + '.' + routingKey]))
+        messages = self.getMessages(routingKey)
+        self.assertEqual(len(messages), 2)
+        self.assertEqual(messages[1]['time'], '2013-02-01T10:25:20.000000')
+
+    def test_sendSkipsIncorrectUid(self):
+        b = self.broker
+        b.send([{'uid': '!!!'}, {'time': '2013-02-01T10:15:20.000000'}])
+        self.assertEqual(len(b._declared), 0)
+
+    def test_sendBatchRemaining(self):
+        b = self.broker
+        publishPackets = b.publishPackets
+        def failedPublish(producer, packets, routing_key, exchange,
+                progress):
+            if packets[0]['uid'] == 'test-uid-3':
+                raise ConnectionError('Connection is lost')
+            publishPackets(producer, packets, routing_key, exchange,
+                progress)
+        b.publishPackets = failedPublish
+        batch = [[{'uid': 'test-uid-2'}], [{'uid': 'test-uid-3'}],
+            [{'uid': 'test-uid-4'}]]
+        self.assertEqual(b.sendBatch(batch), batch[1:])
+        self.assertEqual(b.sendBatch(batch[:1]), [])
+
+    def test_sendBatchPartially(self):
+        b = self.broker
+        publish = b.publish
+        def failedPublish(producer, body, exchange, routingKey, queue):
+            if body['uid'] == 'test-uid-6':
+                raise ConnectionError('Connection is lost')
+            publish(producer, body, exchange, routingKey, queue)
+        b.publish = failedPublish
+        batch = [[{'uid': 'test-uid-5'}, {'uid': 'test-uid-6'},
+            {'uid': 'test-uid-7'}], [{'uid': 'test-uid-8'}]]
+        # published packet of the list is not returned to be sent again
+        self.assertEqual(b.sendBatch(batch), [batch[0][1:], batch[1]])
+        self.assertEqual(len(self.getMessages(
+            b.getRoutingKey('test-uid-5'))), 1)
+
+class PublisherTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.batches = []
+        self.publisher = MessageBrokerPublisher(3, 20, 3, OVERFLOW_DROP)
+        self.publisher.flush = self.batches.append
+
+    def tearDown(self):
+        self.publisher.stop()
+
+    def test_flushByCount(self):
+        p = self.publisher
+        p._queue.put([{'uid': '1'}, {'uid': '1'}])
+        p._queue.put([{'uid': '2'}])
+        p._queue.put([{'uid': '3'}])
+        p.start()
+        p.stop()
+        self.assertEqual(self.batches, [
+            [[{'uid': '1'}, {'uid': '1'}], [{'uid': '2'}]],
+            [[{'uid': '3'}]]
+        ])
+
+    def test_flushByTime(self):
+        p = self.publisher
+        self.assertTrue(p.put([{'uid': '1'}]))
+        time.sleep(0.2)
+        self.assertEqual(self.batches, [[[{'uid': '1'}]]])
+
+    def test_overflowDrop(self):
+        p = self.publisher
+        p._thread = True # do not start publisher thread
+        self.assertTrue(p.put([{'uid': '1'}]))
+        self.assertTrue(p.put([{'uid': '2'}]))
+        self.assertTrue(p.put([{'uid': '3'}]))
+        self.assertFalse(p.put([{'uid': '4'}]))
+        p._thread = None
+
+    def test_flushRetry(self):
+        p = self.publisher
+        p.retryInterval = 0
+        def flush(batch):
+            self.batches.append(batch)
+            # first list is sent, the rest is failed once
+            return batch[1:] if len(self.batches) == 1 else []
+        p.flush = flush
+        p._queue.put([{'uid': '1'}])
+        p._queue.put([{'uid': '2'}])
+        p._queue.put([{'uid': '3'}])
+        p.start()
+        p.stop()
+        self.assertEqual(self.batches, [
+            [[{'uid': '1'}], [{'uid': '2'}], [{'uid': '3'}]],
+            [[{'uid': '2'}], [{'uid': '3'}]]
+        ])
+
+class CommandTestHandler:
+    """ Handler stub for command delivery tests """
+    def __init__(self, uid):
+        self.handlerId = 'test' + uid
+        self.uid = uid
+        self.received = 0
+    def getThread(self):
+        return True
+    def commandReceived(self):
+        self.received += 1
+
+class CommandThreadTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.amqpConnection = conf.amqpConnection
+        conf.amqpConnection = 'memory://'
+        broker._connection = None
+
+    def tearDown(self):
+        conf.amqpConnection = self.amqpConnection
+        broker._connection = None
+
+    def test_commandDelivery(self):
+        handler = CommandTestHandler('test-cmd-uid')
+        broker.handlerUpdate(handler)
+        self.assertEqual(broker.getHandlers('test-cmd-uid'), [handler])
+        self.assertIn('test-cmd-uid', commandThread._queues)
+        command = {
+            'uid': 'test-cmd-uid',
+            'guid': 'test-cmd-guid',
+            'command': 'get_imei',
+            'transport': 'tcp'
+        }
+        broker.send([command], routing_key = 'mon.device.command.test-cmd-uid')
+        for i in range(50):
+            if handler.received: break
+            time.sleep(0.1)
+        self.assertEqual(handler.received, 1)
+        self.assertEqual(broker.getCommands(handler), command)
+        broker.clearCommand(command)
+        self.assertIsNone(broker.getCommands(handler))
+        broker.send([command], routing_key = 'mon.device.command.test-cmd-uid')
+        for i in range(50):
+            if handler.received > 1: break
+            time.sleep(0.1)
+        broker.handlerFinalize(handler)
+        self.assertEqual(broker.getHandlers('test-cmd-uid'), [])
+        self.assertNotIn('test-cmd-uid', commandThread._queues)
+        # commands of disconnected device are not kept
+        self.assertNotIn('test-cmd-uid', broker._commands)
+        self.assertFalse(broker.commandReceived(command))
+        self.assertNotIn('test-cmd-uid', broker._commands)
+
+    def test_handlerWithoutConnection(self):
+        handler = CommandTestHandler('test-cmd-uid2')
+        handler.getThread = lambda: None
+        broker.handlerUpdate(handler)
+        self.assertEqual(broker.getHandlers('test-cmd-uid2'), [])
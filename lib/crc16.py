@@ -15,8 +15,17 @@ Stolen from:
      Modbus starts with a CRC of 0xFFFF, which DF1 starts with 0x0000.
      The module below uses a 256-word look-up table of partially prepared
      answers to greatly reduce the system load.
+
+Checksums used by handlers are available by name (see checksum()):
+  modbus - CRC-16 Modbus (reflected 0x8005, initial 0xFFFF)
+  df1    - CRC-16 DF1 (reflected 0x8005, initial 0x0000)
+  ccitt  - CRC-16 CCITT (0x1021, initial 0xFFFF)
+  kermit - CRC-16 Kermit (reflected 0x1021, initial 0x0000, bytes swapped)
 '''
 
+import sys
+import binascii
+from array import array
 from ctypes import c_ushort
 
 INITIAL_MODBUS = 0xFFFF
@@ -186,6 +195,132 @@ class Crc16(object):
 
         return crcValue
 
+# ===========================================================================
+# Checksum registry
+# ===========================================================================
+
+MODBUS = 'modbus'
+DF1 = 'df1'
+CCITT = 'ccitt'
+KERMIT = 'kermit'
+
+_checksums = {}
+
+def register(name, function):
+    """
+     Registers checksum function
+     @param name: Name of the checksum
+     @param function: Function, which accepts bytes and returns checksum
+    """
+    _checksums[name] = function
+
+def getChecksum(name):
+    """
+     Returns checksum function by its name
+     @param name: Name of the checksum
+     @return: Function, which accepts bytes and returns checksum
+    """
+    try:
+        return _checksums[name]
+    except KeyError:
+        raise ValueError('Unknown checksum: %s' % name)
+
+def checksum(name, data):
+    """
+     Calculates checksum of data
+     @param name: Name of the checksum (MODBUS, DF1, CCITT, KERMIT)
+     @param data: bytes, bytearray or memoryview
+     @return: int
+    """
+    return getChecksum(name)(data)
+
+# ---------------------------------------------------------------------------
+
+class ReflectedCrc16(object):
+    """
+     Table-driven reflected CRC-16, which processes two bytes per step.
+     Table of 65536 words is built on the first call
+    """
+
+    def __init__(self, polynomial, initial):
+        """
+         Constructor
+         @param polynomial: Reflected polynomial (0xA001 for Modbus/DF1)
+         @param initial: Initial value of CRC
+        """
+        self.polynomial = polynomial
+        self.initial = initial
+        self._table = None
+        self._table16 = None
+
+    def _buildTables(self):
+        """
+         Builds byte and word look-up tables
+        """
+        table = []
+        for i in range(256):
+            crc = i
+            for j in range(8):
+                if crc & 1:
+                    crc = (crc >> 1) ^ self.polynomial
+                else:
+                    crc >>= 1
+            table.append(crc)
+        # crc of two bytes depends only on (crc ^ word)
+        self._table16 = array('H', ((table[x & 0xFF] >> 8) ^
+            table[((x >> 8) ^ table[x & 0xFF]) & 0xFF]
+            for x in range(0x10000)))
+        self._table = table
+
+    def __call__(self, data):
+        """
+         Calculates CRC of data
+         @param data: bytes, bytearray or memoryview
+         @return: int
+        """
+        if self._table16 is None:
+            self._buildTables()
+        table16 = self._table16
+        crc = self.initial
+        length = len(data)
+        even = length & ~1
+        # memoryview items are bytes, so words are read from raw data
+        words = array('H')
+        words.frombytes(data[:even])
+        if sys.byteorder == 'big':
+            words.byteswap()
+        for word in words:
+            crc = table16[crc ^ word]
+        if even < length:
+            crc = (crc >> 8) ^ self._table[(crc ^ data[even]) & 0xFF]
+        return crc
+
+# table of bit-reversed bytes
+_REVERSED = bytes(int('{:08b}'.format(i)[::-1], 2) for i in range(256))
+
+def calcCCITT(data):
+    """
+     CRC-16 CCITT (binascii implementation)
+     @param data: bytes, bytearray or memoryview
+     @return: int
+    """
+    return binascii.crc_hqx(data, 0xFFFF)
+
+def calcKermit(data):
+    """
+     CRC-16 Kermit with swapped bytes.
+     Kermit is reflected CCITT, so CRC of reflected bytes is reflected back
+     @param data: bytes, bytearray or memoryview
+     @return: int
+    """
+    crc = binascii.crc_hqx(bytes(data).translate(_REVERSED), 0)
+    return (_REVERSED[crc >> 8] << 8) | _REVERSED[crc & 0xFF]
+
+register(MODBUS, ReflectedCrc16(0xA001, INITIAL_MODBUS))
+register(DF1, ReflectedCrc16(0xA001, INITIAL_DF1))
+register(CCITT, calcCCITT)
+register(KERMIT, calcKermit)
+
 # ===========================================================================
 # TESTS
 # ===========================================================================
@@ -233,5 +368,42 @@ class TestCase(unittest.TestCase):
             b'\x24\x24\x00\x11\x35\x96\x28\x01\x76\x31\x68\x50\x00'
         ), 0x2753)
 
+    def test_checksum(self):
+        self.assertEqual(checksum(MODBUS, b'\xEA\x03\x00\x00\x00\x64'),
+            0x3A53)
+        self.assertEqual(checksum(MODBUS, b'\x4b\x03\x00\x2c\x00\x37'),
+            0xbfcb)
+        self.assertEqual(checksum(DF1, b'\x07\x11\x41\x00\x53\xB9' +
+            b'\x00' * 12 + b'\x03'), 0x4C6B)
+        self.assertEqual(checksum(CCITT,
+            b'\x24\x24\x00\x11\x13\x61\x23\x45\x67\x8f\xff\x50\x00'),
+            0x05D8)
+        self.assertEqual(checksum(KERMIT, memoryview(
+            b'\x24\x24\x00\x11\x35\x96\x28\x01\x76\x31\x68\x50\x00')),
+            0x2753)
+        self.assertRaises(ValueError, checksum, 'unknown', b'')
+
+    def test_checksumMemoryview(self):
+        data = b'\x01\x03\x00\x00\x00\x0a\x55'
+        self.assertEqual(checksum(MODBUS, memoryview(data)), 0x6ccd)
+        self.assertEqual(checksum(DF1, memoryview(data)), 0x6cd6)
+        for name in _checksums:
+            for length in range(len(data) + 1):
+                self.assertEqual(checksum(name, memoryview(data)[:length]),
+                    checksum(name, data[:length]))
+
+    def test_checksumLegacy(self):
+        import random
+        rnd = random.Random(16)
+        for length in range(0, 70):
+            data = bytes(rnd.randrange(256) for i in range(length))
+            self.assertEqual(checksum(MODBUS, data),
+                Crc16.calcBinaryString(data, INITIAL_MODBUS))
+            self.assertEqual(checksum(DF1, data),
+                Crc16.calcBinaryString(data, INITIAL_DF1))
+            self.assertEqual(checksum(CCITT, data), Crc16.calcCCITT(data))
+            self.assertEqual(checksum(KERMIT, data),
+                Crc16.calcCCITT_Kermit(data))
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
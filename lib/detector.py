@@ -0,0 +1,171 @@
+# -*- coding: utf8 -*-
+'''
+@project   Maprox <http://www.maprox.net>
+@info      Protocol auto-detection for handlers sharing one port
+@copyright 2013, Maprox LLC
+'''
+
+from kernel.utils import NeedMoreDataException
+from kernel.logger import log
+from lib.handler import AbstractHandler
+
+# max count of bytes received before the protocol is detected
+DETECT_MAX_LENGTH = 64
+
+# ---------------------------------------------------------------------------
+
+class DetectorHandler(AbstractHandler):
+    """
+     Protocol auto-detection handler.
+     Collects first bytes of the connection, finds the handler
+     of the protocol (see AbstractHandler.detect()) and passes
+     all data of the connection to it
+    """
+    handlers = [] # handler classes to choose from, in order of priority
+
+    def initialization(self):
+        """
+         Initialization of the handler.
+         Detector is not registered in the broker, the chosen handler is
+        """
+        self._handler = None
+        self._detectBuffer = b''
+
+    def finalization(self):
+        pass
+
+    @classmethod
+    def detectHandlerClass(cls, data):
+        """
+         Returns handler class of the protocol of data.
+         First handler, which accepts data, is chosen
+         @param data: First bytes received from device
+         @return: Handler class or None if protocol is unknown
+         @raise NeedMoreDataException: if data is too short to decide
+        """
+        needMoreData = False
+        for handlerClass in cls.handlers:
+            try:
+                if handlerClass.detect(data):
+                    return handlerClass
+            except NeedMoreDataException:
+                needMoreData = True
+        if needMoreData and len(data) < DETECT_MAX_LENGTH:
+            raise NeedMoreDataException('Not enough data to detect protocol')
+        return None
+
+    def processData(self, data):
+        """
+         Processing of data from socket.
+         Data is buffered until the protocol is detected
+         @param data: Data from socket
+        """
+        if self._handler:
+            return self._handler.receiveData(data)
+        self._detectBuffer += bytes(data)
+        try:
+            handlerClass = self.detectHandlerClass(self._detectBuffer)
+        except NeedMoreDataException:
+            log.info('[%s] Need more data to detect protocol...',
+                self.handlerId)
+            return self
+        if not handlerClass:
+            log.error('[%s] Unknown protocol, data = %s',
+                self.handlerId, self._detectBuffer)
+            self._detectBuffer = b''
+            self.getThread().request.close()
+            return self
+        log.debug('[%s] Protocol is detected: %s',
+            self.handlerId, handlerClass.__doc__)
+        data = self._detectBuffer
+        self._detectBuffer = None
+        self._handler = handlerClass(self.getStore(), self.getThread())
+        return self._handler.receiveData(data)
+
+    def processEvents(self):
+        """
+         Process some events while waiting for data from device
+        """
+        if self._handler:
+            self._handler.processEvents()
+
+def createDetectorClass(handlers):
+    """
+     Creates detector class for the handlers
+     @param handlers: list of handler classes
+     @return: DetectorHandler subclass
+    """
+    names = ', '.join((h.__doc__ or h.__name__).strip() for h in handlers)
+    return type('Handler', (DetectorHandler,), {
+        '__doc__': 'Auto-detection of ' + names,
+        'handlers': list(handlers)
+    })
+
+# ===========================================================================
+# TESTS
+# ===========================================================================
+
+import unittest
+import kernel.pipe as pipe
+from lib.handler import TestSocket, TestThread
+
+class TestCase(unittest.TestCase):
+
+    def setUp(self):
+        from lib.handlers.atrack.ax5 import Handler as AtrackHandler
+        from lib.handlers.autolink.default import Handler as AutolinkHandler
+        from lib.handlers.galileo.default import Handler as GalileoHandler
+        from lib.handlers.globalsat.tr203 import Handler as GlobalsatHandler
+        from lib.handlers.globusgps.gltr1mini import Handler as ImeHandler
+        from lib.handlers.naviset.gt20 import Handler as NavisetHandler
+        from lib.handlers.teltonika.fmxxxx import Handler as TeltonikaHandler
+        self.classes = {
+            'atrack': AtrackHandler,
+            'autolink': AutolinkHandler,
+            'galileo': GalileoHandler,
+            'globalsat': GlobalsatHandler,
+            'ime': ImeHandler,
+            'naviset': NavisetHandler,
+            'teltonika': TeltonikaHandler
+        }
+        self.detector = createDetectorClass(list(self.classes.values()))
+
+    def test_detect(self):
+        samples = {
+            'atrack': b'\xfe\x02\x00\x01A\x04\xd8\xdd\x8f(\x00\x01',
+            'autolink': b'\xff\x22\xf3\x0c\x45\xf5\xc9\x0f\x03\x00',
+            'galileo': b'\x01\x17\x80\x01\x82\x02\x10\x03' +
+                       b'868204005647838\x04\x32\x00',
+            'globalsat': b'GSr,011412001415649,3,3,00,,3,090713,' +
+                         b'081527,E03739.1968,N5547.6956,*6B!',
+            'ime': b"$$\x00\x115\x96(\x01v1hP\x00S'\r\n",
+            'naviset': b'\x12\x00\x01\x00012896001609129\x06\x9f\xb9',
+            'teltonika': b'\x00\x0f012896001609129'
+        }
+        for name, data in samples.items():
+            self.assertIs(self.detector.detectHandlerClass(data),
+                self.classes[name], name)
+
+    def test_detectNeedMoreData(self):
+        for data in [b'', b'$', b'\x00', b'\x00\x0f0128', b'\x12\x00\x01']:
+            self.assertRaises(NeedMoreDataException,
+                self.detector.detectHandlerClass, data)
+        self.assertIsNone(self.detector.detectHandlerClass(b'HELLO'))
+
+    def test_processData(self):
+        data = b'\x12\x00\x01\x00012896001609129\x06\x9f\xb9'
+        received = []
+        class NavisetHandler(self.classes['naviset']):
+            def processData(self, data):
+                received.append(data)
+        detector = createDetectorClass([self.classes['teltonika'],
+            NavisetHandler])
+        thread = TestThread(TestSocket([]))
+        handler = detector(pipe.TestManager(), thread)
+        handler.processData(data[:3])
+        self.assertIsNone(handler._handler)
+        handler.processData(memoryview(data[3:]))
+        self.assertIsInstance(handler._handler, NavisetHandler)
+        self.assertIs(handler._handler.getThread(), thread)
+        handler.processData(data)
+        self.assertEqual(received, [data, data])
@@ -6,6 +6,7 @@
 """
 
 from lib.commands import *
+from kernel.utils import NeedMoreDataException
 
 # ---------------------------------------------------------------------------
 
@@ -36,21 +37,59 @@ class AbstractPacketFactory(AbstractFactory):
     """
      Abstract packet factory
     """
+    # True if packets of the factory can be parsed from a memoryview
+    # (see lib.packets.BinaryPacket)
+    zeroCopy = False
+
     def getPacketsFromBuffer(self, data = None):
         """
          Returns an array of BasePacket instances from data
          @param data: Input binary data
          @return: array of BasePacket instances (empty array if no packet found)
         """
+        if self.zeroCopy and data:
+            return self.getPacketsFromView(memoryview(data))
         packets = []
         while True:
             packet = self.getInstance(data)
             if not packet: break
+            if packet.rawDataTail and len(packet.rawDataTail) == len(data):
+                # packet has not used any byte of the buffer
+                raise NeedMoreDataException('Not enough data in buffer')
             data = packet.rawDataTail
             packets.append(packet)
             if not data or len(data) == 0: break
         return packets
 
+    def getPacketsFromView(self, view):
+        """
+         Returns an array of BasePacket instances from memoryview.
+         Packets are read at the increasing offset of the view,
+         so the remaining buffer is never copied
+         @param view: memoryview of input binary data
+         @return: array of BasePacket instances (empty array if no packet found)
+        """
+        packets = []
+        offset = 0
+        while offset < len(view):
+            packet = self.getInstance(view[offset:])
+            if not packet: break
+            packets.append(packet)
+            if not packet.consumed: break
+            offset += packet.consumed
+        return packets
+
+    def getFrameLength(self, data):
+        """
+         Returns full length of the packet at the start of data,
+         reading only the head of the packet (see lib.framer).
+         Returns None if the length can not be determined this way
+         @param data: memoryview or bytes
+         @raise NeedMoreDataException: if data is shorter than packet head
+         @return: int
+        """
+        return None
+
 # ---------------------------------------------------------------------------
 
 class AbstractCommandFactory(AbstractFactory):
@@ -0,0 +1,190 @@
+# -*- coding: utf8 -*-
+'''
+@project   Maprox <http://www.maprox.net>
+@info      Incremental framer of the connection data
+@copyright 2013, Maprox LLC
+'''
+
+from kernel.logger import log
+from kernel.config import conf
+from kernel.utils import NeedMoreDataException, FrameTooLargeException
+
+# ---------------------------------------------------------------------------
+
+class PacketFramer(object):
+    """
+     Stateful framer of the connection data.
+     Data of a packet split across several reads is collected until
+     the whole frame is received, so the packet is parsed only once.
+     Length of the frame is read from the packet head
+     (see AbstractPacketFactory.getFrameLength()).
+     If the factory can not determine the length, the rest of the
+     buffer is parsed on every call, as before.
+    """
+
+    def __init__(self, factory, maxFrameSize = None):
+        """
+         Constructor
+         @param factory: AbstractPacketFactory instance
+         @param maxFrameSize: Maximum size of one frame in bytes
+        """
+        self.factory = factory
+        self.maxFrameSize = maxFrameSize or conf.maxFrameSize
+        self.frames = b''         # raw data of the last returned packets
+        self._buffer = bytearray()
+        self._frameLength = None  # length of the frame being collected
+
+    def __len__(self):
+        """
+         Returns count of buffered bytes which are not parsed yet
+        """
+        return len(self._buffer)
+
+    def reset(self):
+        """
+         Drops buffered data
+        """
+        del self._buffer[:]
+        self._frameLength = None
+
+    def feed(self, data):
+        """
+         Appends data to the buffer and returns packets of all complete
+         frames. Raw data of the returned packets is kept in self.frames
+         @param data: Binary data from socket / storage
+         @return: list of packets (empty if no complete frame yet)
+        """
+        self.frames = b''
+        self._buffer += data
+        if self._frameLength and len(self._buffer) < self._frameLength:
+            return []
+        try:
+            end, known = self._scan()
+            packets = []
+            if end:
+                self.frames = bytes(self._buffer[:end])
+                packets = self.factory.getPacketsFromBuffer(self.frames)
+        except Exception:
+            self.reset()
+            raise
+        del self._buffer[:end]
+        if not known:
+            try:
+                packets += self._parseRest()
+            except FrameTooLargeException:
+                self.reset()
+                raise
+        return packets
+
+    def _scan(self):
+        """
+         Finds complete frames at the start of the buffer
+         @return: tuple (length of complete frames, False if length
+           of the next frame can not be determined by the factory)
+        """
+        end = 0
+        size = len(self._buffer)
+        with memoryview(self._buffer) as view:
+            while end < size:
+                length = self._frameLength
+                if length is None:
+                    try:
+                        length = self.factory.getFrameLength(view[end:])
+                    except NeedMoreDataException:
+                        self._checkLength(size - end)
+                        break
+                    if length is None:
+                        return end, False
+                    self._checkLength(length)
+                    self._frameLength = length
+                if end + length > size:
+                    break
+                end += length
+                self._frameLength = None
+        return end, True
+
+    def _parseRest(self):
+        """
+         Parses the rest of the buffer, when length of its frames
+         is unknown. On errors the data is kept in the buffer
+         (with the frames of this call), so it can be completed
+         by the next portion of data
+         @return: list of packets
+        """
+        rest = bytes(self._buffer)
+        try:
+            packets = self.factory.getPacketsFromBuffer(rest)
+        except NeedMoreDataException:
+            self._checkLength(len(rest))
+            return []
+        except Exception:
+            self._buffer[:0] = self.frames
+            self.frames = b''
+            self._checkLength(len(self._buffer))
+            raise
+        self.frames += rest
+        self.reset()
+        return packets
+
+    def _checkLength(self, length):
+        """
+         Raises an exception if frame is too large
+         @param length: Length of the frame
+        """
+        if length > self.maxFrameSize:
+            log.error('Frame of %s bytes exceeds maximum size (%s)',
+                length, self.maxFrameSize)
+            raise FrameTooLargeException('Frame is too large: %s bytes' %
+                length)
+
+# ===========================================================================
+# TESTS
+# ===========================================================================
+
+import unittest
+class TestCase(unittest.TestCase):
+
+    def setUp(self):
+        from lib.handlers.naviset.packets import PacketFactory
+        self.factory = PacketFactory()
+        self.data = b'\x12\x00\x01\x00012896001609129\x06\x9f\xb9' + \
+                    b'\x12\x00\x22\x00012896001609129\x05$6'
+
+    def test_feedByChunks(self):
+        framer = PacketFramer(self.factory, 1024)
+        calls = []
+        getPackets = self.factory.getPacketsFromBuffer
+        def getPacketsFromBuffer(data):
+            calls.append(data)
+            return getPackets(data)
+        self.factory.getPacketsFromBuffer = getPacketsFromBuffer
+        packets = []
+        for i in range(0, len(self.data), 5):
+            packets += framer.feed(self.data[i:i + 5])
+        self.assertEqual(len(packets), 2)
+        self.assertEqual(packets[1].deviceNumber, 34)
+        self.assertEqual(len(framer), 0)
+        # every packet is parsed only once
+        self.assertEqual(calls, [self.data[:22], self.data[22:]])
+
+    def test_feedSeveralFrames(self):
+        framer = PacketFramer(self.factory, 1024)
+        packets = framer.feed(self.data + self.data[:3])
+        self.assertEqual(len(packets), 2)
+        self.assertEqual(framer.frames, self.data)
+        self.assertEqual(len(framer), 3)
+        packets = framer.feed(self.data[3:22])
+        self.assertEqual(len(packets), 1)
+        self.assertEqual(framer.frames, self.data[:22])
+
+    def test_frameTooLarge(self):
+        framer = PacketFramer(self.factory, 16)
+        self.assertRaises(FrameTooLargeException,
+            framer.feed, self.data[:4])
+        self.assertEqual(len(framer), 0)
+
+    def test_unknownFrameLength(self):
+        from lib.handlers.ime.packets import PacketFactory
+        framer = PacketFramer(PacketFactory(), 1024)
+        self.assertEqual(framer.feed(b'\x24\x24\x00\x11'), [])
+        self.assertEqual(len(framer), 4)
@@ -10,11 +10,16 @@ import os
 import binascii
 import base64
 import socket
+import select
 from kernel.utils import NeedMoreDataException
 from kernel.logger import log
 from kernel.config import conf
 from lib.broker import broker
+from lib.framer import PacketFramer
+from kernel.supervisor import stats
 
+# interval (in seconds) between processEvents() calls
+EVENTS_INTERVAL = 60
 
 class AbstractHandler(object):
     """
@@ -22,8 +27,13 @@ class AbstractHandler(object):
     """
     _packetsFactory = None # packets factory link
     _commandsFactory = None # commands factory link
+    _framer = None # incremental framer of the connection data
+    _recvBuffer = None # reusable receive buffer of the connection
+    _settings = 'settings' # configuration section of the handler settings
+    _signatures = () # first bytes of the protocol stream (see detect())
 
     _buffer = None # buffer of the current dispatch loop (for storage save)
+    _bufferSpilled = False # True if _buffer is already saved to storage
     _uid = None # identifier of currently connected device
 
     def __init__(self, store, clientThread):
@@ -82,16 +92,28 @@ class AbstractHandler(object):
         """ Returns clientThread object """
         return self.__thread
 
+    def getPort(self):
+        """
+         Returns port of the listener, which accepted the connection
+         @return: int (conf.port if it is unknown)
+        """
+        port = getattr(self.getThread(), 'port', None)
+        return conf.port if port is None else port
+
     def dispatch(self):
         """
           Data processing method (after validation) from the device:
           clientThread thread of the socket;
         """
         log.debug('[%s] dispatch()', self.handlerId)
-        buffer = self.recv()
+        buffer = self.recvInto()
         while len(buffer) > 0:
-            self.processData(buffer)
-            buffer = self.recv()
+            # framer of the packets factory copies data to its own buffer,
+            # other handlers can keep received data, so they get bytes
+            if not self._packetsFactory:
+                buffer = buffer.tobytes()
+            self.receiveData(buffer)
+            buffer = self.recvInto()
         log.debug('[%s] dispatch() - EXIT (empty buffer?)', self.handlerId)
 
     def needProcessCommands(self):
@@ -101,27 +123,48 @@ class AbstractHandler(object):
         """
         return self.uid
 
+    def receiveData(self, data):
+        """
+         Processing of data received from socket.
+         Handlers without packets factory get data as is, so it is kept
+         as buffer for storage save (see spillBuffer())
+         @param data: Data from socket
+        """
+        if self._packetsFactory:
+            return self.processData(data)
+        self._buffer = data
+        self._bufferSpilled = False
+        try:
+            return self.processData(data)
+        finally:
+            self._buffer = None
+
     def processData(self, data):
         """
          Processing of data from socket / storage.
          Must be overridden in child classes
          @param data: Data from socket
         """
+        stats.add('bytes', len(data))
         if self._packetsFactory:
             try:
-                if self._buffer is None:
-                    self._buffer = b''
-                self._buffer += data
-                protocolPackets = (
-                    self._packetsFactory.getPacketsFromBuffer(self._buffer)
-                )
+                if self._framer is None:
+                    self._framer = PacketFramer(self._packetsFactory)
+                protocolPackets = self._framer.feed(data)
+                stats.add('packets', len(protocolPackets))
+                self._buffer = self._framer.frames
+                self._bufferSpilled = False
                 for protocolPacket in protocolPackets:
                     self.processProtocolPacket(protocolPacket)
                 self._buffer = None
+                if len(self._framer) > 0:
+                    log.info('[%s] Need more data...', self.handlerId)
+                    return
             except NeedMoreDataException as E:
                 log.info('[%s] Need more data...', self.handlerId)
                 return
             except Exception as E:
+                self._buffer = None
                 log.error("[%s] processData error: %s", self.handlerId, E)
 
         log.debug('[%s] Checking handler commands', self.handlerId)
@@ -140,32 +183,47 @@ class AbstractHandler(object):
         """
         pass
 
-    def recv(self):
+    def recvInto(self):
         """
-         Receiving data from socket
-         @return: String representation of data
+         Receiving data from socket into the reusable buffer
+         of the connection (without allocation of new bytes)
+         @return: memoryview of received data, valid until the next call
         """
-
-        sock = self.getThread().request
-        sock.settimeout(60) # timeout eq. 5 seconds
-        total_data = []
+        if self._recvBuffer is None:
+            self._recvBuffer = memoryview(bytearray(conf.socketPacketLength))
+        thread = self.getThread()
+        sock = thread.request
+        sock.settimeout(EVENTS_INTERVAL)
+        wakeup = getattr(thread, 'wakeup', None)
         while True:
+            self.processScheduled()
             try:
-                data = sock.recv(conf.socketPacketLength)
+                if wakeup and not self.waitData(sock, wakeup):
+                    continue
+                size = sock.recv_into(self._recvBuffer)
             except socket.timeout:
                 self.processEvents()
                 continue
             except Exception as E:
                 log.debug('[%s] %s', self.handlerId, E)
-                break
-            log.debug('[%s] Data chunk = %s', self.handlerId, data)
-            total_data.append(data)
-            # I don't know why [if not data: break] is not working,
-            # so let's do break here
-            if len(data) < conf.socketPacketLength: break
-        log.debug('[%s] Total data = %s', self.handlerId, total_data)
+                size = 0
+            break
+        log.debug('[%s] Data chunk of %s bytes', self.handlerId, size)
+        return self._recvBuffer[:size]
 
-        return b''.join(total_data)
+    def waitData(self, sock, wakeup):
+        """
+         Waits for data from device or for callbacks scheduled for
+         the connection (wakeup socket of clientThread.schedule())
+         @param sock: Socket of the connection
+         @param wakeup: Wakeup socket
+         @return: True if there is data from device
+         @raise socket.timeout: if nothing happens for EVENTS_INTERVAL
+        """
+        ready = select.select([sock, wakeup], [], [], EVENTS_INTERVAL)[0]
+        if not ready:
+            raise socket.timeout('No data from device')
+        return sock in ready
 
     def send(self, data):
         """
@@ -187,6 +245,31 @@ class AbstractHandler(object):
         """
         pass
 
+    def runBlocking(self, function, callback = None):
+        """
+         Calls blocking function (database, message broker).
+         With asyncio server function is called out of the event loop
+         (see clientThread.runInExecutor()), otherwise it is called
+         immediately
+         @param function: callable
+         @param callback: callable, which is called with the result
+        """
+        runInExecutor = getattr(self.getThread(), 'runInExecutor', None)
+        if runInExecutor:
+            return runInExecutor(function, callback)
+        result = function()
+        if callback:
+            callback(result)
+
+    def processScheduled(self):
+        """
+         Calls callbacks, which are scheduled for the connection
+         by other threads (see clientThread.schedule())
+        """
+        runScheduled = getattr(self.getThread(), 'runScheduled', None)
+        if runScheduled:
+            runScheduled()
+
     def store(self, packets):
         """
          Sends a list of packets to store
@@ -199,8 +282,22 @@ class AbstractHandler(object):
         else:
             errorsList = result.getErrorsList()
             log.error('[%s] store():\n %s', self.handlerId, errorsList)
+            if conf.publishOverflow == 'spill':
+                self.spillBuffer()
         return result
 
+    def spillBuffer(self):
+        """
+         Saves raw data of the current dispatch loop to the storage,
+         so it can be restored later (when packets could not be sent)
+        """
+        if not self._buffer or not self.uid or self._bufferSpilled:
+            return
+        from lib.storage import getStorage
+        log.info('[%s] Spill data of %s to storage', self.handlerId, self.uid)
+        getStorage(self.getPort()).save(self.uid, self._buffer)
+        self._bufferSpilled = True
+
     def translate(self, data):
         """
          Translate gps-tracker data to observer pipe format
@@ -269,10 +366,20 @@ class AbstractHandler(object):
          @param defaultValue: Default value if key is not found
          @return: mixed
         """
-        if conf.has_section('settings'):
-            section = conf['settings']
-            return section.get(key, defaultValue)
-        return defaultValue
+        return self.getConfigSection().get(key, defaultValue)
+
+    def getConfigSection(self):
+        """
+         Returns settings of the handler.
+         Options of the handler section (see lib.handlers.list)
+         override options of [settings] section
+         @return: dict
+        """
+        section = {}
+        for name in ['settings', self._settings]:
+            if conf.has_section(name):
+                section.update(conf[name])
+        return section
 
     def processCommands(self):
         """
@@ -289,6 +396,23 @@ class AbstractHandler(object):
         except Exception as E:
             log.error('[%s] %s', self.handlerId, E)
 
+    def commandReceived(self):
+        """
+         Executes when new command for current device is put into
+         the broker mailbox. Commands are processed in the context
+         of the connection (see clientThread.schedule())
+        """
+        thread = self.getThread()
+        if thread:
+            thread.schedule(self.processCommandsIfNeeded)
+
+    def processCommandsIfNeeded(self):
+        """
+         Processing commands if we can process them now
+        """
+        if self.needProcessCommands():
+            self.processCommands()
+
     def processCommand(self, command):
         """
          Processing AMQP command
@@ -384,6 +508,27 @@ class AbstractHandler(object):
     #    log.debug('%s::initAmqpCommandThread()', self.__class__)
     #    MessageBrokerCommandThread(self)
 
+    @classmethod
+    def detect(cls, data):
+        """
+         Checks if the first bytes of the connection belong to the
+         protocol of the handler. Used for auto-detection of the protocol
+         when several handlers share one port (see lib.detector).
+         By default data is compared with signatures of the handler
+         @param data: First bytes received from device
+         @return: True if data belongs to the protocol
+         @raise NeedMoreDataException: if data is too short to decide
+        """
+        needMoreData = False
+        for signature in cls._signatures:
+            if data[:len(signature)] == signature:
+                return True
+            if len(data) < len(signature) and signature.startswith(data):
+                needMoreData = True
+        if needMoreData:
+            raise NeedMoreDataException('Not enough data to detect protocol')
+        return False
+
     @classmethod
     def initAmqpThread(cls, protocol):
         """
@@ -393,3 +538,86 @@ class AbstractHandler(object):
         # start message broker thread for receiving sms commands
         from lib.broker import MessageBrokerThread
         MessageBrokerThread(cls, protocol)
+
+# ===========================================================================
+# TESTS
+# ===========================================================================
+
+import unittest
+
+class TestSocket(object):
+    """
+     Socket stub which returns supplied chunks of data
+    """
+    def __init__(self, chunks):
+        self.chunks = list(chunks)
+
+    def settimeout(self, value):
+        pass
+
+    def recv_into(self, buffer):
+        if not self.chunks:
+            raise ConnectionResetError('Connection is closed')
+        chunk = self.chunks.pop(0)
+        if isinstance(chunk, Exception):
+            raise chunk
+        buffer[:len(chunk)] = chunk
+        return len(chunk)
+
+class TestThread(object):
+    """
+     Client thread stub
+    """
+    def __init__(self, request):
+        self.request = request
+
+class TestCase(unittest.TestCase):
+
+    def setUp(self):
+        import kernel.pipe as pipe
+        from lib.handlers.naviset.packets import PacketFactory
+        self.data = b'\x12\x00\x01\x00012896001609129\x06\x9f\xb9' + \
+                    b'\x12\x00\x22\x00012896001609129\x05$6'
+        self.chunks = [self.data[:5], self.data[5:30], self.data[30:]]
+        self.handler = AbstractHandler(pipe.TestManager(),
+            TestThread(TestSocket(self.chunks)))
+        self.handler._packetsFactory = PacketFactory()
+        self.packets = []
+        self.handler.processProtocolPacket = self.packets.append
+
+    def test_recvInto(self):
+        data = self.handler.recvInto()
+        self.assertIsInstance(data, memoryview)
+        self.assertEqual(data, self.chunks[0])
+        buffer = self.handler._recvBuffer
+        self.handler.recvInto()
+        # the same buffer is used for every read
+        self.assertIs(self.handler._recvBuffer, buffer)
+        self.assertEqual(len(self.handler.recvInto()), 14)
+        self.assertEqual(len(self.handler.recvInto()), 0)
+
+    def test_recvScheduled(self):
+        calls = []
+        thread = TestThread(TestSocket([socket.timeout(), b'data']))
+        thread.runScheduled = lambda: calls.append(len(calls))
+        self.handler.getThread = lambda: thread
+        # scheduled callbacks are called while waiting for data
+        self.assertEqual(self.handler.recvInto(), b'data')
+        self.assertEqual(calls, [0, 1])
+
+    def test_receiveRawData(self):
+        import kernel.pipe as pipe
+        buffers = []
+        handler = AbstractHandler(pipe.TestManager(),
+            TestThread(TestSocket([b'$raw,1\r\n'])))
+        handler.processData = lambda data: buffers.append(handler._buffer)
+        handler.dispatch()
+        # raw data is kept for spillBuffer() while it is processed
+        self.assertEqual(buffers, [b'$raw,1\r\n'])
+        self.assertIsNone(handler._buffer)
+
+    def test_dispatch(self):
+        self.handler.dispatch()
+        self.assertEqual(len(self.packets), 2)
+        self.assertEqual(self.packets[1].deviceNumber, 34)
+        self.assertEqual(self.packets[1].rawData, self.data[22:])
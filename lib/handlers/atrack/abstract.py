@@ -18,17 +18,18 @@ class AtrackHandler(AbstractHandler):
     """
      Base handler for ATrack protocol
     """
+    _signatures = (
+        b'\xFE\x02', # keep-alive packet
+        b'@P'        # binary position report
+    )
+
     def initialization(self):
         """
          Initialization of the handler
          @return:
         """
         super(AtrackHandler, self).initialization()
-        config = {}
-        if conf.has_section('settings'):
-            section = conf['settings']
-            for key in section.keys():
-                config[key] = section[key]
+        config = self.getConfigSection()
         self._packetsFactory = packets.PacketFactory(config)
 
     def processProtocolPacket(self, protocolPacket):
@@ -63,6 +63,15 @@ class PacketKeepAlive(BasePacket):
         # read header and length
         self._length = 10
 
+    @classmethod
+    def getFrameLength(cls, buffer):
+        """
+         Returns full length of the packet (it is fixed)
+         @param buffer: memoryview or bytes
+         @return: int
+        """
+        return calcsize(cls._fmtHeader) + 10
+
     def _parseBody(self):
         """
          Parses body of the packet
@@ -302,6 +311,9 @@ class PacketData(BasePacket):
         'SM': ('>H' 'speed_max')
     }
 
+    # compiled item schemas by (timeFormat, customInfo)
+    _itemSchemas = {}
+
     @property
     def unitId(self):
         if self._rebuild: self._build()
@@ -347,66 +359,47 @@ class PacketData(BasePacket):
         self.__sequenceId = seqId
         self.__unitId = str(unitId)
 
-        # store current offset
-        savedOffset = self._offset
-        self._offset = 0
-
+        schema, customAliases = self.getItemSchema()
         buffer = self._body[10:]
+        offset = 0
         self.__items = []
-        while self._offset < len(buffer):
-            item = {}
+        while offset < len(buffer):
+            record, offset = schema.read(buffer, offset)
+            item = {
+                'time': self.getTime(record['time']),
+                'time_rtc': self.getTime(record['time_rtc']),
+                'time_send': self.getTime(record['time_send']),
+                'longitude': record['longitude'] / 1000000,
+                'latitude': record['latitude'] / 1000000,
+                'azimuth': record['azimuth'],
+                'report_id': record['report_id'],
+                'odometer': record['odometer'] * 100,
+                'hdop': record['hdop'] / 10,
+                'speed': record['speed']
+            }
             sensor = {}
-            item['time'] = self.getTimeFromBuffer(buffer)
-            item['time_rtc'] = self.getTimeFromBuffer(buffer)
-            item['time_send'] = self.getTimeFromBuffer(buffer)
-            item['longitude'] = self.readFrom('>l', buffer) / 1000000
-            item['latitude'] = self.readFrom('>l', buffer) / 1000000
-            item['azimuth'] = self.readFrom('>H', buffer)
-            item['report_id'] = self.readFrom('>B', buffer)
-            item['odometer'] = self.readFrom('>L', buffer) * 100
-            item['hdop'] = self.readFrom('>H', buffer) / 10
-            dInp = self.readFrom('>B', buffer)
-            item['speed'] = self.readFrom('>H', buffer)
-            dOut = self.readFrom('>B', buffer)
             # digital inputs and outputs
+            dInp = record['dInp']
+            dOut = record['dOut']
             for i in range(0, 8):
                 sensor['din%d' % i] = int(bits.bitTest(dInp, i))
                 sensor['dout%d' % i] = int(bits.bitTest(dOut, i))
-
-            sensor['ain0'] = self.readFrom('>H', buffer)
-            sensor['driver_id'] =\
-                buffer[self._offset:].split(b'\x00')[0].decode()
-            self._offset += len(sensor['driver_id']) + 1
-            sensor['ext_temperature_0'] = self.readFrom('>h', buffer)
-            sensor['ext_temperature_1'] = self.readFrom('>h', buffer)
-            sensor['message'] =\
-                buffer[self._offset:].split(b'\x00')[0].decode()
-            self._offset += len(sensor['message']) + 1
-
-            # read custom information
-            fields = self.customInfo.split('%')
-            for field in fields:
-                if not field: continue
-                if field in self.customInfoTable:
-                    fmt, alias = self.customInfoTable[field]
-                    if fmt:
-                        sensor[alias] = self.readFrom(fmt, buffer)
-                    else:
-                        sensor[alias] =\
-                            buffer[self._offset:].split(b'\x00')[0].decode()
-                        self._offset += len(sensor[alias]) + 1
-                    if alias in ['can_total_fuel_consumption']:
-                        sensor[alias] /= 10
-                    if alias in ['ext_battery_voltage',
-                                 'int_battery_voltage']:
-                        sensor[alias] *= 100
+            for alias in ('ain0', 'driver_id', 'ext_temperature_0',
+                          'ext_temperature_1', 'message'):
+                sensor[alias] = record[alias]
+
+            # custom information
+            for alias in customAliases:
+                sensor[alias] = record[alias]
+                if alias in ['can_total_fuel_consumption']:
+                    sensor[alias] /= 10
+                if alias in ['ext_battery_voltage',
+                             'int_battery_voltage']:
+                    sensor[alias] *= 100
 
             item['sensors'] = sensor
             self.__items.append(item)
 
-        # restore offset
-        self._offset = savedOffset
-
     def _parseTail(self):
         """
          Parses packet tail
@@ -426,25 +419,56 @@ class PacketData(BasePacket):
          @return: int
         """
         buffer = pack('>H', self._length) + self._body
-        return crc16.Crc16.calcBinaryString(buffer, crc16.INITIAL_DF1)
+        return crc16.checksum(crc16.DF1, buffer)
+
+    def getItemSchema(self):
+        """
+         Returns schema of the position report item
+         according to timeFormat and customInfo
+         @return: tuple (Schema, list of aliases of custom information)
+        """
+        key = (self.timeFormat, self.customInfo)
+        if key not in self._itemSchemas:
+            fmtTime = 'L' if self.timeFormat == 0 else 'HBBBBB'
+            fields = [
+                ('time', fmtTime),
+                ('time_rtc', fmtTime),
+                ('time_send', fmtTime),
+                ('longitude', 'l'),
+                ('latitude', 'l'),
+                ('azimuth', 'H'),
+                ('report_id', 'B'),
+                ('odometer', 'L'),
+                ('hdop', 'H'),
+                ('dInp', 'B'),
+                ('speed', 'H'),
+                ('dOut', 'B'),
+                ('ain0', 'H'),
+                ('driver_id', Schema.STRING),
+                ('ext_temperature_0', 'h'),
+                ('ext_temperature_1', 'h'),
+                ('message', Schema.STRING)
+            ]
+            aliases = []
+            for field in self.customInfo.split('%'):
+                if not field: continue
+                if field in self.customInfoTable:
+                    fmt, alias = self.customInfoTable[field]
+                    fields.append((alias, fmt[1:] if fmt else Schema.STRING))
+                    aliases.append(alias)
+            self._itemSchemas[key] = (Schema(fields), aliases)
+        return self._itemSchemas[key]
 
-    def getTimeFromBuffer(self, buffer):
+    def getTime(self, value):
         """
-         Returns a datetime object read from buffer according to timeFormat
-         @param buffer:
+         Returns a datetime object according to timeFormat
+         @param value: Timestamp or tuple (year, month, day, hour, min, sec)
          @return: datetime
         """
         if self.timeFormat == 0:
-            return datetime.utcfromtimestamp(self.readFrom('>L', buffer))
+            return datetime.utcfromtimestamp(value)
         else:
-            return datetime(
-                self.readFrom('>H', buffer), # year
-                self.readFrom('>B', buffer), # month
-                self.readFrom('>B', buffer), # day
-                self.readFrom('>B', buffer), # hour
-                self.readFrom('>B', buffer), # minute
-                self.readFrom('>B', buffer)  # second
-            )
+            return datetime(*value)
 
 # ---------------------------------------------------------------------------
 
@@ -459,6 +483,13 @@ class PacketFactory(AbstractPacketFactory):
           @return: BasePacket instance
         """
         if data == None: return
+        return self.getClass(data)(data, self.config)
+
+    def getClass(self, data):
+        """
+          Returns a packet class by the prefix of data
+          @return: BinaryPacket class
+        """
         CLASS = None
         # read prefix
         pka_HeaderPrefix = PacketKeepAlive.headerPrefix
@@ -474,7 +505,19 @@ class PacketFactory(AbstractPacketFactory):
             CLASS = PacketData
         if not CLASS:
             raise Exception('Unknown packet structure')
-        return CLASS(data, self.config)
+        return CLASS
+
+    def getFrameLength(self, data):
+        """
+          Returns full length of the packet at the start of data
+          @return: int
+        """
+        if len(data) < 2:
+            raise NeedMoreDataException('Not enough data in buffer')
+        CLASS = self.getClass(data)
+        if not issubclass(CLASS, BasePacket):
+            return None
+        return CLASS.getFrameLength(data)
 
 # ===========================================================================
 # TESTS
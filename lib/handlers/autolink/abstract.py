@@ -21,6 +21,7 @@ class AutolinkHandler(AbstractHandler):
     __headPacketRawData = None # private buffer for headPacket data
     __imageReceivingConfig = None
     __packNum = 0
+    _signatures = (b'\xFF',) # head packet
 
     def initialization(self):
         """
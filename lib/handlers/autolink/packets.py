@@ -141,15 +141,17 @@ class Package(AutolinkPacket):
         """
         # It is sad that we don't know the length
         # of the packet, so let's determine it by parsing packets
-        buffer = self._rawData[2:]
+        view = memoryview(self._rawData)
+        offset = 2
         self.__packets = []
         self._length = 1
         while True:
-            packet = Packet(buffer)
-            buffer = packet.rawDataTail
+            packet = Packet(view[offset:])
+            offset += packet.consumed
             self.__packets.append(packet)
-            self._length += len(packet.rawData) # increase package length
-            if not buffer or (buffer[:1] == b'\x5d'): break
+            self._length += packet.consumed # increase package length
+            if offset >= len(view) or (view[offset:offset + 1] == b'\x5d'):
+                break
 
     @property
     def sequenceNum(self):
@@ -315,6 +317,7 @@ class PacketFactory(AbstractPacketFactory):
     """
      Packet factory
     """
+    zeroCopy = True
 
     @classmethod
     def getClass(cls, packetPrefix):
@@ -337,7 +340,7 @@ class PacketFactory(AbstractPacketFactory):
         if data is None: return
 
         # read packetId
-        packetPrefix = data[:1]
+        packetPrefix = bytes(data[:1])
 
         CLASS = self.getClass(packetPrefix)
         if not CLASS:
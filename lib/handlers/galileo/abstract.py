@@ -22,6 +22,7 @@ class GalileoHandler(AbstractHandler):
     __commands_num_seq = 0
     __imageReceivingConfig = None
     __packNum = 0
+    _signatures = (b'\x01',) # packet with tags
 
     # private buffer for headPacket data
     __headPacketRawData = None
@@ -51,6 +52,8 @@ class GalileoHandler(AbstractHandler):
         #    self.__packNum += 1
         #    self.sendInternalCommand("Makephoto 1")
 
+        # packet is acknowledged after its tags are parsed, so device
+        # sends it again if the packet can not be translated
         observerPackets = self.translate(protocolPacket)
         self.sendAcknowledgement(protocolPacket)
         if not self.__headPacketRawData:
@@ -278,6 +281,20 @@ class TestCase(unittest.TestCase):
         for packet in protocolPackets:
             self.assertEqual(packet.header, 1)
 
+    def test_ackAfterTranslate(self):
+        data = b'\x01"\x00\x03868204000728070\x042\x00' \
+             + b'\xe0\x00\x00\x00\x00\xe1\x08Photo ok\x137'
+        sent = []
+        h = self.handler
+        h.send = sent.append
+        def translate(packet):
+            raise ValueError('Incorrect packet')
+        h.translate = translate
+        packet = packets.Packet.getPacketsFromBuffer(data)[0]
+        # device sends packet again, if it is not translated
+        self.assertRaises(ValueError, h.processProtocolPacket, packet)
+        self.assertEqual(sent, [])
+
     def test_packetNewTracker(self):
         data = b'\x01\xaa\x03\x03868204001578425\x042\x00\x10\xe7\x04 ' + \
                b'$\x17\x11Q0\x10\x00\x00\x00\x00\x00\x00\x00\x003\x00' + \
@@ -25,10 +25,15 @@ class BasePacket(object):
     __length = 0
     __rawData = None
     __rawDataTail = None
+    __consumed = 0
     __body = None
     __crc = 0
     __convert = True
     __archive = False
+    _decoded = True
+
+    # public properties
+    lazy = False # parse body on first access (see decode())
 
     @classmethod
     def getPacketsFromBuffer(cls, data = None):
@@ -38,11 +43,13 @@ class BasePacket(object):
          @return array of BasePacket instances (empty array if no packet)
         """
         packets = []
+        view = memoryview(data)
+        offset = 0
         while True:
-            packet = cls(data)
-            data = packet.rawDataTail
+            packet = cls(view[offset:])
+            offset += packet.consumed
             packets.append(packet)
-            if len(data) == 0: break
+            if offset >= len(view): break
         return packets
 
     def __init__(self, data = None):
@@ -88,8 +95,14 @@ class BasePacket(object):
 
     @property
     def rawDataTail(self):
+        if isinstance(self.__rawDataTail, memoryview):
+            self.__rawDataTail = self.__rawDataTail.tobytes()
         return self.__rawDataTail
 
+    @property
+    def consumed(self):
+        return self.__consumed
+
     @property
     def rawData(self):
         if self.__convert: self.__build()
@@ -117,9 +130,22 @@ class BasePacket(object):
     @body.setter
     def body(self, value):
         self.__body = value
+        self._decoded = True
         self._parseBody(value)
         self.rebuild()
 
+    def decode(self):
+        """
+         Parses body of the lazy packet, if it is not parsed yet.
+         Header, length and crc of the lazy packet are checked at once,
+         body is parsed on first access to its fields
+         @return: self
+        """
+        if not self._decoded:
+            self._decoded = True
+            self._parseBody(self.__body)
+        return self
+
     def __parse(self):
         """
          Parses rawData
@@ -138,19 +164,20 @@ class BasePacket(object):
             raise NeedMoreDataException('Not enough data in buffer')
 
         crc = unpack("<H", buffer[length + 3:length + 5])[0]
-        crc_data = buffer[:length + 3]
+        crc_data = bytes(buffer[:length + 3])
         if not self.isCorrectCrc(crc_data, crc):
             raise Exception('Crc Is incorrect!')
 
         # now let's read packet data
         # but before this, check tagsdata length
-        body = buffer[3:length + 3]
+        body = crc_data[3:]
         if len(body) != length:
             raise Exception('Body length Is incorrect!')
 
         # apply new data
         self.__rawDataTail = buffer[length + 5:]
-        self.__rawData = buffer[:length + 5]
+        self.__rawData = bytes(buffer[:length + 5])
+        self.__consumed = length + 5
         self.__archive = archive
         self.__header = header
         self.__length = length
@@ -158,13 +185,17 @@ class BasePacket(object):
         self.__crc = crc
 
         # parse packet body
-        self._parseBody(body)
+        if self.lazy:
+            self._decoded = False
+        else:
+            self._parseBody(body)
 
     def __build(self):
         """
          Builds rawData from object variables
          @protected
         """
+        self.decode()
         self.__body = self._buildBody()
         self.__convert = False
         self.__header = self.__header
@@ -176,10 +207,7 @@ class BasePacket(object):
 
         self.__rawData = pack("<BH", self.__header, length)
         self.__rawData += self.__body
-        self.__crc = crc16.Crc16.calcBinaryString(
-          self.__rawData,
-          crc16.INITIAL_MODBUS
-        )
+        self.__crc = crc16.checksum(crc16.MODBUS, self.__rawData)
         self.__rawData += pack("<H", self.__crc)
 
     def _parseBody(self, data):
@@ -202,8 +230,7 @@ class BasePacket(object):
          @param crc: binary string
          @return: True if buffer crc equals to supplied crc value, else False
         """
-        crc_calculated = crc16.Crc16.calcBinaryString(
-          buffer, crc16.INITIAL_MODBUS)
+        crc_calculated = crc16.checksum(crc16.MODBUS, buffer)
         return crc == crc_calculated
 
     def __str__(self):
@@ -218,17 +245,23 @@ class Packet(BasePacket):
     _tags = None
     _tagsMap = None
 
+    # tags are parsed on first access
+    lazy = True
+
     @property
     def tags(self):
+        self.decode()
         return self._tags
 
     @tags.setter
     def tags(self, value):
+        self.decode()
         self._tags = value
         self.rebuild()
 
     @property
     def tagsMap(self):
+        self.decode()
         return self._tagsMap
 
     def isHalved(self, header):
@@ -289,6 +322,7 @@ class Packet(BasePacket):
          Returns True if packet has tag with number 'num'
          @param num: Number of packet tag
         """
+        self.decode()
         return num in self._tagsMap
 
     def getTag(self, num):
@@ -296,6 +330,7 @@ class Packet(BasePacket):
          Returns packet tag with number 'num'
          @param num: Number of packet tag
         """
+        self.decode()
         return self._tagsMap[num]
 
     def addTagInstance(self, tag):
@@ -303,6 +338,7 @@ class Packet(BasePacket):
          Adds a tag to the packet
          @param tag: tags.Tag instance
         """
+        self.decode()
         if (self._tags == None): self._tags = []
         self._tags.append(tag)
         self.rebuild()
@@ -318,11 +354,24 @@ class Packet(BasePacket):
         return self
 
 class PacketFactory(AbstractPacketFactory):
-    
+    zeroCopy = True
+
     def getInstance(self, data = None):
         if data == None: return
         return Packet(data)
 
+    def getFrameLength(self, data):
+        """
+          Returns full length of the packet at the start of data
+          @return: int
+        """
+        if len(data) < 3:
+            raise NeedMoreDataException('Not enough data in buffer')
+        header, length = unpack("<BH", data[:3])
+        if header == 1: # see Packet.isHalved()
+            length = bits.bitClear(length, 15)
+        return length + 5
+
 # ===========================================================================
 # TESTS
 # ===========================================================================
@@ -370,6 +419,9 @@ class TestCase(unittest.TestCase):
           b'\x01\x00\x00\x00\xe1\x08Photo ok\x13\xf6')
         self.assertEqual(packet.header, 1)
         self.assertEqual(packet.length, 34)
+        # tags are not parsed until they are needed
+        self.assertIsNone(packet._tags)
+        self.assertEqual(packet.crc, 0xf613)
         self.assertEqual(packet.hasTag(0x03), True)
         self.assertEqual(packet.hasTag(0xe2), False)
         self.assertEqual(packet.getTag(0xe1).getValue(), 'Photo ok')
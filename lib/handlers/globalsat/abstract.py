@@ -21,6 +21,7 @@ class GlobalsatHandler(AbstractHandler):
     """
      Base handler for Globalsat protocol
     """
+    _signatures = (b'GS',)
 
     reportFormat = "SPRXYAB27GHKLMmnaefghio*U!"
 
@@ -94,9 +95,9 @@ class GlobalsatHandler(AbstractHandler):
          @return:
         """
         super(GlobalsatHandler, self).initialization()
-        self._commandsFactory = CommandFactory()
+        self._commandsFactory = CommandFactory(self.getConfigSection())
         self.reportFormat = truncateChecksum(
-            conf.get('settings', "reportFormat"))
+            self.getConfigOption("reportFormat"))
         self.__compileRegularExpressions()
 
     def __compileRegularExpressions(self):
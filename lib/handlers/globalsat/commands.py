@@ -17,17 +17,21 @@ class GloblasatCommandConfigure(AbstractCommandConfigure):
     hostNameNotSupported = False
     """ True if protocol doesn't support dns hostname (only ip-address) """
 
+    settings = None
+    """ Settings of the handler (see CommandFactory) """
+
     def getSmsData(self, config):
         """
          Converts options to string
          @param config: request data
          @return: string
         """
-        initialConfig = conf.get('settings', 'initialConfig')
+        settings = self.settings or conf['settings']
+        initialConfig = settings['initialConfig']
         if initialConfig:
             initialConfig = ',' + initialConfig
         ret = "GSS,{0},3,0".format(config['identifier'])
-        ret += ',O3=' + conf.get('settings', 'reportFormat')
+        ret += ',O3=' + settings['reportFormat']
         ret += initialConfig
         ret += ',D1=' + str(config['gprs']['apn'] or '')
         ret += ',D2=' + str(config['gprs']['username'] or '')
@@ -175,10 +179,22 @@ class CommandCustom(GlobalsatCommand):
 
 class CommandFactory(AbstractCommandFactory):
     """
-     Command factory
+     Command factory.
+     Configuration of the factory is settings of the handler
     """
     module = __name__
 
+    def getInstance(self, data):
+        """
+          Returns a command instance by supplied data
+          @param data: dict command description
+          @return: AbstractCommand
+        """
+        command = super(CommandFactory, self).getInstance(data)
+        if command and self.config:
+            command.settings = self.config
+        return command
+
 # ===========================================================================
 # TESTS
 # ===========================================================================
@@ -206,6 +222,23 @@ class TestCase(unittest.TestCase):
                 ',D1=,D2=,D3=,E0=trx.maprox.net,E1=21202*0A!'
         }])
 
+    def test_handlerSettings(self):
+        factory = CommandFactory({
+            'reportFormat': 'SPRXYAB27GHKLMmnaefghiotuvwb*U!',
+            'initialConfig': ''
+        })
+        cmd = factory.getInstance({
+            'command': 'configure',
+            'params': {
+                "identifier": "0123456789012345",
+                "host": "trx.maprox.net",
+                "port": 21202
+            }
+        })
+        message = cmd.getData('sms')[0]['message']
+        self.assertTrue(message.startswith('GSS,0123456789012345,3,0,' +
+            'O3=SPRXYAB27GHKLMmnaefghiotuvwb*U!,D1=,'))
+
     def test_digitalOutputs(self):
         cmd = self.factory.getInstance({
             'command': 'activate_digital_output',
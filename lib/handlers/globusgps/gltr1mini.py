@@ -7,26 +7,25 @@
 
 from lib.handlers.ime.abstract import ImeHandler
 import lib.handlers.ime.packets as packets
-from lib.crc16 import Crc16
-
-# This is a spike-nail to substitute checksum calculation
-packets.ImeBase._fmtChecksum = '<H'
-packets.ImeBase.fnChecksum = Crc16.calcCCITT_Kermit
+import lib.crc16 as crc16
 
 class Handler(ImeHandler):
     """ Globusgps. GL-TR1-mini """
+    _packetsConfig = {
+        'checksumType': crc16.KERMIT,
+        'checksumFormat': '<H'
+    }
 
 # ===========================================================================
 # TESTS
 # ===========================================================================
 
 import unittest
+from struct import pack
 class TestCase(unittest.TestCase):
 
     def setUp(self):
-        packets.ImeBase.fnChecksum = Crc16.calcCCITT_Kermit
-        packets.ImeBase._fmtChecksum = '<H'
-        self.factory = packets.PacketFactory()
+        self.factory = packets.PacketFactory(Handler._packetsConfig)
 
     def test_checksumStrange(self):
         packetsList = self.factory.getPacketsFromBuffer(
@@ -49,6 +48,19 @@ class TestCase(unittest.TestCase):
         self.assertEqual(p.params['sensors']['sos'], 1)
 
 
+    def test_loginConfirm(self):
+        import kernel.pipe as pipe
+        sent = []
+        handler = Handler(pipe.TestManager(), None)
+        handler.send = sent.append
+        packet = self.factory.getPacketsFromBuffer(
+            b"$$\x00\x115\x96(\x01v1hP\x00S'\r\n")[0]
+        handler.sendAcknowledgement(packet)
+        # answer has checksum of the firmware, other handlers keep default
+        self.assertEqual(sent[0][-4:-2], pack('<H', crc16.checksum(
+            crc16.KERMIT, sent[0][:-4])))
+        self.assertEqual(packets.ImeBase.checksumType, crc16.CCITT)
+
     def test_nullPacket(self):
         packetsList = self.factory.getPacketsFromBuffer(
             b'\x00\x00$$\x00cE%0\x00@\x00p\x99U081724.000,A,5306.4757,N,04955.5630'
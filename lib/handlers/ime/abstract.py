@@ -17,6 +17,8 @@ class ImeHandler(AbstractHandler):
      Base handler for Ime protocol
     """
     __headPacketRawData = None  # private buffer for headPacket data
+    _signatures = (b'$$',)
+    _packetsConfig = {} # configuration of packets of the firmware
 
     def initialization(self):
         """
@@ -24,8 +26,8 @@ class ImeHandler(AbstractHandler):
          @return:
         """
         super(ImeHandler, self).initialization()
-        self._packetsFactory = packets.PacketFactory()
-        self._commandsFactory = commands.CommandFactory()
+        self._packetsFactory = packets.PacketFactory(self._packetsConfig)
+        self._commandsFactory = commands.CommandFactory(self._packetsConfig)
 
     def processProtocolPacket(self, protocolPacket):
         """
@@ -95,6 +97,7 @@ class ImeHandler(AbstractHandler):
         cmd = commands.ImeCommandLoginConfirm({
             'identifier': packet.deviceImei
         })
+        cmd.configure(self._packetsConfig)
         self.send(cmd.getData())
 
 # ===========================================================================
@@ -102,13 +105,10 @@ class ImeHandler(AbstractHandler):
 # ===========================================================================
 
 import unittest
-from lib.crc16 import Crc16
 
 
 class TestCase(unittest.TestCase):
     def setUp(self):
-        packets.ImeBase.fnChecksum = Crc16.calcCCITT_Kermit
-        packets.ImeBase._fmtChecksum = '<H'
         import kernel.pipe as pipe
 
         self.handler = ImeHandler(pipe.TestManager(), None)
\ No newline at end of file
@@ -113,20 +113,33 @@ class ImeCommandLoginConfirm(ImeCommand):
 
 class CommandFactory(AbstractCommandFactory):
     """
-     Command factory
+     Command factory.
+     Configuration of the factory is configuration of packets
+     (see packets.ImeBase.configure())
     """
     module = __name__
 
+    def getInstance(self, data):
+        """
+          Returns a command instance by supplied data
+          @param data: dict command description
+          @return: AbstractCommand
+        """
+        command = super(CommandFactory, self).getInstance(data)
+        if command:
+            command.configure(self.config)
+        return command
+
 # ===========================================================================
 # TESTS
 # ===========================================================================
 
 import unittest
-from lib.crc16 import Crc16
+import lib.crc16 as crc16
 class TestCase(unittest.TestCase):
 
     def setUp(self):
-        packets.ImeBase.fnChecksum = Crc16.calcCCITT
+        packets.ImeBase.checksumType = crc16.CCITT
         packets.ImeBase._fmtChecksum = '>H'
         self.factory = CommandFactory()
 
@@ -9,7 +9,7 @@ import binascii
 import re
 import inspect
 import sys
-from lib.crc16 import Crc16
+import lib.crc16 as crc16
 from lib.packets import *
 from lib.geo import Geo
 from lib.factory import AbstractPacketFactory
@@ -36,6 +36,19 @@ class ImeBase(BasePacket):
     __deviceImei = 0
     _command = 0        # expected command number
 
+    def configure(self, config):
+        """
+         Configuration.
+         Firmwares of the protocol use different checksums:
+           checksumType - name of the checksum (see lib.crc16)
+           checksumFormat - format of the checksum
+         @param config: dict
+        """
+        if not config:
+            return
+        self.checksumType = config.get('checksumType', self.checksumType)
+        self._fmtChecksum = config.get('checksumFormat', self._fmtChecksum)
+
     def _parseLength(self):
         """
          Parses packet length data.
@@ -67,16 +80,16 @@ class ImeBase(BasePacket):
         """
         return self._body[9:]
 
-    # public link to checksum calculation function
+    # name of the checksum, see lib.crc16.checksum()
     # (CRC-16 CCITT 0xFFFF by default)
-    fnChecksum = Crc16.calcCCITT
+    checksumType = crc16.CCITT
     def calculateChecksum(self):
         """
          Calculates CRC
          @return: True if buffer crc equals to supplied crc value, else False
         """
         data = (self._head or b'') + (self._body or b'')
-        return self.fnChecksum(data)
+        return crc16.checksum(self.checksumType, data)
 
     def _buildBody(self):
         """
@@ -298,11 +311,11 @@ class PacketFactory(AbstractPacketFactory):
         if not data:
             raise Exception('Packet is not found')
 
-        packet = ImePacket(data)
+        packet = ImePacket(data, self.config)
         for name, cls in inspect.getmembers(sys.modules[__name__]):
             if inspect.isclass(cls) and issubclass(cls, ImePacket):
                 if cls._command == packet.command:
-                    return cls(data)
+                    return cls(data, self.config)
 
         return None
 
@@ -315,7 +328,7 @@ from datetime import datetime
 class TestCase(unittest.TestCase):
 
     def setUp(self):
-        ImeBase.fnChecksum = Crc16.calcCCITT
+        ImeBase.checksumType = crc16.CCITT
         ImeBase._fmtChecksum = '>H'
         self.factory = PacketFactory()
         pass
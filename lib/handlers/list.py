@@ -5,21 +5,101 @@
 @copyright 2009-2013, Maprox LLC
 '''
 
+from collections import OrderedDict
 from kernel.logger import log
 from kernel.config import conf
+from lib.detector import createDetectorClass
 
-# Load modules
+# names of handlers, which AMQP command threads are started
+amqpHandlerNames = set()
+# handler classes of the listeners by their names (see getListeners())
+listenerClasses = OrderedDict()
+
+def initAmqpThread(handlerClass, handlerName):
+    """
+     Starts AMQP thread of the handler (commands sent to the protocol)
+     if it is not started yet
+     @param handlerClass: Handler class
+     @param handlerName: Name of the handler
+    """
+    if handlerName in amqpHandlerNames:
+        return
+    amqpHandlerNames.add(handlerName)
+    handlerClass.initAmqpThread(handlerName)
+
+def initAmqpThreads():
+    """
+     Starts AMQP threads of handlers of the listeners, e.g. in a worker
+     process, when listeners are read by the supervisor before fork()
+    """
+    for handlerName, handlerClass in list(listenerClasses.items()):
+        initAmqpThread(handlerClass, handlerName)
+
+def loadHandlerClass(handlerName, initAmqp = True):
+    """
+     Loads protocol handler class by its name.
+     If configuration has a section with the name of the handler,
+     the handler reads its settings from this section
+     @param handlerName: Name of the handler, for example "naviset.gt20"
+     @param initAmqp: If False, AMQP thread of the handler is not started,
+       e.g. when data is replayed by restore.py
+     @return: Handler class or None if it can not be loaded
+    """
+    handlerClassPath = "lib.handlers." + handlerName
+    try:
+        pkg = __import__(handlerClassPath, globals(), locals(), ['Handler'])
+        if not hasattr(pkg, 'Handler'):
+            log.error("Class 'Handler' in not found in module %s",
+                handlerClassPath)
+            return None
+        handlerClass = getattr(pkg, 'Handler')
+        if conf.has_section(handlerName):
+            handlerClass = type(handlerClass.__name__, (handlerClass,), {
+                '__doc__': handlerClass.__doc__,
+                '_settings': handlerName
+            })
+        if initAmqp:
+            initAmqpThread(handlerClass, handlerName)
+        log.info("Protocol is loaded: " + handlerClass.__doc__)
+        return handlerClass
+    except Exception as E:
+        log.error("Protocol '%s' loading error: %s", handlerClassPath, E)
+    return None
+
+def getListeners(initAmqp = True):
+    """
+     Returns list of protocol handlers with their ports.
+     Handlers are read from [listeners] section of configuration
+     (lines like "naviset.gt20=21120"), if there is no such section,
+     the only handler is settings/handler at general/port.
+     Handlers with the same port share one listener, protocol of
+     a connection is detected by its first bytes (see lib.detector)
+     @param initAmqp: If False, AMQP threads of handlers are not started
+     @return: list of tuples (HandlerClass, port)
+    """
+    if not conf.has_section('listeners'):
+        if not HandlerClass:
+            return []
+        listenerClasses[handlerName] = HandlerClass
+        if initAmqp:
+            initAmqpThread(HandlerClass, handlerName)
+        return [(HandlerClass, conf.port)]
+    ports = OrderedDict()
+    for name, port in conf.items('listeners'):
+        handlerClass = loadHandlerClass(name, initAmqp)
+        if handlerClass:
+            listenerClasses[name] = handlerClass
+            ports.setdefault(int(port), []).append(handlerClass)
+    listeners = []
+    for port, handlers in ports.items():
+        if len(handlers) > 1:
+            listeners.append((createDetectorClass(handlers), port))
+        else:
+            listeners.append((handlers[0], port))
+    return listeners
+
+# Load modules, AMQP thread of the handler is started by getListeners()
 HandlerClass = None
-handlerName = conf.get('settings', 'handler')
-handlerClassPath = "lib.handlers." + handlerName
-try:
-    pkg = __import__(handlerClassPath, globals(), locals(), ['Handler'])
-    if (hasattr(pkg, 'Handler')):
-        HandlerClass = getattr(pkg, 'Handler')
-        HandlerClass.initAmqpThread(handlerName)
-        log.info("Protocol is loaded: " + HandlerClass.__doc__)
-    else:
-        log.error("Class 'Handler' in not found in module %s",
-            handlerClassPath)
-except Exception as E:
-    log.error("Protocol '%s' loading error: %s", handlerClassPath, E)
+handlerName = conf.get('settings', 'handler', fallback = None)
+if handlerName:
+    HandlerClass = loadHandlerClass(handlerName, False)
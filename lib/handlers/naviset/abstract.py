@@ -6,9 +6,10 @@
 """
 
 from datetime import datetime
-from struct import pack
+from struct import pack, unpack
 
 from kernel.logger import log
+from kernel.utils import NeedMoreDataException
 from lib.handler import AbstractHandler
 import lib.handlers.naviset.packets as packets
 import lib.handlers.naviset.commands as commands
@@ -24,6 +25,7 @@ class NavisetHandler(AbstractHandler):
     __headPacketRawData = None # private buffer for headPacket data
     __imageReceivingConfig = None
     __packNum = 0
+    isHeadPacket = False # True if the last packet is a head packet
 
     def initialization(self):
         """
@@ -34,6 +36,23 @@ class NavisetHandler(AbstractHandler):
         self._packetsFactory = packets.PacketFactory()
         self._commandsFactory = commands.CommandFactory()
 
+    @classmethod
+    def detect(cls, data):
+        """
+         Checks if data starts with naviset head packet:
+         <length(2b, type bits = 0)><device number(2b)><imei(15b)>...
+         @param data: First bytes received from device
+         @return: True if data belongs to the protocol
+        """
+        if len(data) < 2:
+            raise NeedMoreDataException('Not enough data to detect protocol')
+        length = unpack('<H', bytes(data[:2]))[0]
+        if (length >> 14 != 0) or (length < 17):
+            return False
+        if len(data) < 19:
+            raise NeedMoreDataException('Not enough data to detect protocol')
+        return bytes(data[4:19]).isdigit()
+
     def processProtocolPacket(self, protocolPacket):
         """
          Process naviset packet.
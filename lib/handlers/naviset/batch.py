@@ -0,0 +1,240 @@
+# -*- coding: utf8 -*-
+'''
+@project   Maprox <http://www.maprox.net>
+@info      Naviset batch decoder of data items (requires NumPy)
+@copyright 2013, Maprox LLC
+'''
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# min count of data items in packet to decode them in batch
+BATCH_MIN_ITEMS = 16
+
+# fields of data item without additional data
+ITEM_FIELDS = [
+    ('number', '<u2'),
+    ('time', '<u4'),
+    ('satellitescount', 'u1'),
+    ('latitude', '<u4'),
+    ('longitude', '<u4'),
+    ('speed', '<u2'),
+    ('azimuth', '<u2'),
+    ('altitude', '<u2'),
+    ('hdop', 'u1')
+]
+
+# fields of additional data by bit of data structure word
+ADDITIONAL_FIELDS = {
+    0: [('status', 'u1')],
+    1: [('ext_battery_voltage', '<u2'), ('int_battery_voltage', '<u2')],
+    2: [('int_temperature', 'i1')],
+    3: [('din', 'u1'), ('dout', 'u1')],
+    4: [('ain0', '<u2'), ('ain1', '<u2')],
+    5: [('ain2', '<u2'), ('ain3', '<u2')],
+    6: [('ain4', '<u2'), ('ain5', '<u2')],
+    7: [('ain6', '<u2'), ('ain7', '<u2')],
+    8: [('ext_temperature_%d' % i, 'i1') for i in range(0, 4)],
+    9: [('ext_temperature_%d' % i, 'i1') for i in range(4, 8)],
+    10: [('ibutton_low', '<u2'), ('ibutton_high', '<u4')],
+    11: [('fin0', '<u2'), ('fin1', '<u2')],
+    12: [('omnicomm_fuel_0', '<u2'), ('omnicomm_fuel_1', '<u2')],
+    13: [('omnicomm_temperature_0', 'i1'),
+         ('omnicomm_temperature_1', 'i1')],
+    14: [('can_fuel', 'u1'), ('can_rpm', '<u2'),
+         ('can_coolant_temperature', 'i1')],
+    15: [('can_fuel_consumption', '<u4'), ('can_mileage', '<u4')]
+}
+
+# bits of protocol status
+STATUS_BITS = [
+    ('bad_ext_voltage', 0),
+    ('moving', 1),
+    ('armed', 2),
+    ('gsm_sim_card_1_enabled', 3),
+    ('gsm_sim_card_2_enabled', 4),
+    ('gsm_no_gprs_connection', 5)
+]
+
+# exact powers of ten to place the decimal point of coordinates
+_POWERS = [10 ** k for k in range(2, 11)]
+_SCALES = [10.0 ** k for k in range(0, 10)]
+
+_dtypes = {}
+
+def isAvailable():
+    """
+     Returns True if NumPy is installed
+     @return: bool
+    """
+    return numpy is not None
+
+def getDtype(ds):
+    """
+     Returns structured dtype of data item for the data structure word
+     @param ds: Data structure word
+     @return: numpy.dtype
+    """
+    if ds not in _dtypes:
+        fields = list(ITEM_FIELDS)
+        for key in range(0, 16):
+            if (ds >> key) & 1:
+                fields.extend(ADDITIONAL_FIELDS[key])
+        _dtypes[ds] = numpy.dtype(fields)
+    return _dtypes[ds]
+
+def convertCoordinates(values):
+    """
+     Converts coordinates as PacketDataItem.convertCoordinate()
+     does (decimal point after the second digit)
+     @param values: numpy array of unsigned integers
+     @return: list of floats
+    """
+    exponents = numpy.searchsorted(_POWERS, values, side = 'right')
+    scales = numpy.array(_SCALES)[exponents]
+    return (values.astype(numpy.float64) / scales).tolist()
+
+def getBits(values, bit):
+    """
+     Returns bit of values
+     @param values: numpy array of integers
+     @param bit: Number of the bit
+     @return: list of ints (0 or 1)
+    """
+    return ((values >> bit) & 1).tolist()
+
+def decodeItems(data, ds):
+    """
+     Decodes all data items of the packet at once.
+     Returns None if items can not be decoded in batch (NumPy is not
+     installed, packet is too small or its length is not multiple
+     of item length), then items must be parsed one by one
+     @param data: Data items buffer
+     @param ds: Data structure word
+     @return: list of tuples (rawData, number, params) or None
+    """
+    if numpy is None or not data:
+        return None
+    dtype = getDtype(ds)
+    count, rest = divmod(len(data), dtype.itemsize)
+    if rest or count < BATCH_MIN_ITEMS:
+        return None
+    records = numpy.frombuffer(bytes(data), dtype = dtype)
+    names = dtype.names
+    columns = {}
+    columns['time'] = records['time'].astype('datetime64[s]').tolist()
+    columns['satellitescount'] = records['satellitescount'].tolist()
+    columns['latitude'] = convertCoordinates(records['latitude'])
+    columns['longitude'] = convertCoordinates(records['longitude'])
+    columns['speed'] = (records['speed'] / 10).tolist()
+    columns['azimuth'] = numpy.round(
+        records['azimuth'] / 10).astype(numpy.int64).tolist()
+    columns['altitude'] = records['altitude'].tolist()
+    columns['hdop'] = (records['hdop'] / 10).tolist()
+
+    sensors = {}
+    if 'status' in names:
+        status = records['status']
+        for name, bit in STATUS_BITS:
+            sensors[name] = getBits(status, bit)
+        sensors['sat_antenna_connected'] = (1 - ((status >> 6) & 1)).tolist()
+    if 'din' in names:
+        for i in range(0, 8):
+            sensors['din%d' % i] = getBits(records['din'], i)
+            sensors['dout%d' % i] = getBits(records['dout'], i)
+    if 'ibutton_low' in names:
+        sensors['ibutton_0'] = (records['ibutton_low'].astype(numpy.int64) |
+            (records['ibutton_high'].astype(numpy.int64) << 16)).tolist()
+    if 'can_fuel' in names:
+        fuel = records['can_fuel'] * 0.4
+        sensors['can_fuel_percent'] = [100 if value > 100 else value
+            for value in fuel.tolist()]
+    if 'can_fuel_consumption' in names:
+        sensors['can_total_fuel_consumption'] = \
+            (records['can_fuel_consumption'] * 0.5).tolist()
+        sensors['can_total_mileage'] = \
+            (records['can_mileage'].astype(numpy.int64) * 5).tolist()
+    for name in names[len(ITEM_FIELDS):]:
+        if name.startswith('ext_temperature_'):
+            continue
+        if name in sensors or name in ('status', 'din', 'dout',
+                'ibutton_low', 'ibutton_high', 'can_fuel',
+                'can_fuel_consumption', 'can_mileage'):
+            continue
+        sensors[name] = records[name].tolist()
+    # temperatures lower than -100 are absent
+    temperatures = [(name, records[name].tolist())
+        for name in names if name.startswith('ext_temperature_')]
+
+    numbers = records['number'].tolist()
+    size = dtype.itemsize
+    result = []
+    for index in range(count):
+        params = {}
+        for name, values in columns.items():
+            params[name] = values[index]
+        itemSensors = {}
+        for name, values in sensors.items():
+            itemSensors[name] = values[index]
+        for name, values in temperatures:
+            if values[index] > -100:
+                itemSensors[name] = values[index]
+        params['sensors'] = itemSensors
+        offset = index * size
+        result.append((bytes(data[offset:offset + size]),
+            numbers[index], params))
+    return result
+
+# ===========================================================================
+# TESTS
+# ===========================================================================
+
+import unittest
+import struct
+
+class TestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.ds = 0xFFFF
+        item = struct.pack('<HLBLLHHHB', 10606, 1365045754, 16, 53243104,
+            50183400, 125, 1235, 150, 9)
+        additional = struct.pack('<BHHbBB', 0x45, 11450, 4100, 36, 0x81, 2)
+        additional += struct.pack('<HHHHHHHH', *range(8))
+        additional += struct.pack('<bbbbbbbb', 20, -127, 5, -100, 0, 1, 2, 3)
+        additional += struct.pack('<HI', 0x1234, 0x56789A)
+        additional += struct.pack('<HHHHbb', 1, 2, 3, 4, -5, 6)
+        additional += struct.pack('<BHbLL', 251, 3000, 90, 1001, 7)
+        self.item = item + additional
+        self.data = b''.join(self.item[:2] + bytes([i]) + self.item[3:]
+            for i in range(BATCH_MIN_ITEMS))
+
+    def test_notAvailable(self):
+        self.assertIsNone(decodeItems(b'', self.ds))
+        self.assertIsNone(decodeItems(self.data[:-1], self.ds))
+        self.assertIsNone(decodeItems(self.item, self.ds))
+
+    @unittest.skipIf(numpy is None, 'NumPy is not installed')
+    def test_decodeItems(self):
+        from lib.handlers.naviset.packets import PacketDataItem
+        items = decodeItems(memoryview(self.data), self.ds)
+        self.assertEqual(len(items), BATCH_MIN_ITEMS)
+        expected = PacketDataItem.getDataItemsFromBuffer(self.data, self.ds)
+        for (rawData, number, params), item in zip(items, expected):
+            self.assertEqual(rawData, item.rawData)
+            self.assertEqual(number, item.number)
+            self.assertEqual(params, item.params)
+            for name, value in params['sensors'].items():
+                self.assertIs(type(value), type(item.params['sensors'][name]))
+        self.assertEqual(items[0][2]['latitude'], 53.243104)
+        self.assertEqual(items[0][2]['sensors']['can_fuel_percent'], 100)
+        self.assertNotIn('ext_temperature_1', items[0][2]['sensors'])
+
+    @unittest.skipIf(numpy is None, 'NumPy is not installed')
+    def test_convertCoordinates(self):
+        from lib.handlers.naviset.packets import PacketDataItem
+        values = [0, 5, 99, 100, 37660096, 55788660, 150123456, 4294967295]
+        result = convertCoordinates(numpy.array(values, dtype = '<u4'))
+        item = PacketDataItem()
+        self.assertEqual(result, [item.convertCoordinate(v) for v in values])
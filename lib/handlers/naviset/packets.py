@@ -9,6 +9,7 @@ from datetime import datetime
 from struct import unpack, pack
 import lib.bits as bits
 import lib.crc16 as crc16
+import lib.handlers.naviset.batch as batch
 from lib.packets import *   
 from lib.factory import AbstractPacketFactory
 
@@ -28,7 +29,7 @@ class NavisetBase(BasePacket):
          @return: True if buffer crc equals to supplied crc value, else False
         """
         data = (self._head or b'') + (self._body or b'')
-        return crc16.Crc16.calcBinaryString(data, crc16.INITIAL_MODBUS)
+        return crc16.checksum(crc16.MODBUS, data)
 
 # ---------------------------------------------------------------------------
 
@@ -51,6 +52,15 @@ class NavisetPacket(NavisetBase):
         self._length = head
         self._header = head >> 14
 
+    @classmethod
+    def _getBodyLength(cls, value):
+        """
+         Returns length of the packet body by value of its length field
+         @param value: int
+         @return: int
+        """
+        return bits.bitClear(bits.bitClear(value, 15), 14)
+
     def _buildHead(self):
         """
          Builds rawData from object variables
@@ -90,11 +100,13 @@ class PacketNumbered(NavisetPacket):
     @property
     def deviceNumber(self):
         if self._rebuild: self._build()
+        self.decode()
         return self.__deviceNumber
 
     @deviceNumber.setter
     def deviceNumber(self, value):
         if (0 <= value <= 0xFFFF):
+            self.decode()
             self.__deviceNumber = value
             self._rebuild = True
 
@@ -162,6 +174,9 @@ class PacketData(PacketNumbered):
     __itemsData = None
     __items = None
 
+    # data items are parsed on first access
+    lazy = True
+
     def __init__(self, data = None):
         """
          Constructor
@@ -180,6 +195,13 @@ class PacketData(PacketNumbered):
         super(PacketData, self)._parseBody()
         self.__dataStructure = unpack('<H', self._body[2:4])[0]
         self.__itemsData = self._body[4:]
+        # archive packets with a lot of items are decoded in batch
+        decoded = batch.decodeItems(self.__itemsData, self.__dataStructure)
+        if decoded is not None:
+            self.__items = [PacketDataItem.createDecoded(
+                    rawData, self.__dataStructure, number, params)
+                for rawData, number, params in decoded]
+            return
         self.__items = PacketDataItem.getDataItemsFromBuffer(
             self.__itemsData,
             self.__dataStructure
@@ -196,6 +218,7 @@ class PacketData(PacketNumbered):
 
     @property
     def items(self):
+        self.decode()
         return self.__items
 
 # ---------------------------------------------------------------------------
@@ -207,6 +230,7 @@ class PacketDataItem:
     # private properties
     __rawData = None
     __rawDataTail = None
+    __consumed = 0
     __dataStructure = 0
     __number = 0
     __params = None
@@ -245,6 +269,24 @@ class PacketDataItem:
         self.__params = {}
         self.__parse()
 
+    @classmethod
+    def createDecoded(cls, rawData, ds, number, params):
+        """
+         Returns an item decoded by batch decoder
+         @param rawData: Binary data of the item
+         @param ds: Data structure word
+         @param number: Number of the item
+         @param params: dict Parameters of the item
+         @return: PacketDataItem instance
+        """
+        item = cls(None, ds)
+        item.__rawData = rawData
+        item.__consumed = len(rawData)
+        item.__number = number
+        item.__params = params
+        item.__additional = rawData[22:]
+        return item
+
     @classmethod
     def getAdditionalDataLength(cls, ds = None):
         """
@@ -271,11 +313,13 @@ class PacketDataItem:
          @return: array of PacketDataItem instances (empty array if not found)
         """
         items = []
+        view = memoryview(data or b'')
+        offset = 0
         while True:
-            item = cls(data, ds)
-            data = item.rawDataTail
+            item = cls(view[offset:], ds)
+            offset += item.consumed
             items.append(item)
-            if data is None or len(data) == 0: break
+            if not item.consumed or offset >= len(view): break
         return items
 
     @classmethod
@@ -392,12 +436,13 @@ class PacketDataItem:
             unpack("<H", buffer[17:19])[0] / 10))
         self.__params['altitude'] = unpack("<H", buffer[19:21])[0]
         self.__params['hdop'] = unpack("<B", buffer[21:22])[0] / 10
-        self.__additional = buffer[22:length]
+        self.__additional = bytes(buffer[22:length])
         self.__params['sensors'] = self.parseAdditionalData()
 
         # apply new data
         self.__rawDataTail = buffer[length:]
-        self.__rawData = buffer[:length]
+        self.__rawData = bytes(buffer[:length])
+        self.__consumed = length
 
     @property
     def length(self):
@@ -409,8 +454,14 @@ class PacketDataItem:
 
     @property
     def rawDataTail(self):
+        if isinstance(self.__rawDataTail, memoryview):
+            self.__rawDataTail = self.__rawDataTail.tobytes()
         return self.__rawDataTail
 
+    @property
+    def consumed(self):
+        return self.__consumed
+
     @property
     def number(self):
         return self.__number
@@ -1103,6 +1154,7 @@ class PacketFactory(AbstractPacketFactory):
     """
      Packet factory
     """
+    zeroCopy = True
 
     @classmethod
     def getClass(cls, number):
@@ -1138,6 +1190,19 @@ class PacketFactory(AbstractPacketFactory):
                             % (data, number))
         return CLASS(data)
 
+    def getFrameLength(self, data):
+        """
+          Returns full length of the packet at the start of data
+          @return: int
+        """
+        if len(data) < 2:
+            raise NeedMoreDataException('Not enough data in buffer')
+        number = unpack("<H", data[:2])[0] >> 14
+        CLASS = self.getClass(number)
+        if not CLASS:
+            raise Exception('Packet %s is not found' % number)
+        return CLASS.getFrameLength(data)
+
 import inspect
 import sys
 
@@ -1199,6 +1264,23 @@ class TestCase(unittest.TestCase):
         p = packets[0]
         self.assertEqual(p.deviceImei, '012896001609129')
 
+    def test_packetTailZeroCopy(self):
+        data = b'\x12\x00\x01\x00012896001609129\x06\x9f\xb9' + \
+               b'\x12\x00\x22\x00012896001609129\x05$6'
+        packets = self.factory.getPacketsFromBuffer(data)
+        self.assertEqual([p.consumed for p in packets], [22, 22])
+        self.assertEqual(b''.join(p.rawData for p in packets), data)
+        for p in packets:
+            self.assertIsInstance(p.rawData, bytes)
+            self.assertIsInstance(p.body, bytes)
+        self.assertEqual(packets[0].rawDataTail, data[22:])
+        self.assertEqual(packets[1].deviceNumber, 34)
+        # legacy path gives the same packets
+        self.factory.zeroCopy = False
+        legacy = self.factory.getPacketsFromBuffer(data)
+        self.assertEqual([p.rawData for p in legacy],
+            [p.rawData for p in packets])
+
     def test_dataPacket(self):
         packets = self.factory.getPacketsFromBuffer(
             b'\xdcC\x01\x00\xff\xffh)\x8f\xf0\\Q\x10\xe0l,\x03\xe8\xbc' +
@@ -1268,7 +1350,11 @@ class TestCase(unittest.TestCase):
         self.assertEqual(len(packets), 1)
         packet = packets[0]
         self.assertEqual(isinstance(packet, PacketData), True)
+        # data items are not parsed until they are needed
+        self.assertFalse(packet._decoded)
+        self.assertEqual(packet.checksum, 0xa93d)
         self.assertEqual(len(packet.items), 12)
+        self.assertEqual(packet.deviceNumber, 1)
         packetItem = packet.items[3]
         self.assertEqual(isinstance(packetItem, PacketDataItem), True)
         self.assertEqual(packetItem.params['speed'], 0.0)
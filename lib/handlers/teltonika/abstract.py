@@ -9,6 +9,7 @@ import binascii
 from struct import pack
 
 from kernel.logger import log
+from kernel.utils import NeedMoreDataException
 from kernel.dbmanager import db
 from lib.handler import AbstractHandler
 import lib.handlers.teltonika.packets as packets
@@ -21,6 +22,8 @@ class TeltonikaHandler(AbstractHandler):
      Base handler for Teltonika FMXXXXX protocol
     """
     __headPacketRawData = None # private buffer for headPacket data
+    _configuration = None # configuration sent to device, waiting for answer
+    _configuredPackets = None # packets received while configuring device
 
     def initialization(self):
         """
@@ -31,6 +34,31 @@ class TeltonikaHandler(AbstractHandler):
         self._packetsFactory = packets.PacketFactory()
         self._commandsFactory = commands.CommandFactory()
 
+    def processData(self, data):
+        """
+         Processing of data from socket.
+         If configuration is sent to device, data starts with its answer
+         @param data: Data from socket
+        """
+        if self._configuration is not None:
+            return self.processConfigurationAnswer(data)
+        return super(TeltonikaHandler, self).processData(data)
+
+    @classmethod
+    def detect(cls, data):
+        """
+         Checks if data starts with teltonika head packet:
+         <length of imei(2b) = 15><imei(15b)>
+         @param data: First bytes received from device
+         @return: True if data belongs to the protocol
+        """
+        head = b'\x00\x0f'
+        if data[:2] != head[:len(data)]:
+            return False
+        if len(data) < 17:
+            raise NeedMoreDataException('Not enough data to detect protocol')
+        return bytes(data[2:17]).isdigit()
+
     def processProtocolPacket(self, protocolPacket):
         """
          Process teltonika packet.
@@ -48,17 +76,30 @@ class TeltonikaHandler(AbstractHandler):
         if not self.uid:
             return log.error('HeadPack is not found!')
 
-        # try to configure this tracker
-        if self.configure():
+        if self._configuredPackets is not None:
+            # packet is processed when configuration is checked
+            # or device answers to the configuration
+            self._configuredPackets.append(protocolPacket)
             return
 
-        # sends the acknowledgment
-        self.sendAcknowledgement(protocolPacket)
+        # try to configure this tracker
+        self._configuredPackets = [protocolPacket]
+        self.runBlocking(self.loadConfiguration, self.configure)
 
+    def processPacket(self, protocolPacket):
+        """
+         Process teltonika packet of configured tracker.
+         @type protocolPacket: packets.Packet
+         @param protocolPacket: Teltonika protocol packet
+        """
         if isinstance(protocolPacket, packets.PacketHead):
+            self.sendAcknowledgement(protocolPacket)
             return
 
+        # packet is acknowledged after its records are parsed, so device
+        # sends it again if the packet can not be translated
         observerPackets = self.translate(protocolPacket)
+        self.sendAcknowledgement(protocolPacket)
         if len(observerPackets) == 0:
             log.info('Location packet not found. Exiting...')
             return
@@ -66,22 +107,73 @@ class TeltonikaHandler(AbstractHandler):
         log.info(observerPackets)
         self.store(observerPackets)
 
-    def configure(self):
-        current_db = db.get(self.uid)
-        if not current_db.has('config'):
-            return False
-        data = current_db.get('config')
+    def processPackets(self, protocolPackets):
+        """
+         Process packets, which were received while configuring tracker.
+         Raw data of the packets is used as buffer for storage save
+         @param protocolPackets: list of packets.Packet
+        """
+        if self._buffer is not None:
+            # packets are processed together with data they came from
+            for protocolPacket in protocolPackets:
+                self.processPacket(protocolPacket)
+            return
+        self._buffer = b''.join(p.rawData for p in protocolPackets)
+        self._bufferSpilled = False
+        try:
+            for protocolPacket in protocolPackets:
+                self.processPacket(protocolPacket)
+        finally:
+            self._buffer = None
+
+    def loadConfiguration(self):
+        """
+         Returns configuration of the tracker from database
+         @return: bytes (empty if there is no configuration)
+        """
+        return db.get(self.uid).get('config')
+
+    def configure(self, data):
+        """
+         Sends configuration to the tracker (if there is one).
+         Answer of the tracker is not awaited here, it is received
+         by processData() as any other data, so configuration works
+         with both threading and asyncio servers
+         @param data: Configuration of the tracker (see loadConfiguration())
+        """
+        if not data:
+            protocolPackets, self._configuredPackets = \
+                self._configuredPackets, None
+            self.processPackets(protocolPackets)
+            return
         self.send(data)
         log.debug('Configuration data sent = %s', data)
-        config = packets.TeltonikaConfiguration(data)
-        answer = b''
-        try:
-            log.debug('Waiting for the answer from device...')
-            answer = self.recv()
-        except Exception as E:
-            log.error(E)
-        current_db.remove('config')
-        return config.isCorrectAnswer(answer)
+        self._configuration = packets.TeltonikaConfiguration(data)
+
+    def processConfigurationAnswer(self, data):
+        """
+         Checks answer of the tracker to the configuration.
+         If answer is correct, the packet, which was processed when
+         configuration was sent, is dropped (tracker sends it again),
+         otherwise data is processed as usual
+         @param data: Data from socket
+        """
+        config, self._configuration = self._configuration, None
+        protocolPackets, self._configuredPackets = \
+            self._configuredPackets, None
+        uid = self.uid
+        self.runBlocking(lambda: db.get(uid).remove('config'))
+        if config.isCorrectAnswer(bytes(data[:3])):
+            log.debug('[%s] Configuration is applied', self.handlerId)
+            protocolPackets.pop(0)
+            data = data[3:]
+        else:
+            log.error('[%s] Incorrect answer to the configuration',
+                self.handlerId)
+        self.processPackets(protocolPackets)
+        if len(data) > 0:
+            return super(TeltonikaHandler, self).processData(data)
+        return self
 
     def receiveImage(self, packet):
         """
@@ -136,7 +228,7 @@ class TeltonikaHandler(AbstractHandler):
         if isinstance(packet, packets.PacketHead):
             return b'\x01'
         else:
-            return pack('>L', len(packet.AvlDataArray.items))
+            return pack('>L', packet.itemsCount)
 
     @classmethod
     def packString(cls, value):
@@ -170,6 +262,47 @@ class TestCase(unittest.TestCase):
         packet = h._packetsFactory.getInstance(b'\x00\x0f012896001609129')
         self.assertEqual(h.getAckPacket(packet), b'\x01')
 
+    def test_configure(self):
+        from kernel.database.memory import MemoryRedis
+        uid = '012896001609129'
+        current_db = db.get(uid)
+        store, current_db._store = current_db._store, MemoryRedis()
+        config = packets.TeltonikaConfiguration()
+        config.packetId = 15
+        config.addParam(1024, '1024')
+        sent = []
+        class TestRequest(object):
+            def send(self, data):
+                sent.append(data)
+        class TestThread(object):
+            receivesCommands = False
+            request = TestRequest()
+        head = b'\x00\x0f' + uid.encode()
+        answer = pack('>BH', config.packetId, config.length)
+        for reply, acks in [(answer, []), (b'\x00', [b'\x01'])]:
+            del sent[:]
+            current_db.set('config', config.rawData)
+            h = TeltonikaHandler(pipe.TestManager(), TestThread())
+            # head packet is not acknowledged until the answer
+            h.processData(head)
+            self.assertEqual(sent, [config.rawData])
+            h.processData(reply)
+            self.assertEqual(sent[1:], acks)
+            self.assertFalse(current_db.has('config'))
+        # with asyncio server configuration is loaded out of event loop
+        calls = []
+        thread = TestThread()
+        thread.runInExecutor = lambda f, callback = None: \
+            calls.append((f, callback))
+        del sent[:]
+        h = TeltonikaHandler(pipe.TestManager(), thread)
+        h.processData(head)
+        self.assertEqual(sent, [])
+        function, callback = calls.pop()
+        callback(function())
+        self.assertEqual(sent, [b'\x01'])
+        current_db._store = store
+
     def test_processData(self):
         self.skipTest('Need mock for redis server')
         h = self.handler
@@ -63,11 +63,23 @@ class PacketData(BasePacket):
     _fmtChecksum = '>L' # checksum format
     _AvlDataArray = None
 
+    # AVL data is parsed on first access
+    lazy = True
+
     @property
     def AvlDataArray(self):
         if self._rebuild: self._build()
+        self.decode()
         return self._AvlDataArray
 
+    @property
+    def itemsCount(self):
+        """
+         Count of AVL data items (read without parsing of AVL data)
+        """
+        if self._rebuild: self._build()
+        return self._body[1]
+
     def _parseHeader(self):
         """
          Parses rawData
@@ -101,7 +113,7 @@ class PacketData(BasePacket):
          Calculates CRC (CRC-16 Modbus)
          @return: True if buffer crc equals to supplied crc value, else False
         """
-        return crc16.Crc16.calcBinaryString(self._body, crc16.INITIAL_DF1)
+        return crc16.checksum(crc16.DF1, self._body)
 
 # ---------------------------------------------------------------------------
 
@@ -210,13 +222,24 @@ class AvlData(BinaryPacket):
         """
         AvlClass = AvlDataCodec7 if codecId == 7 else AvlDataCodec8
         items = []
+        view = memoryview(data)
+        offset = 0
         while True:
-            item = AvlClass(data)
-            data = item.rawDataTail
+            item = AvlClass(view[offset:])
+            offset += item.consumed
             items.append(item)
-            if len(data) == 0: break
+            if offset >= len(view): break
         return items
 
+    def _parseTail(self):
+        """
+         Cuts the tail of the buffer, body of the item is its raw data
+         @return: self
+        """
+        super(AvlData, self)._parseTail()
+        self._body = self._rawData
+        return self
+
 # ---------------------------------------------------------------------------
 
 class AvlDataCodec8(AvlData):
@@ -224,61 +247,49 @@ class AvlDataCodec8(AvlData):
       Item of data packet of naviset messaging protocol with codec \x08
     """
 
+    # fixed part of the item
+    _schema = Schema([
+        ('time', 'Q'),
+        ('priority', 'B'),
+        ('longitude', 'l'),
+        ('latitude', 'l'),
+        ('altitude', 'H'),
+        ('azimuth', 'H'),
+        ('satellitescount', 'B'),
+        ('speed', 'H'),
+        ('eventIoId', 'B'),
+        ('ioTotalCount', 'B')
+    ])
+
+    # formats of IO elements with 1, 2, 4 and 8 byte values
+    _fmtIoElements = ('>BB', '>BH', '>BL', '>BQ')
+
     def _parseBody(self):
         """
          Parses packet's head
          @return: self
         """
         super(AvlDataCodec8, self)._parseBody()
-        self._body = self._rawData
 
-        self._params = {}
-        self._params['time'] = datetime.utcfromtimestamp(
-            self.readFrom('>Q') / 1000)
-        self._params['priority'] = self.readFrom('>B')
-        self._params['longitude'] = self.convertCoordinate(self.readFrom('>l'))
-        self._params['latitude'] = self.convertCoordinate(self.readFrom('>l'))
-        self._params['altitude'] = self.readFrom('>H')
-        self._params['azimuth'] = self.readFrom('>H')
-        self._params['satellitescount'] = self.readFrom('>B')
-        self._params['speed'] = self.readFrom('>H')
+        record = self.readSchema(self._schema)
+        self._params = {
+            'time': datetime.utcfromtimestamp(record['time'] / 1000),
+            'priority': record['priority'],
+            'longitude': self.convertCoordinate(record['longitude']),
+            'latitude': self.convertCoordinate(record['latitude']),
+            'altitude': record['altitude'],
+            'azimuth': record['azimuth'],
+            'satellitescount': record['satellitescount'],
+            'speed': record['speed']
+        }
 
         # get ioElement
-        eventIoId = self.readFrom('>B')
+        eventIoId = record['eventIoId']
         items = []
-        ioTotalCount = self.readFrom('>B')
-        ioOneByteCount = self.readFrom('>B')
-        cnt = 0
-        while cnt < ioOneByteCount:
-            items.append({
-                'id': self.readFrom('>B'),
-                'value': self.readFrom('>B')
-            })
-            cnt += 1
-        ioTwoByteCount = self.readFrom('>B')
-        cnt = 0
-        while cnt < ioTwoByteCount:
-            items.append({
-                'id': self.readFrom('>B'),
-                'value': self.readFrom('>H')
-            })
-            cnt += 1
-        ioFourByteCount = self.readFrom('>B')
-        cnt = 0
-        while cnt < ioFourByteCount:
-            items.append({
-                'id': self.readFrom('>B'),
-                'value': self.readFrom('>L')
-            })
-            cnt += 1
-        ioEightByteCount = self.readFrom('>B')
-        cnt = 0
-        while cnt < ioEightByteCount:
-            items.append({
-                'id': self.readFrom('>B'),
-                'value': self.readFrom('>Q')
-            })
-            cnt += 1
+        for fmt in self._fmtIoElements:
+            count = self.readFrom('>B')
+            for ioId, value in self.readArray(fmt, count):
+                items.append({'id': ioId, 'value': value})
 
         self._ioElement = {
             # Event IO ID – if data is acquired on event – this field
@@ -302,7 +313,6 @@ class AvlDataCodec7(AvlData):
          @return: self
         """
         super(AvlDataCodec7, self)._parseBody()
-        self._body = self._rawData
         self._params = {}
         self._sensors = {}
 
@@ -551,11 +561,13 @@ class TeltonikaConfigurationParam(BasePacket):
         """
         params = []
         index = 0
+        view = memoryview(buffer)
+        offset = 0
         while (itemsCount is None) or (index < itemsCount):
-            item = TeltonikaConfigurationParam(buffer)
-            buffer = item.rawDataTail
+            item = TeltonikaConfigurationParam(view[offset:])
+            offset += item.consumed
             params.append(item)
-            if (len(buffer) == 0): break
+            if (offset >= len(view)): break
             index += 1
         return params
 
@@ -675,6 +687,7 @@ class PacketFactory(AbstractPacketFactory):
     """
      Packet factory
     """
+    zeroCopy = True
 
     def getInstance(self, data = None):
         """
@@ -682,6 +695,15 @@ class PacketFactory(AbstractPacketFactory):
           @return: BasePacket instance
         """
         if data == None: return
+        return self.getClass(data)(data)
+
+    def getClass(self, data):
+        """
+          Returns a packet class by the head of data
+          @return: BasePacket class
+        """
+        if len(data) < 2:
+            raise NeedMoreDataException('Not enough data in buffer')
         CLASS = PacketHead
         # read header and length
         length = unpack(">H", data[:2])[0]
@@ -689,7 +711,14 @@ class PacketFactory(AbstractPacketFactory):
             CLASS = PacketData
         if not CLASS:
             raise Exception('Unknown packet structure')
-        return CLASS(data)
+        return CLASS
+
+    def getFrameLength(self, data):
+        """
+          Returns full length of the packet at the start of data
+          @return: int
+        """
+        return self.getClass(data).getFrameLength(data)
 
 # ===========================================================================
 # TESTS
@@ -749,6 +778,9 @@ class TestCase(unittest.TestCase):
                b'\x6f\x00\xd6\x04\x00\x04\x00\x04\x03\x01\x01\x15\x03\x16' + \
                b'\x03\x00\x01\x46\x00\x00\x01\x5d\x00\x01\x00\x00\xcf\x77'
         packet = PacketData(data)
+        # AVL data is not parsed until it is needed
+        self.assertIsNone(packet._AvlDataArray)
+        self.assertEqual(packet.itemsCount, 1)
         avl = packet.AvlDataArray
         self.assertEqual(avl.codecId, 8)
         self.assertEqual(len(avl.items), 1)
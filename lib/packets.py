@@ -10,6 +10,119 @@ from kernel.utils import NeedMoreDataException
 
 # ---------------------------------------------------------------------------
 
+_structs = {}
+
+def getStruct(fmt):
+    """
+     Returns compiled struct of the format
+     @param fmt: pack() format string
+     @return: Struct
+    """
+    result = _structs.get(fmt)
+    if result is None:
+        result = _structs[fmt] = Struct(fmt)
+    return result
+
+# ---------------------------------------------------------------------------
+
+class Schema(object):
+    """
+     Declarative layout of a binary record.
+     Fields are described once as (name, format) pairs, where format is
+     a pack() format without byte order. Adjacent fixed fields are compiled
+     into one Struct, so a fixed section of the record is read by one
+     unpack_from() call. Format 'z' is a zero-terminated string.
+     Field with several values (e.g. 'HBB') is read as a tuple,
+     field without a name (e.g. padding) is skipped
+    """
+    STRING = 'z'
+
+    def __init__(self, fields, byteOrder = '>'):
+        """
+         Constructor
+         @param fields: list of (name, format) pairs
+         @param byteOrder: Byte order of the record ('>' or '<')
+        """
+        self.fields = list(fields)
+        self.byteOrder = byteOrder
+        self.names = tuple(name for name, fmt in self.fields if name)
+        self.size = 0 # size of record or None if it is variable
+        self._steps = []
+        self._compile()
+
+    def _compile(self):
+        """
+         Compiles fields into steps: (Struct, list of (name, count))
+         for fixed sections, (Struct, tuple of names) for fixed sections
+         of named single values and (None, name) for strings
+        """
+        fmt, names = '', []
+        for name, fieldFormat in self.fields:
+            if fieldFormat == self.STRING:
+                self._addStep(fmt, names)
+                fmt, names = '', []
+                self._steps.append((None, name))
+                self.size = None
+                continue
+            fieldStruct = Struct(self.byteOrder + fieldFormat)
+            count = len(fieldStruct.unpack(bytes(fieldStruct.size)))
+            fmt += fieldFormat
+            names.append((name, count))
+        self._addStep(fmt, names)
+
+    def _addStep(self, fmt, names):
+        """
+         Adds fixed section of fields
+         @param fmt: Format of the section
+         @param names: list of (name, count of values)
+        """
+        if not fmt:
+            return
+        step = Struct(self.byteOrder + fmt)
+        if all(name and count == 1 for name, count in names):
+            # values of the section are read by zip() of names
+            names = tuple(name for name, count in names)
+        self._steps.append((step, names))
+        if self.size is not None:
+            self.size += step.size
+
+    def read(self, buffer, offset = 0):
+        """
+         Reads record from buffer
+         @param buffer: bytes, bytearray or memoryview
+         @param offset: Offset of the record in buffer
+         @return: tuple (dict of field values, offset after the record)
+         @raise struct.error: if buffer is too short
+        """
+        result = {}
+        for step, names in self._steps:
+            if step is None:
+                if isinstance(buffer, memoryview):
+                    buffer = buffer.tobytes()
+                end = buffer.find(b'\x00', offset)
+                if end < 0:
+                    end = len(buffer)
+                if names:
+                    result[names] = bytes(buffer[offset:end]).decode()
+                offset = end + 1
+                continue
+            values = step.unpack_from(buffer, offset)
+            offset += step.size
+            if isinstance(names, tuple):
+                result.update(zip(names, values))
+                continue
+            index = 0
+            for name, count in names:
+                if name:
+                    if count == 1:
+                        result[name] = values[index]
+                    else:
+                        result[name] = values[index:index + count]
+                index += count
+        return result, offset
+
+# ---------------------------------------------------------------------------
+
 class SolidBinaryPacket(object):
     """
      Solid binary packet, which can not determine its length
@@ -20,6 +133,10 @@ class SolidBinaryPacket(object):
     _tail = None
     _rawData = None
     _rebuild = True       # flag to rebuild rawData
+    _decoded = True       # False if body of lazy packet is not parsed yet
+
+    # public properties
+    lazy = False          # parse body on first access (see decode())
 
     def __init__(self, data = None, config = None):
         """
@@ -62,6 +179,7 @@ class SolidBinaryPacket(object):
     @body.setter
     def body(self, value):
         self._body = value
+        self._decoded = True
         self._parseBody()
         self._rebuild = True
 
@@ -77,9 +195,27 @@ class SolidBinaryPacket(object):
         if self._rawData == None: return
         self._offset = 0
         self._parseHead()
-        self._parseBody()
+        if self.lazy:
+            self._decoded = False
+        else:
+            self._parseBody()
         self._parseTail()
 
+    def decode(self):
+        """
+         Parses body of the lazy packet, if it is not parsed yet.
+         Head and tail (length, checksum) of the lazy packet are parsed
+         at once, body is parsed by this method on first access to
+         its fields, so packets, which are only acknowledged or stored,
+         never pay for parsing. Only packets, which body is known after
+         the head is parsed (see BasePacket), can be lazy
+         @return: self
+        """
+        if not self._decoded:
+            self._decoded = True
+            self._parseBody()
+        return self
+
     def _parseHead(self):
         """
          Parses packet's head
@@ -106,6 +242,7 @@ class SolidBinaryPacket(object):
          Builds rawData from object variables
          @return: self
         """
+        self.decode()
         self._rebuild = False
         self._body = self._buildBody()
         self._head = self._buildHead()
@@ -156,12 +293,42 @@ class SolidBinaryPacket(object):
             return None
         if buffer is None:
             buffer = self._rawData
-        fmtSize = calcsize(fmt)
-        shift = self._offset + fmtSize
-        result = unpack(fmt, buffer[self._offset:shift])[0]
-        self._offset += fmtSize
+        fmtStruct = getStruct(fmt)
+        result = fmtStruct.unpack_from(buffer, self._offset)[0]
+        self._offset += fmtStruct.size
+        return result
+
+    def readArray(self, fmt, count, buffer = None):
+        """
+         Reads count of items of the same format from buffer,
+         and increases offset
+         @param fmt: pack() format string of one item
+         @param count: Count of items
+         @param buffer: buffer from which we will get the result
+         @return: list of tuples
+        """
+        if buffer is None:
+            buffer = self._rawData
+        fmtStruct = getStruct(fmt)
+        shift = self._offset + fmtStruct.size * count
+        if shift > len(buffer):
+            raise error('unpack requires a buffer of %d bytes' % shift)
+        result = list(fmtStruct.iter_unpack(buffer[self._offset:shift]))
+        self._offset = shift
+        return result
+
+    def readSchema(self, schema, buffer = None):
+        """
+         Reads record of the schema from buffer, and increases offset
+         @param schema: Schema instance
+         @param buffer: buffer from which we will get the result
+         @return: dict
+        """
+        if buffer is None:
+            buffer = self._rawData
+        result, self._offset = schema.read(buffer, self._offset)
         return result
-    
+
     def to_string(self):
         return "Not Implemented!"
 
@@ -170,22 +337,44 @@ class SolidBinaryPacket(object):
 class BinaryPacket(SolidBinaryPacket):
     """
      Abstract binary protocol packet which can determine its length
-     and through this cut the tail of supplied raw data
+     and through this cut the tail of supplied raw data.
+     Raw data can also be supplied as a memoryview: then the tail stays
+     a view of the same buffer and only the packet itself is copied
     """
 
     # protected properties
     _rawDataTail = None
+    _consumed = 0
 
     @property
     def rawDataTail(self):
+        if isinstance(self._rawDataTail, memoryview):
+            self._rawDataTail = self._rawDataTail.tobytes()
         return self._rawDataTail
 
+    @property
+    def consumed(self):
+        """
+         Count of bytes of the supplied raw data used by the packet
+        """
+        return self._consumed
+
     def _parseTail(self):
         """
          Parses packet's tail.
          By default it cuts the unused tail of packet buffer.
          @return: self
         """
+        self._consumed = self._offset
+        if isinstance(self._rawData, memoryview):
+            # do not keep references to the source buffer
+            self._rawDataTail = self._rawData[self._offset:]
+            self._rawData = self._rawData[:self._offset].tobytes()
+            for name in ('_head', '_body', '_tail'):
+                value = getattr(self, name)
+                if isinstance(value, memoryview):
+                    setattr(self, name, value.tobytes())
+            return self
         # cut the tail
         self._rawDataTail = self._rawData[self._offset:]
         self._rawData = self._rawData[:self._offset]
@@ -240,6 +429,36 @@ class BasePacket(BinaryPacket):
         if self._rebuild: self._build()
         return self._checksum
 
+    @classmethod
+    def getFrameLength(cls, buffer):
+        """
+         Returns full length of the packet at the start of buffer,
+         reading only its header and length fields.
+         Returns None if the packet has no length field
+         @param buffer: memoryview or bytes
+         @raise NeedMoreDataException: if buffer is shorter than packet head
+         @return: int
+        """
+        if cls._fmtLength is None:
+            return None
+        offset = calcsize(cls._fmtHeader or '')
+        shift = offset + calcsize(cls._fmtLength)
+        if len(buffer) < shift:
+            raise NeedMoreDataException('Not enough data in buffer')
+        length = cls._getBodyLength(
+            unpack(cls._fmtLength, buffer[offset:shift])[0])
+        return shift + length + calcsize(cls._fmtChecksum or '') + \
+            calcsize(cls._fmtFooter or '')
+
+    @classmethod
+    def _getBodyLength(cls, value):
+        """
+         Returns length of the packet body by value of its length field
+         @param value: int
+         @return: int
+        """
+        return value
+
     def _parseHeader(self):
         """
          Parses header data.
@@ -305,7 +524,7 @@ class BasePacket(BinaryPacket):
         shift = self._offset + fmtSize
         if fmt is not None:
             self._header = unpack(fmt, buffer[self._offset:shift])[0]
-            self._head = buffer[:shift]
+            self._head = bytes(buffer[:shift])
         self._offset += self._parseHeader() or fmtSize
 
         fmt = self._fmtLength
@@ -313,7 +532,7 @@ class BasePacket(BinaryPacket):
         shift = self._offset + fmtSize
         if fmt is not None:
             self._length = unpack(fmt, buffer[self._offset:shift])[0]
-            self._head = buffer[:shift]
+            self._head = bytes(buffer[:shift])
         self._offset += self._parseLength() or fmtSize
 
         if self._length > len(buffer):
@@ -321,7 +540,8 @@ class BasePacket(BinaryPacket):
 
         self._body = b''
         if self._length > 0:
-            self._body = buffer[self._offset:self._offset + self._length]
+            self._body = bytes(
+                buffer[self._offset:self._offset + self._length])
             if len(self._body) != self._length:
                 raise Exception('Body length is incorrect! ' +\
                     str(self._length) + ' (given) != ' + \
@@ -343,7 +563,7 @@ class BasePacket(BinaryPacket):
         shift = self._offset + fmtSize
         if fmt is not None:
             self._checksum = unpack(fmt, buffer[self._offset:shift])[0]
-            self._tail = buffer[self._offset:shift]
+            self._tail = bytes(buffer[self._offset:shift])
             # checksum check
             if not self._isCorrectChecksum():
                 raise Exception('Checksum is incorrect! ' +
@@ -356,7 +576,7 @@ class BasePacket(BinaryPacket):
         shift = self._offset + fmtSize
         if fmt is not None:
             self._footer = unpack(fmt, buffer[self._offset:shift])[0]
-            self._tail += buffer[self._offset:shift]
+            self._tail += bytes(buffer[self._offset:shift])
         self._offset += self._parseFooter() or fmtSize
 
         return super(BasePacket, self)._parseTail()
@@ -396,4 +616,78 @@ class BasePacket(BinaryPacket):
         self._length = 0
         if self._body is not None:
             self._length = len(self._body)
-        return self._length
\ No newline at end of file
+        return self._length
+
+
+# ===========================================================================
+# TESTS
+# ===========================================================================
+
+import unittest
+class TestCase(unittest.TestCase):
+
+    def test_schema(self):
+        schema = Schema([
+            ('id', 'H'),
+            ('flags', 'B'),
+            (None, 'x'),
+            ('date', 'HBB'),
+            ('name', 'z'),
+            ('value', 'l')
+        ])
+        self.assertEqual(len(schema._steps), 3)
+        self.assertIsNone(schema.size)
+        data = b'\x00' + pack('>HBxHBB', 513, 7, 2013, 10, 18) + b'abc\x00' + \
+            pack('>l', -5)
+        for buffer in [data, memoryview(data)]:
+            result, offset = schema.read(buffer, 1)
+            self.assertEqual(offset, len(data))
+            self.assertEqual(result, {'id': 513, 'flags': 7,
+                'date': (2013, 10, 18), 'name': 'abc', 'value': -5})
+        self.assertRaises(error, schema.read, data[:-1], 1)
+
+    def test_fixedSchema(self):
+        schema = Schema([('a', 'B'), ('b', 'H'), ('c', 'L')], '<')
+        self.assertEqual(len(schema._steps), 1)
+        self.assertEqual(schema.size, 7)
+        self.assertEqual(schema.names, ('a', 'b', 'c'))
+        self.assertEqual(schema.read(b'\x01\x02\x00\x03\x00\x00\x00'),
+            ({'a': 1, 'b': 2, 'c': 3}, 7))
+
+    def test_readFrom(self):
+        packet = SolidBinaryPacket(b'\x01\x00\x02\x01\x03\x02\x04\x00')
+        packet._offset = 0
+        self.assertEqual(packet.readFrom('>B'), 1)
+        self.assertEqual(packet.readArray('>BB', 3), [(0, 2), (1, 3), (2, 4)])
+        self.assertEqual(packet._offset, 7)
+        self.assertRaises(error, packet.readArray, '>BB', 1)
+        self.assertEqual(packet.readSchema(Schema([('x', 'B')])), {'x': 0})
+
+    def test_lazy(self):
+        parsed = []
+        class Packet(BasePacket):
+            _fmtLength = '>B'
+            _fmtChecksum = '>B'
+            value = None
+            def _parseBody(self):
+                parsed.append(self._body)
+                self.value = unpack('>H', self._body)[0]
+            def calculateChecksum(self):
+                return sum(self._body) & 0xFF
+        class LazyPacket(Packet):
+            lazy = True
+        data = b'\x02\x01\x02\x03\xFF'
+        packet = Packet(data)
+        self.assertEqual(packet.value, 0x102)
+        self.assertEqual(len(parsed), 1)
+        packet = LazyPacket(memoryview(data))
+        self.assertEqual(len(parsed), 1)
+        self.assertIsNone(packet.value)
+        # framing and checksum are parsed at once
+        self.assertEqual(packet.rawData, data[:4])
+        self.assertEqual(packet.rawDataTail, b'\xFF')
+        self.assertEqual(packet.checksum, 3)
+        self.assertEqual(packet.decode().value, 0x102)
+        packet.decode()
+        self.assertEqual(parsed, [b'\x01\x02', b'\x01\x02'])
+        self.assertRaises(Exception, LazyPacket, b'\x02\x01\x02\x04')
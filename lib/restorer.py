@@ -0,0 +1,433 @@
+# -*- coding: utf8 -*-
+'''
+@project   Maprox <http://www.maprox.net>
+@info      Restoring of stored data (see lib.storage)
+@copyright 2013, Maprox LLC
+'''
+
+import time
+import zlib
+import queue
+import socket
+from threading import Thread, Lock, Event
+
+import kernel.pipe as pipe
+from kernel.store import Store
+from kernel.logger import log
+
+# restore modes
+MODE_SOCKET = 'socket' # data is sent to the server of the port
+MODE_DIRECT = 'direct' # data is passed to the handler of the port
+
+# timeout (in seconds) for sending data in socket mode
+TIMEOUT_SECONDS = 30
+
+class ReplayError(Exception):
+    """ Packets of the replayed data are not sent """
+    pass
+
+class RateLimiter(object):
+    """
+     Token bucket, which limits count of records per second
+    """
+
+    def __init__(self, rate, burst = None):
+        """
+         Constructor
+         @param rate: Max count of records per second (0 - unlimited)
+         @param burst: Max count of records passed at once (rate by default)
+        """
+        self.rate = rate
+        self.burst = burst or rate
+        self._tokens = self.burst
+        self._time = time.monotonic()
+        self._lock = Lock()
+
+    def acquire(self, count = 1):
+        """
+         Waits until count records can be passed
+         @param count: Count of records
+        """
+        if not self.rate or count <= 0:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst,
+                self._tokens + (now - self._time) * self.rate)
+            self._time = now
+            self._tokens -= count
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+class Progress(object):
+    """
+     Counters of the restore by port
+    """
+
+    FIELDS = ['items', 'bytes', 'records', 'errors']
+
+    def __init__(self):
+        """ Constructor """
+        self._lock = Lock()
+        self._ports = {}
+        self._start = time.time()
+
+    def setTotal(self, port, size):
+        """
+         Sets total size of stored data of the port
+         @param port: Port
+         @param size: Size in bytes
+        """
+        with self._lock:
+            self.getCounters(port)['total'] = size
+
+    def getCounters(self, port):
+        if port not in self._ports:
+            self._ports[port] = dict((name, 0) for name in self.FIELDS)
+            self._ports[port]['total'] = 0
+        return self._ports[port]
+
+    def add(self, port, name, value = 1):
+        """
+         Increases counter of the port
+         @param port: Port
+         @param name: Name of the counter
+         @param value: Increment
+        """
+        with self._lock:
+            self.getCounters(port)[name] += value
+
+    def get(self):
+        """
+         Returns copy of counters
+         @return: dict of dicts by port
+        """
+        with self._lock:
+            return dict((port, dict(counters))
+                for port, counters in self._ports.items())
+
+    def report(self):
+        """
+         Returns progress report, one line per port
+         @return: list of str
+        """
+        elapsed = max(time.time() - self._start, 1e-6)
+        lines = []
+        for port, c in sorted(self.get().items()):
+            percent = 100.0 * c['bytes'] / c['total'] if c['total'] else 100
+            lines.append('port %s: %d items, %d of %d bytes (%.1f%%), '
+                '%d records (%.1f/s), %d errors' % (port, c['items'],
+                c['bytes'], c['total'], percent, c['records'],
+                c['records'] / elapsed, c['errors']))
+        return lines
+
+class ReplayRequest(object):
+    """
+     Socket stub of the replayed connection, answers of handler are dropped
+    """
+
+    def send(self, data):
+        return len(data)
+
+    def settimeout(self, value):
+        pass
+
+    def close(self):
+        pass
+
+class ReplayThread(object):
+    """
+     Client thread stub of the replayed connection.
+     Handlers of replayed connections are not subscribed to commands
+     of their devices, commands are received by the running server
+    """
+    receivesCommands = False
+
+    def __init__(self, port = None):
+        """
+         Constructor
+         @param port: Port of the replayed data
+        """
+        self.request = ReplayRequest()
+        self.port = port
+
+    def schedule(self, callback):
+        callback()
+
+class ReplayStore(Store):
+    """
+     Store of the replayed connection.
+     Packets are passed to the target store not faster than rate limit.
+     If packets are not sent, ReplayError is raised, so the handler does
+     not spill replayed data to the storage again
+    """
+
+    def __init__(self, target, limiter, progress, port):
+        """
+         Constructor
+         @param target: Store to send packets to (kernel.pipe.Manager)
+         @param limiter: RateLimiter instance
+         @param progress: Progress instance
+         @param port: Port of the replayed data
+        """
+        Store.__init__(self)
+        self.target = target
+        self.limiter = limiter
+        self.progress = progress
+        self.port = port
+        self.failed = False
+
+    def send(self, obj):
+        count = len(obj) if isinstance(obj, list) else 1
+        self.limiter.acquire(count)
+        result = self.target.send(obj)
+        if not result.isSuccess():
+            self.failed = True
+            raise ReplayError('Packets are not sent: %s' %
+                result.getErrorsList())
+        self.progress.add(self.port, 'records', count)
+        return result
+
+class Restorer(object):
+    """
+     Restores stored data by a pool of workers.
+     Items of a device are restored by the same worker in order
+    """
+
+    def __init__(self, storage, listeners = None, mode = MODE_SOCKET,
+            workers = 1, rate = 0, host = 'localhost'):
+        """
+         Constructor
+         @param storage: lib.storage.Storage instance
+         @param listeners: list of tuples (HandlerClass, port)
+           for direct mode (see lib.handlers.list.getListeners)
+         @param mode: MODE_SOCKET or MODE_DIRECT
+         @param workers: Count of worker threads
+         @param rate: Max count of records per second sent to the
+           observer in direct mode (0 - unlimited)
+         @param host: Host of servers for socket mode
+        """
+        self.storage = storage
+        self.handlers = dict((int(port), handlerClass)
+            for handlerClass, port in listeners or [])
+        self.mode = mode
+        self.workers = max(1, workers)
+        self.host = host
+        self.limiter = RateLimiter(rate)
+        self.progress = Progress()
+        self.timestamp = str(int(time.time()))
+        self.createStore = pipe.Manager
+
+    def getWorkerIndex(self, item):
+        """
+         Returns index of the worker for the item
+         @param item: Storage item
+         @return: int
+        """
+        key = item.get('uid') or item['name']
+        return zlib.crc32(key.encode()) % self.workers
+
+    def restoreItem(self, port, item):
+        """
+         Restores data of the item and removes it from storage.
+         Item is kept in storage if its data is not restored
+         @param port: Port (str)
+         @param item: Storage item
+        """
+        handlerClass = self.handlers.get(int(port))
+        if self.mode == MODE_DIRECT and handlerClass:
+            self.feedHandler(handlerClass, port, item['contents'])
+        else:
+            self.sendData(int(port), item['contents'])
+        self.storage.delete(item, port, self.timestamp)
+
+    def feedHandler(self, handlerClass, port, data):
+        """
+         Passes data to the new handler as if it is received from socket
+         @param handlerClass: Protocol handler class
+         @param port: Port (str)
+         @param data: bytes
+        """
+        store = ReplayStore(self.createStore(), self.limiter,
+            self.progress, port)
+        handler = handlerClass(store, ReplayThread(int(port)))
+        handler.processData(data)
+        if store.failed:
+            # handler can catch errors of the store
+            raise ReplayError('Data is not replayed')
+
+    def sendData(self, port, data):
+        """
+         Sends data to the server of the port
+         @param port: Port (int)
+         @param data: bytes
+        """
+        sock = socket.create_connection((self.host, port), TIMEOUT_SECONDS)
+        try:
+            sock.sendall(data)
+            sock.shutdown(socket.SHUT_WR)
+            try:
+                # if there is some data from server, let's receive it
+                while sock.recv(4096): pass
+            except (OSError, socket.timeout):
+                pass
+        finally:
+            sock.close()
+
+    def worker(self, items):
+        """
+         Restores items from the queue until None is received
+         @param items: queue.Queue
+        """
+        while True:
+            task = items.get()
+            if task is None:
+                return
+            port, item = task
+            try:
+                self.restoreItem(port, item)
+            except Exception as E:
+                self.progress.add(port, 'errors')
+                log.error('Restore error of %s on port %s: %s',
+                    item['name'], port, E)
+            self.progress.add(port, 'items')
+            self.progress.add(port, 'bytes', item['size'])
+
+    def getTotalSizes(self):
+        """
+         Returns size of stored data by port (see Storage.getSize)
+         @return: dict
+        """
+        return dict((port, self.storage.getSize(dirPort))
+            for port, dirPort in self.storage.getPortDirs())
+
+    def run(self, progressInterval = 10, report = None):
+        """
+         Restores all stored data
+         @param progressInterval: Interval (in seconds) of progress reports
+         @param report: Function to call with lines of progress report
+           (log.info by default)
+         @return: True if all items are restored without errors
+        """
+        report = report or (lambda lines: [log.info(l) for l in lines])
+        for port, size in self.getTotalSizes().items():
+            self.progress.setTotal(port, size)
+        queues = [queue.Queue(2) for i in range(self.workers)]
+        threads = [Thread(target = self.worker, args = (items,))
+            for items in queues]
+        for thread in threads:
+            thread.start()
+        finished = Event()
+        def reporter():
+            while not finished.wait(progressInterval):
+                report(self.progress.report())
+        reporterThread = Thread(target = reporter)
+        reporterThread.daemon = True
+        reporterThread.start()
+        try:
+            for port, item in self.storage.replay():
+                queues[self.getWorkerIndex(item)].put((port, item))
+        finally:
+            for items in queues:
+                items.put(None)
+            for thread in threads:
+                thread.join()
+            finished.set()
+        report(self.progress.report())
+        return not any(counters['errors']
+            for counters in self.progress.get().values())
+
+# ===========================================================================
+# TESTS
+# ===========================================================================
+
+import os
+import unittest
+import shutil
+import tempfile
+
+class TestCase(unittest.TestCase):
+
+    def setUp(self):
+        from lib.storage import Storage
+        from kernel.config import conf
+        self.path = tempfile.mkdtemp()
+        self.pathTrash = conf.pathTrash
+        conf.pathTrash = os.path.join(self.path, 'trash')
+        self.storage = Storage(os.path.join(self.path, 'storage'), 21120)
+
+    def tearDown(self):
+        from kernel.config import conf
+        self.storage.close()
+        conf.pathTrash = self.pathTrash
+        shutil.rmtree(self.path)
+
+    def test_rateLimiter(self):
+        limiter = RateLimiter(100, 1)
+        start = time.monotonic()
+        for i in range(6):
+            limiter.acquire()
+        self.assertGreaterEqual(time.monotonic() - start, 0.04)
+        limiter = RateLimiter(0)
+        limiter.acquire(1000000)
+
+    def test_restoreDirect(self):
+        from lib.handlers.naviset.gt20 import Handler
+        head = b'\x12\x00\x01\x00012896001609129\x06\x9f\xb9'
+        data = b'\x01\x00\x00\x00\x00\x00\x00\x00\x00\x00'
+        self.storage.save('012896001609129', head)
+        self.storage.save('012896001609130', head.replace(b'29', b'30'))
+        self.storage.close()
+        stores = []
+        def createStore():
+            stores.append(pipe.TestManager())
+            return stores[-1]
+        restorer = Restorer(self.storage, [(Handler, 21120)], MODE_DIRECT,
+            workers = 2, rate = 1000)
+        restorer.createStore = createStore
+        lines = []
+        self.assertTrue(restorer.run(report = lines.extend))
+        self.assertEqual(len(stores), 2)
+        counters = restorer.progress.get()['21120']
+        self.assertEqual(counters['items'], 2)
+        self.assertEqual(counters['errors'], 0)
+        self.assertEqual(counters['bytes'], counters['total'])
+        self.assertTrue(lines[-1].startswith('port 21120: 2 items'))
+        # data is removed from storage
+        self.assertEqual(list(self.storage.replay()), [])
+
+    def test_restoreErrors(self):
+        from lib.handlers.galileo.default import Handler
+        from benchmark import readCorpus
+        self.storage.save('868204005647838',
+            b''.join(readCorpus('galileo.default')))
+        self.storage.close()
+        class FailedManager(pipe.TestManager):
+            def send(self, obj):
+                result = pipe.TestManager.send(self, obj)
+                result.error('503', ['Publish queue is full'])
+                return result
+        restorer = Restorer(self.storage, [(Handler, 21120)], MODE_DIRECT)
+        restorer.createStore = FailedManager
+        self.assertFalse(restorer.run(report = lambda lines: None))
+        counters = restorer.progress.get()['21120']
+        self.assertEqual(counters['errors'], 1)
+        self.assertEqual(counters['records'], 0)
+        # data, which is not restored, is kept in storage
+        self.assertEqual(len(list(self.storage.replay())), 1)
+        restorer = Restorer(self.storage)
+        def sendData(port, data):
+            raise ConnectionRefusedError('Connection refused')
+        restorer.sendData = sendData
+        self.assertFalse(restorer.run(report = lambda lines: None))
+        self.assertEqual(len(list(self.storage.replay())), 1)
+
+    def test_replayHandler(self):
+        from lib.broker import broker, commandThread
+        from lib.handlers.naviset.gt20 import Handler
+        handler = Handler(pipe.TestManager(), ReplayThread())
+        handler.uid = '012896001609129'
+        # commands of the device are not consumed by the restore process
+        self.assertEqual(broker.getHandlers('012896001609129'), [])
+        self.assertNotIn('012896001609129', commandThread._queues)
@@ -0,0 +1,725 @@
+# -*- coding: utf8 -*-
+'''
+@project   Maprox <http://www.maprox.net>
+@info      Segmented append-only spool of device data
+@copyright 2013, Maprox LLC
+
+Spool of a port is a directory of segment files <number>.spool:
+  segment header: magic (4s), version (B), codec (B), reserved (H)
+  record header:  crc32 (I), uid length (H), port (H), timestamp (d),
+                  data length (I)
+  followed by uid (utf-8) and data of the record.
+crc32 covers record header (without crc), uid and data, so torn writes
+at the end of a segment are detected and skipped.
+
+Data of a compressed segment (codec is not 0) is a sequence of blocks:
+  block header:   crc32 (I), raw length (I), compressed length (I)
+  followed by compressed records.
+Records never cross blocks. Offsets of records are logical, i.e. offsets
+in the segment without compression, so they are the same for all codecs.
+Writer keeps records of the current block in memory until the block
+reaches blockSize or records are synced (see SpoolWriter).
+
+Sealed segment has an index <number>.index (json): count of records,
+[offset, length] of records by uid and [logical offset, file offset]
+of blocks for compressed segment, so records are read without
+decompression of the whole segment. Deleted records are appended to
+<number>.deleted as offsets; a sealed segment, whose records are all
+deleted, is removed. Segment, which is written now, is locked by
+its writer (flock), so readers do not remove or seal it.
+'''
+
+import os
+import json
+import lzma
+import mmap
+import time
+import zlib
+import bisect
+import fcntl
+import struct
+from threading import Thread, Lock, Event
+
+from kernel.logger import log
+
+SEGMENT_MAGIC = b'MPXS'
+SEGMENT_VERSION = 1
+SEGMENT_HEADER = struct.Struct('<4sBBH')
+RECORD_HEADER = struct.Struct('<IHHdI')
+BLOCK_HEADER = struct.Struct('<III')
+DELETED_ENTRY = struct.Struct('<Q')
+
+SEGMENT_POSTFIX = '.spool'
+INDEX_POSTFIX = '.index'
+DELETED_POSTFIX = '.deleted'
+
+# codecs of segment data
+CODEC_NONE = 0
+CODEC_ZLIB = 1
+CODEC_LZMA = 2
+
+# codecs by name of compression (see conf.spoolCompression)
+COMPRESSION = {
+    'none': CODEC_NONE,
+    'zlib': CODEC_ZLIB,
+    'lzma': CODEC_LZMA
+}
+
+def getCodec(compression):
+    """
+     Returns codec by name of compression
+     @param compression: "none", "zlib" or "lzma"
+     @return: int
+    """
+    if compression not in COMPRESSION:
+        raise ValueError('Unknown spool compression: %s' % compression)
+    return COMPRESSION[compression]
+
+def getSegmentFileName(path, number):
+    """
+     Returns file name of the segment
+     @param path: Spool directory
+     @param number: Number of the segment
+     @return: str
+    """
+    return os.path.join(path, '%08d%s' % (number, SEGMENT_POSTFIX))
+
+def getSegmentNumbers(path):
+    """
+     Returns numbers of segments of the spool
+     @param path: Spool directory
+     @return: sorted list of int
+    """
+    numbers = []
+    if not os.path.isdir(path):
+        return numbers
+    for fileName in os.listdir(path):
+        name, ext = os.path.splitext(fileName)
+        if ext == SEGMENT_POSTFIX and name.isdigit():
+            numbers.append(int(name))
+    return sorted(numbers)
+
+def packRecord(uid, port, timestamp, data):
+    """
+     Returns record as bytes
+     @param uid: Device identifier
+     @param port: Port of the handler
+     @param timestamp: Time of the record
+     @param data: bytes
+     @return: bytes
+    """
+    uidBytes = uid.encode()
+    header = RECORD_HEADER.pack(0, len(uidBytes), port, timestamp, len(data))
+    crc = zlib.crc32(data, zlib.crc32(uidBytes, zlib.crc32(header[4:])))
+    return struct.pack('<I', crc) + header[4:] + uidBytes + data
+
+def getRecordSize(uid, data):
+    """
+     Returns size of the record in segment
+     @param uid: Device identifier
+     @param data: bytes
+     @return: int
+    """
+    return RECORD_HEADER.size + len(uid.encode()) + len(data)
+
+def packBlock(codec, data):
+    """
+     Returns compressed block as bytes
+     @param codec: Codec of the segment
+     @param data: Records of the block (bytes)
+     @return: bytes
+    """
+    if codec == CODEC_ZLIB:
+        compressed = zlib.compress(data)
+    elif codec == CODEC_LZMA:
+        compressed = lzma.compress(data)
+    else:
+        raise ValueError('Unknown segment codec: %s' % codec)
+    header = BLOCK_HEADER.pack(0, len(data), len(compressed))
+    crc = zlib.crc32(compressed, zlib.crc32(header[4:]))
+    return struct.pack('<I', crc) + header[4:] + compressed
+
+def unpackBlock(codec, data):
+    """
+     Decompresses data of the block
+     @param codec: Codec of the segment
+     @param data: Compressed data
+     @return: bytes
+    """
+    if codec == CODEC_ZLIB:
+        return zlib.decompress(data)
+    elif codec == CODEC_LZMA:
+        return lzma.decompress(data)
+    raise ValueError('Unknown segment codec: %s' % codec)
+
+def readBlocks(f, codec, offset = SEGMENT_HEADER.size):
+    """
+     Reads blocks of the compressed segment from the current position.
+     Reading is stopped on incomplete or damaged block
+     @param f: File object
+     @param codec: Codec of the segment
+     @param offset: Logical offset of the first block
+     @return: generator of tuples (offset, file offset, bytes)
+    """
+    while True:
+        position = f.tell()
+        header = f.read(BLOCK_HEADER.size)
+        if not header:
+            return
+        if len(header) < BLOCK_HEADER.size:
+            log.warning('Spool: incomplete block at %s', position)
+            return
+        crc, rawLength, length = BLOCK_HEADER.unpack(header)
+        data = f.read(length)
+        if len(data) < length:
+            log.warning('Spool: incomplete block at %s', position)
+            return
+        try:
+            if zlib.crc32(data, zlib.crc32(header[4:])) != crc:
+                raise ValueError('Wrong crc')
+            data = unpackBlock(codec, data)
+            if len(data) != rawLength:
+                raise ValueError('Wrong length')
+        except (ValueError, zlib.error, lzma.LZMAError):
+            log.warning('Spool: damaged block at %s', position)
+            return
+        yield offset, position, data
+        offset += rawLength
+
+def unpackRecords(buffer, offset = 0):
+    """
+     Reads records from the buffer.
+     Reading is stopped on incomplete or damaged record
+     @param buffer: bytes, memoryview or mmap
+     @param offset: Offset of the first record
+     @return: generator of tuples (offset, uid, port, timestamp, data)
+    """
+    size = len(buffer)
+    headerSize = RECORD_HEADER.size
+    while offset + headerSize <= size:
+        crc, uidLength, port, timestamp, dataLength = \
+            RECORD_HEADER.unpack_from(buffer, offset)
+        start = offset + headerSize
+        end = start + uidLength + dataLength
+        if end > size:
+            log.warning('Spool: incomplete record at %s', offset)
+            return
+        if zlib.crc32(buffer[offset + 4:end]) != crc:
+            log.warning('Spool: damaged record at %s', offset)
+            return
+        uid = bytes(buffer[start:start + uidLength]).decode()
+        data = bytes(buffer[start + uidLength:end])
+        yield offset, uid, port, timestamp, data
+        offset = end
+
+def readSegmentHeader(f):
+    """
+     Reads and checks header of the segment
+     @param f: File object
+     @return: int Codec of the segment
+    """
+    header = f.read(SEGMENT_HEADER.size)
+    if len(header) < SEGMENT_HEADER.size:
+        raise ValueError('Incomplete segment header')
+    magic, version, codec, reserved = SEGMENT_HEADER.unpack(header)
+    if magic != SEGMENT_MAGIC or version != SEGMENT_VERSION:
+        raise ValueError('Unknown segment format')
+    return codec
+
+def readRecords(fileName):
+    """
+     Reads records of the segment lazily.
+     Segment is memory-mapped, so only the current record is copied
+     to the memory of the process
+     @param fileName: Segment file name
+     @return: generator of tuples (offset, uid, port, timestamp, data)
+    """
+    with open(fileName, 'rb') as f:
+        codec = readSegmentHeader(f)
+        if codec != CODEC_NONE:
+            # compressed segment is read block by block
+            for offset, position, data in readBlocks(f, codec):
+                for record in unpackRecords(data):
+                    yield (offset + record[0],) + record[1:]
+            return
+        if os.fstat(f.fileno()).st_size <= SEGMENT_HEADER.size:
+            return
+        with mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ) as buffer:
+            for record in unpackRecords(buffer, SEGMENT_HEADER.size):
+                yield record
+
+def readSpans(fileName, index, spans):
+    """
+     Reads parts of the segment by their logical offsets.
+     Blocks of compressed segment are found by its index, so only
+     blocks with the spans are decompressed
+     @param fileName: Segment file name
+     @param index: dict Index of the segment (see readIndex)
+     @param spans: list of [offset, length] (e.g. records of the uid)
+     @return: generator of bytes
+    """
+    with open(fileName, 'rb') as f:
+        codec = readSegmentHeader(f)
+        if codec == CODEC_NONE:
+            for offset, length in spans:
+                f.seek(offset)
+                yield f.read(length)
+            return
+        blocks = index.get('blocks', [])
+        starts = [start for start, position in blocks]
+        number, data = None, b''
+        for offset, length in spans:
+            i = bisect.bisect_right(starts, offset) - 1
+            if i < 0:
+                continue
+            if i != number:
+                start, position = blocks[i]
+                f.seek(position)
+                number, data = i, b''
+                for block in readBlocks(f, codec, start):
+                    data = block[2]
+                    break
+            start = offset - starts[i]
+            yield data[start:start + length]
+
+def isLocked(fileName):
+    """
+     Returns True if segment is written by an alive writer
+     @param fileName: Segment file name
+     @return: bool
+    """
+    try:
+        with open(fileName, 'rb') as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_SH | fcntl.LOCK_NB)
+            except (IOError, OSError):
+                return True
+            fcntl.flock(f, fcntl.LOCK_UN)
+    except (IOError, OSError):
+        pass
+    return False
+
+def buildIndex(fileName):
+    """
+     Builds index of the segment by reading of its records
+     @param fileName: Segment file name
+     @return: dict Index
+    """
+    index = {'records': 0, 'uids': {}}
+    with open(fileName, 'rb') as f:
+        codec = readSegmentHeader(f)
+        if codec != CODEC_NONE:
+            index['blocks'] = [[offset, position]
+                for offset, position, data in readBlocks(f, codec)]
+    for offset, uid, port, timestamp, data in readRecords(fileName):
+        index['records'] += 1
+        index['uids'].setdefault(uid, []).append(
+            [offset, getRecordSize(uid, data)])
+    return index
+
+def writeIndex(fileName, index):
+    """
+     Writes index of the segment, so segment becomes sealed
+     @param fileName: Segment file name
+     @param index: dict Index
+    """
+    indexFileName = os.path.splitext(fileName)[0] + INDEX_POSTFIX
+    temporary = indexFileName + '.tmp'
+    with open(temporary, 'w') as f:
+        json.dump(index, f)
+    os.rename(temporary, indexFileName)
+
+def readIndex(fileName):
+    """
+     Returns index of the segment.
+     Index of not sealed segment is built by its records
+     @param fileName: Segment file name
+     @return: tuple (dict Index, bool Sealed)
+    """
+    indexFileName = os.path.splitext(fileName)[0] + INDEX_POSTFIX
+    try:
+        with open(indexFileName) as f:
+            return json.load(f), True
+    except (IOError, OSError, ValueError):
+        return buildIndex(fileName), False
+
+def readDeleted(fileName):
+    """
+     Returns offsets of deleted records of the segment
+     @param fileName: Segment file name
+     @return: set of int
+    """
+    deletedFileName = os.path.splitext(fileName)[0] + DELETED_POSTFIX
+    try:
+        with open(deletedFileName, 'rb') as f:
+            data = f.read()
+    except (IOError, OSError):
+        return set()
+    data = data[:len(data) - len(data) % DELETED_ENTRY.size]
+    return set(offset for offset, in DELETED_ENTRY.iter_unpack(data))
+
+def markDeleted(fileName, offsets):
+    """
+     Marks records of the segment as deleted.
+     Segment is removed if all of its records are deleted
+     @param fileName: Segment file name
+     @param offsets: Offsets of deleted records
+    """
+    base = os.path.splitext(fileName)[0]
+    with open(base + DELETED_POSTFIX, 'ab') as f:
+        f.write(b''.join(DELETED_ENTRY.pack(offset) for offset in offsets))
+    if isLocked(fileName):
+        # segment is removed by its writer when it is sealed
+        return
+    index, sealed = readIndex(fileName)
+    if not removeIfDeleted(fileName, index) and not sealed:
+        # writer of the segment is finished without sealing
+        writeIndex(fileName, index)
+
+def removeIfDeleted(fileName, index):
+    """
+     Removes segment if all of its records are deleted
+     @param fileName: Segment file name
+     @param index: Index of the segment
+     @return: True if segment is removed
+    """
+    if len(readDeleted(fileName)) < index['records']:
+        return False
+    base = os.path.splitext(fileName)[0]
+    for postfix in [SEGMENT_POSTFIX, INDEX_POSTFIX, DELETED_POSTFIX]:
+        try:
+            os.remove(base + postfix)
+        except (IOError, OSError):
+            pass
+    log.debug('Spool: segment %s is removed', fileName)
+    return True
+
+class SpoolWriter(object):
+    """
+     Writer of the spool segments.
+     Every writer (process) appends records to its own segment,
+     segments are rotated when they reach segmentSize.
+     Records are written to the file immediately and synced to disk
+     by group commit: one fsync() for all records written during
+     syncInterval (or every record if syncInterval is 0).
+     With compression records are collected to a block, which is written
+     when it reaches blockSize or records are synced
+    """
+
+    def __init__(self, path, port, segmentSize = 16777216,
+            syncInterval = 1000, compression = 'none', blockSize = 65536):
+        """
+         Constructor
+         @param path: Spool directory
+         @param port: Port of the handler
+         @param segmentSize: Max size of segment file in bytes
+         @param syncInterval: Max time (ms) records wait for fsync
+         @param compression: Compression of segments (see COMPRESSION)
+         @param blockSize: Size of records in compressed block in bytes
+        """
+        self.path = path
+        self.port = port
+        self.segmentSize = segmentSize
+        self.syncInterval = syncInterval
+        self.codec = getCodec(compression)
+        self.blockSize = blockSize
+        self._lock = Lock()
+        self._file = None
+        self._fileName = None
+        self._index = None
+        self._size = 0
+        self._fileSize = 0
+        self._block = bytearray()
+        self._blockOffset = 0
+        self._dirty = False
+        self._thread = None
+        self._stopped = Event()
+
+    @property
+    def fileName(self):
+        """ File name of the current segment """
+        return self._fileName
+
+    def _open(self):
+        """
+         Creates new segment with the next number
+        """
+        os.makedirs(self.path, 0o777, True)
+        while True:
+            numbers = getSegmentNumbers(self.path)
+            number = numbers[-1] + 1 if numbers else 1
+            fileName = getSegmentFileName(self.path, number)
+            try:
+                fd = os.open(fileName, os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+                    0o666)
+                break
+            except FileExistsError:
+                continue # segment is created by other process
+        self._file = os.fdopen(fd, 'wb')
+        fcntl.flock(self._file, fcntl.LOCK_EX)
+        self._file.write(SEGMENT_HEADER.pack(SEGMENT_MAGIC, SEGMENT_VERSION,
+            self.codec, 0))
+        self._fileName = fileName
+        self._index = {'records': 0, 'uids': {}}
+        if self.codec != CODEC_NONE:
+            self._index['blocks'] = []
+        self._size = SEGMENT_HEADER.size
+        self._fileSize = SEGMENT_HEADER.size
+        self._block = bytearray()
+        self._blockOffset = self._size
+        log.debug('Spool: segment %s is created', fileName)
+
+    def _flushBlock(self):
+        """
+         Writes collected records of compressed segment as a block
+        """
+        if not self._block:
+            return
+        block = packBlock(self.codec, bytes(self._block))
+        self._file.write(block)
+        self._file.flush()
+        self._index['blocks'].append([self._blockOffset, self._fileSize])
+        self._fileSize += len(block)
+        self._blockOffset = self._size
+        self._block = bytearray()
+
+    def _seal(self):
+        """
+         Syncs and closes current segment, writes its index.
+         Segment is removed if all of its records are already deleted
+        """
+        if self._file is None:
+            return
+        self._flushBlock()
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        writeIndex(self._fileName, self._index)
+        self._file.close()
+        self._file = None
+        self._dirty = False
+        removeIfDeleted(self._fileName, self._index)
+
+    def append(self, uid, data):
+        """
+         Appends record to the spool
+         @param uid: Device identifier
+         @param data: bytes
+         @return: tuple (segment file name, offset of the record)
+        """
+        record = packRecord(uid, self.port, time.time(), bytes(data))
+        with self._lock:
+            # size of collected block is not known until it is compressed
+            if self._file is not None and self._fileSize + \
+                    len(self._block) + len(record) > self.segmentSize:
+                self._seal()
+            if self._file is None:
+                self._open()
+            offset = self._size
+            self._size += len(record)
+            if self.codec == CODEC_NONE:
+                self._file.write(record)
+                self._file.flush()
+                self._fileSize += len(record)
+            else:
+                self._block += record
+                if len(self._block) >= self.blockSize:
+                    self._flushBlock()
+            self._index['records'] += 1
+            self._index['uids'].setdefault(uid, []).append(
+                [offset, len(record)])
+            self._dirty = True
+            if not self.syncInterval:
+                self._flushBlock()
+                os.fsync(self._file.fileno())
+                self._dirty = False
+            fileName = self._fileName
+        self.start()
+        return fileName, offset
+
+    def flush(self):
+        """
+         Writes collected block of records to the current segment
+        """
+        with self._lock:
+            if self._file is not None:
+                self._flushBlock()
+
+    def sync(self):
+        """
+         Writes records of the current segment to disk
+        """
+        with self._lock:
+            if self._file is not None and self._dirty:
+                self._flushBlock()
+                os.fsync(self._file.fileno())
+                self._dirty = False
+
+    def start(self):
+        """
+         Starts group commit thread (if it is not started yet)
+        """
+        if self._thread is not None or not self.syncInterval:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = Thread(target = self.threadHandler)
+                self._thread.daemon = True
+                self._thread.start()
+
+    def threadHandler(self):
+        """
+         Group commit thread
+        """
+        stopped = self._stopped
+        while not stopped.wait(self.syncInterval / 1000):
+            try:
+                self.sync()
+            except Exception as E:
+                log.error('Spool: sync error: %s', E)
+
+    def close(self):
+        """
+         Stops group commit thread and seals current segment
+        """
+        thread = self._thread
+        if thread is not None:
+            self._stopped.set()
+            thread.join()
+            self._thread = None
+            self._stopped = Event()
+        with self._lock:
+            self._seal()
+
+# ===========================================================================
+# TESTS
+# ===========================================================================
+
+import unittest
+import shutil
+import tempfile
+
+class TestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.writer = SpoolWriter(self.path, 20100, 256, 0)
+
+    def tearDown(self):
+        self.writer.close()
+        shutil.rmtree(self.path)
+
+    def test_records(self):
+        w = self.writer
+        fileName, offset = w.append('uid1', b'\x01\x02')
+        self.assertEqual(offset, SEGMENT_HEADER.size)
+        w.append('uid2', b'\x03')
+        w.append('uid1', b'\x04' * 10)
+        records = list(readRecords(fileName))
+        self.assertEqual([(uid, port, data)
+            for offset, uid, port, timestamp, data in records], [
+            ('uid1', 20100, b'\x01\x02'),
+            ('uid2', 20100, b'\x03'),
+            ('uid1', 20100, b'\x04' * 10)
+        ])
+        # segment is not sealed while it is written
+        self.assertTrue(isLocked(fileName))
+        index, sealed = readIndex(fileName)
+        self.assertFalse(sealed)
+        self.assertEqual(index['records'], 3)
+        w.close()
+        self.assertFalse(isLocked(fileName))
+        self.assertEqual(readIndex(fileName), (index, True))
+
+    def test_rotation(self):
+        w = self.writer
+        for i in range(10):
+            w.append('uid%d' % i, b'\x00' * 50)
+        w.close()
+        numbers = getSegmentNumbers(self.path)
+        self.assertEqual(numbers, list(range(1, len(numbers) + 1)))
+        self.assertGreater(len(numbers), 1)
+        count = 0
+        for number in numbers:
+            fileName = getSegmentFileName(self.path, number)
+            self.assertLessEqual(os.path.getsize(fileName), 256)
+            count += readIndex(fileName)[0]['records']
+        self.assertEqual(count, 10)
+
+    def test_damagedRecord(self):
+        w = self.writer
+        fileName, offset = w.append('uid1', b'\x01\x02')
+        w.append('uid1', b'\x03\x04')
+        w.close()
+        with open(fileName, 'r+b') as f:
+            f.seek(-1, os.SEEK_END)
+            f.write(b'\xff')
+        self.assertEqual([r[4] for r in readRecords(fileName)], [b'\x01\x02'])
+        # torn write
+        with open(fileName, 'r+b') as f:
+            f.truncate(os.path.getsize(fileName) - 3)
+        self.assertEqual([r[4] for r in readRecords(fileName)], [b'\x01\x02'])
+
+    def test_markDeleted(self):
+        w = self.writer
+        fileName, first = w.append('uid1', b'\x01')
+        fileName, second = w.append('uid2', b'\x02')
+        markDeleted(fileName, [first])
+        self.assertEqual(readDeleted(fileName), set([first]))
+        w.close()
+        markDeleted(fileName, [second])
+        self.assertEqual(getSegmentNumbers(self.path), [])
+        self.assertEqual(os.listdir(self.path), [])
+
+    def test_sealDeleted(self):
+        w = self.writer
+        fileName, offset = w.append('uid1', b'\x01')
+        # all records are deleted while the segment is written
+        markDeleted(fileName, [offset])
+        self.assertEqual(getSegmentNumbers(self.path), [1])
+        w.close()
+        self.assertEqual(os.listdir(self.path), [])
+
+    def test_groupCommit(self):
+        w = SpoolWriter(self.path, 20100, 256, 10)
+        w.append('uid1', b'\x01')
+        self.assertTrue(w._dirty)
+        time.sleep(0.1)
+        self.assertFalse(w._dirty)
+        w.close()
+        self.assertIsNone(w._thread)
+
+    def test_compression(self):
+        self.assertRaises(ValueError, getCodec, 'bzip2')
+        for compression in ['zlib', 'lzma']:
+            path = os.path.join(self.path, compression)
+            w = SpoolWriter(path, 20100, 4096, 60000, compression, 100)
+            records = [('uid%d' % (i % 3), bytes([i]) * 20)
+                for i in range(32)]
+            offsets = [w.append(uid, data)[1] for uid, data in records]
+            fileName = w.fileName
+            # the last records are not written until the block is full
+            index, sealed = readIndex(fileName)
+            self.assertFalse(sealed)
+            self.assertEqual(index['records'], 30)
+            w.close()
+            with open(fileName, 'rb') as f:
+                self.assertEqual(readSegmentHeader(f),
+                    COMPRESSION[compression])
+            index, sealed = readIndex(fileName)
+            self.assertTrue(sealed)
+            self.assertEqual(index, buildIndex(fileName))
+            self.assertEqual(len(index['blocks']), 11)
+            # offsets are the same as in segment without compression
+            self.assertEqual(offsets[1] - offsets[0],
+                getRecordSize('uid0', records[0][1]))
+            self.assertEqual([(r[0], r[1], r[4])
+                for r in readRecords(fileName)],
+                [(o, uid, data) for o, (uid, data) in zip(offsets, records)])
+            parts = readSpans(fileName, index, index['uids']['uid1'])
+            self.assertEqual([r[4] for part in parts
+                for r in unpackRecords(part)],
+                [data for uid, data in records if uid == 'uid1'])
+            # damaged block is skipped with all next ones
+            with open(fileName, 'r+b') as f:
+                f.truncate(os.path.getsize(fileName) - 3)
+            self.assertEqual(len(list(readRecords(fileName))), 30)
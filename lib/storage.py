@@ -9,36 +9,77 @@ import re
 import os
 import base64
 import shutil
-import time
+import atexit
 import glob
-import copy
+import fnmatch
+from threading import Lock
 
 from kernel.logger import log
 from kernel.config import conf
+from lib import spool
 
 class Storage(object):
     """
      Class of storage for protocol handlers (Files I/O).
      Used when there is an error during sending data to the pipe controller.
-     Stores protocol data in files, wich then can be restored when
-     error on pipe controller fixed
+     Stores protocol data in the spool (see lib.spool) of the port,
+     wich then can be restored when error on pipe controller fixed.
+     Files <uid>.storage of the previous versions are loaded too
     """
 
     filePostfix = '.storage'
     re_uid = re.compile('\w+')
     re_port = re.compile('\d+')
-    __path = os.path.join(conf.pathStorage, str(conf.port))
 
-    def __init__(self):
+    def __init__(self, pathStorage = None, port = None):
         """
          Storage constructor
+         @param pathStorage: Storage directory (conf.pathStorage by default)
+         @param port: Port of the handler (conf.port by default)
         """
         log.debug('%s::__init__()', self.__class__)
+        self.pathStorage = pathStorage or conf.pathStorage
+        self.port = conf.port if port is None else port
+        self.__path = os.path.join(self.pathStorage, str(self.port))
+        self.__writer = None
+        self.__lock = Lock()
         try:
             os.makedirs(self.__path, 0o777, True)
         except:
             pass
 
+    def getWriter(self):
+        """
+         Returns spool writer of the port (created on the first call)
+         @return: spool.SpoolWriter
+        """
+        with self.__lock:
+            if self.__writer is None:
+                self.__writer = spool.SpoolWriter(self.__path, self.port,
+                    conf.spoolSegmentSize, conf.spoolSyncInterval,
+                    conf.spoolCompression, conf.spoolBlockSize)
+                atexit.register(self.close)
+            return self.__writer
+
+    def close(self):
+        """
+         Seals current spool segment
+        """
+        with self.__lock:
+            writer, self.__writer = self.__writer, None
+        if writer is not None:
+            writer.close()
+
+    def flush(self):
+        """
+         Writes records collected by spool writer (compressed block)
+         to the segment, so they can be read
+        """
+        with self.__lock:
+            writer = self.__writer
+        if writer is not None:
+            writer.flush()
+
     def getStorageFileName(self, uid):
         """
          Returns storage filename.
@@ -47,18 +88,19 @@ class Storage(object):
          string of uid as a file name.
          @param uid: Device identifier
         """
+        return os.path.join(self.__path, self.getItemName(uid))
+
+    def getItemName(self, uid):
+        """
+         Returns name of the storage item (file name) of the device
+         @param uid: Device identifier
+         @return: str
+        """
         if (self.re_uid.match(uid)):
             storageFileName = uid
         else:
             storageFileName = base64.b64encode(uid.encode()).decode()
-
-        if not os.path.isdir(self.__path):
-            try:
-                os.makedirs(self.__path, 0o777, True)
-            except:
-                pass
-
-        return os.path.join(self.__path, storageFileName + self.filePostfix)
+        return storageFileName + self.filePostfix
 
     def save(self, uid, data):
         """
@@ -76,8 +118,7 @@ class Storage(object):
         """
         log.debug('Storage::saveByUid(). %s', uid)
         try:
-            with open(self.getStorageFileName(uid), 'ab') as f:
-                f.write(data)
+            self.getWriter().append(uid, data)
         except Exception as E:
             log.error(E)
 
@@ -91,27 +132,148 @@ class Storage(object):
         for filename in fnmatch.filter(files, pattern):
             yield filename
 
+    def readLegacyFile(self, storageFileName):
+        """
+         Returns item of the storage file of the previous versions
+         @param storageFileName: File name
+         @return: dict Item (name, contents)
+        """
+        f_data = {}
+        with open(storageFileName, 'rb') as f:
+            f_data['name'] = os.path.basename(storageFileName)
+            f_data['contents'] = f.read()
+        f_data['size'] = len(f_data['contents'])
+        return f_data
+
+    def readSegment(self, fileName):
+        """
+         Returns not deleted records of the spool segment grouped by device
+         @param fileName: Segment file name
+         @return: list of items (name, uid, contents, records and size
+           of records in the segment)
+        """
+        items = {}
+        deleted = spool.readDeleted(fileName)
+        for offset, uid, port, timestamp, data in \
+                spool.readRecords(fileName):
+            if offset in deleted:
+                continue
+            if uid not in items:
+                items[uid] = {
+                    'name': self.getItemName(uid),
+                    'uid': uid,
+                    'contents': [],
+                    'records': [],
+                    'size': 0
+                }
+            items[uid]['contents'].append(data)
+            items[uid]['records'].append((fileName, offset))
+            items[uid]['size'] += spool.getRecordSize(uid, data)
+        for item in items.values():
+            item['contents'] = b''.join(item['contents'])
+        return list(items.values())
+
+    def getPortDirs(self):
+        """
+         Returns port directories of the storage
+         @return: list of tuples (port, directory)
+        """
+        result = []
+        for dirPort in sorted(glob.glob(os.path.join(self.pathStorage, '*'))):
+            basename = os.path.basename(dirPort)
+            if os.path.isdir(dirPort) and self.re_port.match(basename):
+                result.append((basename, dirPort))
+        return result
+
+    def replayPort(self, dirPort):
+        """
+         Returns data of the port directory lazily: storage files one
+         by one and records of every spool segment grouped by device.
+         Segments are memory-mapped and read one by one, so no more than
+         one segment is held in memory
+         @param dirPort: Directory of the port
+         @return: generator of items (see readSegment)
+        """
+        self.flush()
+        for storageFileName in sorted(glob.glob(
+                os.path.join(dirPort, '*' + self.filePostfix))):
+            if (os.path.isfile(storageFileName)):
+                yield self.readLegacyFile(storageFileName)
+        for number in spool.getSegmentNumbers(dirPort):
+            fileName = spool.getSegmentFileName(dirPort, number)
+            try:
+                items = self.readSegment(fileName)
+            except Exception as E:
+                log.error('Storage: error reading %s: %s', fileName, E)
+                continue
+            for item in items:
+                yield item
+
+    def getSize(self, dirPort):
+        """
+         Returns size of stored data of the port directory
+         (storage files and not deleted records of spool segments)
+         @param dirPort: Directory of the port
+         @return: int Size in bytes
+        """
+        size = 0
+        for storageFileName in glob.glob(
+                os.path.join(dirPort, '*' + self.filePostfix)):
+            size += os.path.getsize(storageFileName)
+        for number in spool.getSegmentNumbers(dirPort):
+            fileName = spool.getSegmentFileName(dirPort, number)
+            try:
+                index, sealed = spool.readIndex(fileName)
+                deleted = spool.readDeleted(fileName)
+            except Exception as E:
+                log.error('Storage: error reading %s: %s', fileName, E)
+                continue
+            for records in index['uids'].values():
+                size += sum(length for offset, length in records
+                    if offset not in deleted)
+        return size
+
+    def replay(self):
+        """
+         Returns all existed data in storage lazily (see replayPort)
+         @return: generator of tuples (port, item)
+        """
+        for port, dirPort in self.getPortDirs():
+            for item in self.replayPort(dirPort):
+                yield port, item
+
+    def loadPort(self, dirPort):
+        """
+         Returns data of the port directory grouped by device
+         @param dirPort: Directory of the port
+         @return: list of items (name, contents, uid and records)
+        """
+        items = []
+        devices = {}
+        for item in self.replayPort(dirPort):
+            uid = item.get('uid')
+            if uid is None:
+                items.append(item)
+            elif uid not in devices:
+                devices[uid] = item
+                items.append(item)
+            else:
+                devices[uid]['contents'] += item['contents']
+                devices[uid]['records'].extend(item['records'])
+                devices[uid]['size'] += item['size']
+        return items
+
     def load(self):
         """
          Returns all existed data in storage
          @return (list) Storage data
         """
         list = []
-        for dirPort in glob.glob(os.path.join(conf.pathStorage, '*')):
-            basename = os.path.basename(dirPort)
-            if os.path.isdir(dirPort) and self.re_port.match(basename):
-                record = {}
-                record['port'] = basename
-                record['data'] = []
-                for storageFileName in glob.glob(
-                    os.path.join(dirPort, '*' + self.filePostfix)):
-                    if (os.path.isfile(storageFileName)):
-                        f_data = {}
-                        with open(storageFileName, 'rb') as f:
-                            f_data['name'] = os.path.basename(storageFileName)
-                            f_data['contents'] = f.read()
-                        record['data'].append(f_data)
-                list.append(record)
+        for port, dirPort in self.getPortDirs():
+            record = {}
+            record['port'] = port
+            record['data'] = self.loadPort(dirPort)
+            list.append(record)
         return list
 
     def delete(self, item, port, timestamp):
@@ -123,14 +285,23 @@ class Storage(object):
         """
         try:
             uidName = item['name']
-            filename = os.path.join(conf.pathStorage, port, uidName)
+            filename = os.path.join(self.pathStorage, port, uidName)
             newName = os.path.join(conf.pathTrash, timestamp, port, uidName)
             log.info('Delete data for %s', uidName)
             log.info('fileName = %s, newName = %s', filename, newName)
             newDir = os.path.dirname(newName)
             if not os.path.exists(newDir):
                 os.makedirs(newDir)
-            os.rename(filename, newName)
+            if 'records' not in item:
+                os.rename(filename, newName)
+                return
+            with open(newName, 'ab') as f:
+                f.write(item['contents'])
+            segments = {}
+            for fileName, offset in item['records']:
+                segments.setdefault(fileName, []).append(offset)
+            for fileName, offsets in segments.items():
+                spool.markDeleted(fileName, offsets)
         except Exception as E:
             log.error(E)
 
@@ -143,10 +314,22 @@ class Storage(object):
         log.debug('Storage::loadByUid(). %s', uid)
         data = b''
         try:
+            self.flush()
             storageFileName = self.getStorageFileName(uid)
             if (os.path.isfile(storageFileName)):
                 with open(storageFileName, 'rb') as f:
                     data = f.read()
+            for number in spool.getSegmentNumbers(self.__path):
+                fileName = spool.getSegmentFileName(self.__path, number)
+                index, sealed = spool.readIndex(fileName)
+                if uid not in index['uids']:
+                    continue
+                deleted = spool.readDeleted(fileName)
+                spans = [span for span in index['uids'][uid]
+                    if span[0] not in deleted]
+                for part in spool.readSpans(fileName, index, spans):
+                    for record in spool.unpackRecords(part):
+                        data += record[4]
         except Exception as E:
             log.error(E)
         return data
@@ -157,6 +340,137 @@ class Storage(object):
          @warning By calling this function you delete folder at conf.pathStorage
         """
         log.debug('Storage::clear()')
-        shutil.rmtree(conf.pathStorage)
+        self.close()
+        shutil.rmtree(self.pathStorage)
+
+def getStorage(port = None):
+    """
+     Returns storage of the listener port.
+     Handlers of several listeners of one process (see [listeners]
+     section) save data to storages of their own ports
+     @param port: Port of the listener (conf.port by default)
+     @return: Storage
+    """
+    port = conf.port if port is None else int(port)
+    with storagesLock:
+        if port not in storages:
+            storages[port] = Storage(port = port)
+        return storages[port]
 
 storage = Storage()
+# storages of listener ports of the process (see getStorage())
+storages = {storage.port: storage}
+storagesLock = Lock()
+
+# ===========================================================================
+# TESTS
+# ===========================================================================
+
+import unittest
+import tempfile
+
+class TestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.pathTrash = conf.pathTrash
+        conf.pathTrash = os.path.join(self.path, 'trash')
+        self.storage = Storage(os.path.join(self.path, 'storage'), 20100)
+
+    def tearDown(self):
+        self.storage.close()
+        conf.pathTrash = self.pathTrash
+        shutil.rmtree(self.path)
+
+    def test_saveLoad(self):
+        s = self.storage
+        s.save('uid1', b'\x01\x02')
+        s.save('uid2', b'\x03')
+        s.save('uid1', memoryview(b'\x04'))
+        self.assertEqual(s.loadByUid('uid1'), b'\x01\x02\x04')
+        data = s.load()
+        self.assertEqual(len(data), 1)
+        self.assertEqual(data[0]['port'], '20100')
+        items = data[0]['data']
+        self.assertEqual([(item['name'], item['contents']) for item in items],
+            [('uid1.storage', b'\x01\x02\x04'), ('uid2.storage', b'\x03')])
+
+    def test_delete(self):
+        s = self.storage
+        s.save('uid1', b'\x01\x02')
+        s.save('uid2', b'\x03')
+        s.close()
+        items = s.load()[0]['data']
+        s.delete(items[0], '20100', '1')
+        self.assertEqual(s.loadByUid('uid1'), b'')
+        self.assertEqual([item['name'] for item in s.load()[0]['data']],
+            ['uid2.storage'])
+        with open(os.path.join(conf.pathTrash, '1', '20100',
+                'uid1.storage'), 'rb') as f:
+            self.assertEqual(f.read(), b'\x01\x02')
+        s.delete(items[1], '20100', '1')
+        # all records of the segment are deleted
+        self.assertEqual(os.listdir(os.path.join(self.path,
+            'storage', '20100')), [])
+
+    def test_replay(self):
+        s = Storage(self.storage.pathStorage, 20100)
+        s.save('uid1', b'\x01')
+        s.save('uid2', b'\x02')
+        s.close()
+        s.save('uid1', b'\x03')
+        replay = s.replay()
+        port, item = next(replay)
+        self.assertEqual((port, item['uid'], item['contents']),
+            ('20100', 'uid1', b'\x01'))
+        # data can be deleted during replay
+        s.delete(item, port, '1')
+        self.assertEqual([(item['uid'], item['contents'])
+            for port, item in replay], [('uid2', b'\x02'), ('uid1', b'\x03')])
+        self.assertEqual([(item['uid'], item['contents'])
+            for port, item in s.replay()],
+            [('uid2', b'\x02'), ('uid1', b'\x03')])
+        s.close()
+
+    def test_legacyFile(self):
+        s = self.storage
+        with open(s.getStorageFileName('uid1'), 'wb') as f:
+            f.write(b'\x01')
+        s.save('uid1', b'\x02')
+        self.assertEqual(s.loadByUid('uid1'), b'\x01\x02')
+        items = s.load()[0]['data']
+        self.assertEqual([item['contents'] for item in items],
+            [b'\x01', b'\x02'])
+        s.delete(items[0], '20100', '1')
+        self.assertFalse(os.path.exists(s.getStorageFileName('uid1')))
+
+    def test_compression(self):
+        compression = conf.spoolCompression
+        conf.spoolCompression = 'zlib'
+        try:
+            s = Storage(self.storage.pathStorage, 20200)
+            record = b'\x02\x00\x1f012896001609129\x00\x00\x00\x00\x00'
+            for i in range(100):
+                s.save('uid%d' % (i % 2), record + bytes([i]))
+            self.assertEqual(s.loadByUid('uid1'),
+                b''.join(record + bytes([i]) for i in range(1, 100, 2)))
+            s.close()
+        finally:
+            conf.spoolCompression = compression
+        path = os.path.join(s.pathStorage, '20200')
+        fileName = spool.getSegmentFileName(path, 1)
+        items = s.loadPort(path)
+        self.assertLess(os.path.getsize(fileName), s.getSize(path) / 3)
+        self.assertEqual([item['uid'] for item in items], ['uid0', 'uid1'])
+        self.assertEqual(sum(item['size'] for item in items), s.getSize(path))
+        s.delete(items[0], '20200', '1')
+        s.delete(items[1], '20200', '1')
+        self.assertEqual(os.listdir(path), [])
+
+    def test_getStorage(self):
+        self.assertIs(getStorage(), storage)
+        self.assertIs(getStorage(storage.port), storage)
+        s = getStorage(20300)
+        self.assertIs(getStorage('20300'), s)
+        self.assertEqual(s.port, 20300)
+        del storages[20300]
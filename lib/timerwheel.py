@@ -0,0 +1,171 @@
+# -*- coding: utf8 -*-
+'''
+@project   Maprox <http://www.maprox.net>
+@info      Hierarchical timer wheel
+@copyright 2013, Maprox LLC
+'''
+
+import time
+
+# ===========================================================================
+class TimerWheel(object):
+    """
+     Hierarchical timer wheel.
+     Keeps a lot of timers (one per key) with O(1) scheduling and
+     cancelling. Timers of the first level are kept in slots of one tick,
+     slots of every next level are "slots" times wider. When the wheel
+     turns, timers of the next level are moved down to the lower levels.
+     Wheel is not thread-safe, caller must serialize access to it
+    """
+
+    def __init__(self, tick = 1, slots = 64, levels = 3, now = None):
+        """
+         Constructor
+         @param tick: Duration of one tick in seconds
+         @param slots: Count of slots of every level
+         @param levels: Count of levels (max delay is tick * slots ** levels)
+         @param now: Current time (default is time.time())
+        """
+        self.tick = tick
+        self.slots = slots
+        self.levels = levels
+        self._current = self._getTick(time.time() if now is None else now)
+        self._wheels = [[{} for i in range(slots)] for l in range(levels)]
+        self._timers = {} # key => (expiry tick, level, slot)
+
+    def __len__(self):
+        return len(self._timers)
+
+    def __contains__(self, key):
+        return key in self._timers
+
+    def _getTick(self, value):
+        """
+         Returns number of the tick of the time
+         @param value: Time in seconds
+         @return: int
+        """
+        return int(value // self.tick)
+
+    def schedule(self, key, delay, now = None):
+        """
+         Schedules timer of the key (previous timer of the key is replaced)
+         @param key: Hashable key of the timer
+         @param delay: Delay in seconds
+         @param now: Current time (default is time.time())
+        """
+        now = time.time() if now is None else now
+        # timer never expires earlier than the delay
+        expiry = -int(-(now + delay) // self.tick)
+        self.cancel(key)
+        self._insert(key, max(expiry, self._current + 1))
+
+    def _insert(self, key, expiry):
+        """
+         Puts timer into the slot of the suitable level
+         @param key: Key of the timer
+         @param expiry: Expiry tick
+        """
+        delta = expiry - self._current
+        level = 0
+        span = self.slots
+        while delta >= span and level < self.levels - 1:
+            level += 1
+            span *= self.slots
+        # timers beyond the wheel wait in the farthest slot of the last level
+        expiryTick = min(expiry, self._current + span - 1)
+        slot = (expiryTick // (span // self.slots)) % self.slots
+        self._wheels[level][slot][key] = expiry
+        self._timers[key] = (expiry, level, slot)
+
+    def cancel(self, key):
+        """
+         Cancels timer of the key
+         @param key: Key of the timer
+         @return: True if timer existed
+        """
+        timer = self._timers.pop(key, None)
+        if timer is None:
+            return False
+        expiry, level, slot = timer
+        del self._wheels[level][slot][key]
+        return True
+
+    def advance(self, now = None):
+        """
+         Turns the wheel to the current time
+         @param now: Current time (default is time.time())
+         @return: list of keys of expired timers (in order of expiry)
+        """
+        target = self._getTick(time.time() if now is None else now)
+        expired = []
+        while self._current < target:
+            self._current += 1
+            self._cascade()
+            slot = self._wheels[0][self._current % self.slots]
+            for key, expiry in list(slot.items()):
+                if expiry <= self._current:
+                    del slot[key]
+                    del self._timers[key]
+                    expired.append(key)
+        return expired
+
+    def _cascade(self):
+        """
+         Moves timers of the upper levels down when their slot is reached
+        """
+        span = 1
+        for level in range(1, self.levels):
+            span *= self.slots
+            if self._current % span:
+                break
+            slot = self._wheels[level][(self._current // span) % self.slots]
+            timers = list(slot.items())
+            slot.clear()
+            for key, expiry in timers:
+                self._insert(key, expiry)
+
+# ===========================================================================
+# TESTS
+# ===========================================================================
+
+import unittest
+class TestCase(unittest.TestCase):
+
+    def test_expiry(self):
+        wheel = TimerWheel(1, 4, 3, now = 0)
+        for key, delay in [('a', 1), ('b', 3), ('c', 5), ('d', 17), ('e', 70)]:
+            wheel.schedule(key, delay, now = 0)
+        self.assertEqual(len(wheel), 5)
+        self.assertEqual(wheel.advance(0.5), [])
+        self.assertEqual(wheel.advance(1), ['a'])
+        self.assertEqual(wheel.advance(4.9), ['b'])
+        self.assertEqual(wheel.advance(16), ['c'])
+        self.assertEqual(wheel.advance(17), ['d'])
+        # timer beyond the wheel range (64 ticks) expires in time as well
+        self.assertEqual(wheel.advance(69), [])
+        self.assertEqual(wheel.advance(70), ['e'])
+        self.assertEqual(len(wheel), 0)
+
+    def test_reschedule(self):
+        wheel = TimerWheel(1, 8, 2, now = 100)
+        wheel.schedule('a', 10, now = 100)
+        wheel.schedule('b', 10, now = 100)
+        wheel.schedule('a', 30, now = 105)
+        self.assertTrue(wheel.cancel('b'))
+        self.assertFalse(wheel.cancel('b'))
+        self.assertEqual(wheel.advance(134), [])
+        self.assertIn('a', wheel)
+        self.assertEqual(wheel.advance(135), ['a'])
+        self.assertNotIn('a', wheel)
+
+    def test_many(self):
+        wheel = TimerWheel(0.5, 16, 3, now = 0)
+        for i in range(1000):
+            wheel.schedule(i, i % 300 + 0.1, now = 0)
+        expired = []
+        for t in range(0, 320, 7):
+            for key in wheel.advance(t):
+                self.assertLessEqual(key % 300 + 0.1, t)
+                expired.append(key)
+        self.assertEqual(sorted(expired), list(range(1000)))
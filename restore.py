@@ -2,61 +2,59 @@
 '''
 @project   Maprox <http://www.maprox.net>
 @info      Restoring from storage
-@copyright 2009-2012, Maprox LLC
+@copyright 2009-2013, Maprox LLC
+
+Usage:
+  python3 restore.py [--mode socket|direct] [-j WORKERS] [-r RATE]
+    [--progress SECONDS] [options of the pipe, e.g. -c handler.conf]
+
+In socket mode stored data is sent to the servers of ports on localhost.
+In direct mode data is passed to handlers of ports (see [listeners] or
+[settings] section of the handler configuration) inside of this process,
+packets are sent to the observer not faster than RATE records per second.
 '''
 
-import socket
-import time
+import sys
+import argparse
+
+parser = argparse.ArgumentParser(description = 'Restoring from storage')
+parser.add_argument('--mode', choices = ['socket', 'direct'],
+    default = 'socket', help = 'restore mode (default: %(default)s)')
+parser.add_argument('-j', '--workers', type = int, default = 1,
+    help = 'count of worker threads (default: %(default)s)')
+parser.add_argument('-r', '--rate', type = int, default = 0,
+    help = 'max count of records per second in direct mode (0 - unlimited)')
+parser.add_argument('--progress', type = float, default = 10,
+    help = 'interval (in seconds) of progress reports')
+args, sys.argv[1:] = parser.parse_known_args()
 
 from kernel.logger import log
 from lib.storage import storage
+from lib.restorer import Restorer, MODE_DIRECT
 
+def report(lines):
+    for line in lines:
+        log.info(line)
+        print(line)
+    sys.stdout.flush()
+
+code = 1
 try:
-    TIMEOUT_SECONDS = 30 # seconds for waiting/sending data
-    timestamp = str(int(time.time()))
-    for record in storage.load():
-        host, port = "localhost", int(record['port'])
-        for item in record['data']:
-            try:
-                data = item['contents']
-
-                # Let's remove data from storage here
-                # to avoid double entries in storage when error
-                storage.delete(item, str(port), timestamp)
-
-                # Connect to server and send data
-                # Create a socket (SOCK_STREAM means a TCP socket)
-                sock = socket.socket(
-                    socket.AF_INET,
-                    socket.SOCK_STREAM
-                )
-                sock.settimeout(TIMEOUT_SECONDS)
-                try:
-                    sock.connect((host, port))
-                    try:
-                        sock.send(data)
-                    except Exception as E:
-                        # In case of error during data sending
-                        # try to send it again
-                        sock = socket.socket(
-                            socket.AF_INET,
-                            socket.SOCK_STREAM
-                        )
-                        sock.connect((host, port))
-                        sock.send(data)
-
-                    try:
-                        # if there is some data from server,
-                        # let's receive it
-                        while sock.recv(4096): pass
-                    except:
-                        pass
-
-                except Exception as E:
-                    log.error(E)
-                finally:
-                    sock.close()
-            except Exception as E:
-                log.error(E)
+    listeners = []
+    if args.mode == MODE_DIRECT:
+        # commands of devices are received by the running server,
+        # so AMQP threads of handlers are not started
+        from lib.handlers.list import getListeners
+        listeners = getListeners(False)
+    restorer = Restorer(storage, listeners, args.mode, args.workers,
+        args.rate)
+    if restorer.run(args.progress, report):
+        code = 0
 except Exception as E:
     log.error(E)
+
+# packets, which are waiting for publishing, are sent before exit
+from lib.broker import publisher
+publisher.stop()
+storage.close()
+sys.exit(code)
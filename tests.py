@@ -40,6 +40,24 @@ from lib.handlers.ime.abstract import TestCase as tc23
 from lib.handlers.ime.packets import TestCase as tc25
 from lib.handlers.ime.commands import TestCase as tc26
 from lib.handlers.globusgps.gltr1mini import TestCase as tc27
+from kernel.server import TestCase as tc28
+from lib.broker import TestCase as tc29
+from lib.broker import PublisherTestCase as tc30
+from lib.broker import CommandThreadTestCase as tc31
+from lib.framer import TestCase as tc32
+from lib.handler import TestCase as tc33
+from kernel.supervisor import TestCase as tc34
+from lib.detector import TestCase as tc35
+from kernel.balancer import TestCase as tc36
+from lib.timerwheel import TestCase as tc37
+from kernel.database.balancer import TestCase as tc38
+from lib.packets import TestCase as tc39
+from lib.handlers.naviset.batch import TestCase as tc40
+from kernel.database.memory import TestCase as tc41
+from lib.spool import TestCase as tc42
+from lib.storage import TestCase as tc43
+from lib.restorer import TestCase as tc44
+from kernel.dbmanager import TestCase as tc45
 
 if __name__ == '__main__':
     unittest.main()